@@ -0,0 +1,118 @@
+"""
+A stub of the helm binary serving canned responses from a fixture directory, so the benchmarks run offline.
+
+Environment:
+    FAKE_HELM_DIR       The fixture directory written by write_fixtures.
+    FAKE_HELM_LATENCY   Seconds every command sleeps before answering, default 0.
+    FAKE_HELM_LATENCY_<COMMAND>
+                        Latency of a single command, e.g. FAKE_HELM_LATENCY_UPGRADE=2.
+
+Supported commands: version, list, status, history, get values, pull, template, upgrade, rollback.
+"""
+import json, os, shutil, stat, sys, tarfile, time
+from io import BytesIO
+
+CHART_NAME = "quixplatform-manager"
+CHART_VERSION = "1.0.0"
+RELEASE_NAME = "quixplatform-manager"
+
+
+def write_fixtures(directory: str, defaults_yaml: str, release_values: dict, manifests: str, namespace: str = "quix"):
+    """
+    Writes the canned responses of the stub and a helm executable wrapping it.
+
+    :param directory: The fixture directory, created if needed.
+    :param defaults_yaml: The values.yaml of the chart.
+    :param release_values: The values of the deployed release.
+    :param manifests: The output of helm template.
+    :param namespace: The namespace of the release.
+    :return: The path of the helm executable.
+    """
+    os.makedirs(directory, exist_ok=True)
+    release = {
+        'name': RELEASE_NAME, 'namespace': namespace, 'revision': '3', 'updated': '2025-01-01 00:00:00.000000 +0000 UTC',
+        'status': 'deployed', 'chart': f"{CHART_NAME}-{CHART_VERSION}", 'app_version': CHART_VERSION,
+    }
+    with open(os.path.join(directory, "list.json"), 'w') as f:
+        json.dump([release], f)
+    with open(os.path.join(directory, "values.json"), 'w') as f:
+        json.dump(release_values, f)
+    with open(os.path.join(directory, "manifests.yaml"), 'w') as f:
+        f.write(manifests)
+
+    files = {
+        f"{CHART_NAME}/Chart.yaml": f"apiVersion: v2\nname: {CHART_NAME}\nversion: {CHART_VERSION}\n".encode('utf-8'),
+        f"{CHART_NAME}/values.yaml": defaults_yaml.encode('utf-8'),
+        f"{CHART_NAME}/templates/configmap.yaml": b"apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: config\n",
+    }
+    with tarfile.open(os.path.join(directory, "chart.tgz"), "w:gz") as archive:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = 0
+            archive.addfile(info, BytesIO(content))
+
+    helm_bin = os.path.join(directory, "helm")
+    with open(helm_bin, 'w') as f:
+        f.write(f'#!/bin/sh\nFAKE_HELM_DIR="{directory}" exec "{sys.executable}" "{os.path.abspath(__file__)}" "$@"\n')
+    os.chmod(helm_bin, os.stat(helm_bin).st_mode | stat.S_IEXEC)
+    return helm_bin
+
+
+def _option(args: list, name: str, default=None):
+    return args[args.index(name) + 1] if name in args and args.index(name) + 1 < len(args) else default
+
+
+def _copy_file(path: str):
+    with open(path, 'rb') as f:
+        shutil.copyfileobj(f, sys.stdout.buffer)
+
+
+def main(args: list):
+    fixtures = os.environ.get('FAKE_HELM_DIR', '.')
+    command = args[0] if args else ''
+    if command == 'get' and len(args) > 1:
+        command = f"get_{args[1]}"
+    latency = os.environ.get(f"FAKE_HELM_LATENCY_{command.upper()}", os.environ.get('FAKE_HELM_LATENCY', '0'))
+    time.sleep(float(latency))
+
+    if command == 'version':
+        print("v3.17.2+gfake")
+    elif command == 'list':
+        _copy_file(os.path.join(fixtures, "list.json"))
+    elif command == 'get_values':
+        _copy_file(os.path.join(fixtures, "values.json"))
+    elif command == 'status':
+        with open(os.path.join(fixtures, "list.json")) as f:
+            release = json.load(f)[0]
+        json.dump({'name': release['name'], 'namespace': release['namespace'], 'version': int(release['revision']),
+                   'info': {'status': release['status'], 'description': 'Upgrade complete'},
+                   'chart': {'metadata': {'name': CHART_NAME, 'version': CHART_VERSION, 'appVersion': CHART_VERSION}}}, sys.stdout)
+    elif command == 'history':
+        with open(os.path.join(fixtures, "list.json")) as f:
+            release = json.load(f)[0]
+        json.dump([{'revision': int(release['revision']), 'updated': release['updated'], 'status': release['status'],
+                    'chart': release['chart'], 'app_version': release['app_version'], 'description': 'Upgrade complete'}], sys.stdout)
+    elif command == 'pull':
+        chart = args[1].rstrip('/').split('/')[-1]
+        version = _option(args, '--version', CHART_VERSION)
+        shutil.copyfile(os.path.join(fixtures, "chart.tgz"), os.path.join(_option(args, '--destination', '.'), f"{chart}-{version}.tgz"))
+        print(f"Pulled: {args[1]}:{version}")
+    elif command in ('template', 'upgrade'):
+        # helm reads the values before rendering
+        if '-' in args:
+            sys.stdin.buffer.read()
+        if command == 'template':
+            _copy_file(os.path.join(fixtures, "manifests.yaml"))
+        else:
+            print(f'Release "{args[2]}" has been upgraded. Happy Helming!')
+    elif command == 'rollback':
+        print("Rollback was a success! Happy Helming!")
+    else:
+        print(f"Error: unknown command {command!r} for fake helm", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,194 @@
+"""
+Runs the benchmark suite offline and writes the results as JSON.
+
+Usage:
+    python benchmarks/run.py [--output results.json] [--size-kb 300] [--repeat 5] [--latency 0.05]
+    python benchmarks/run.py --compare baseline.json [--threshold 0.2]
+
+The end-to-end benchmarks run HelmManager against a stub helm binary serving canned responses,
+the micro-benchmarks time the merge, the serialization and the chart extraction on synthetic values.
+With --compare, the run fails when the median of a benchmark regressed by more than the threshold.
+"""
+import argparse, json, logging as std_logging, os, platform, statistics, sys, tempfile, time, yaml
+from argparse import Namespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from benchmarks.fake_helm import CHART_NAME, CHART_VERSION, RELEASE_NAME, write_fixtures
+from benchmarks.values_generator import derive_release_values, generate_manifests, generate_override, generate_values
+from src import helm_manager
+from src.helm_manager import DeploymentManager, FileManager, HelmManager, YamlMerger
+
+NAMESPACE = "quix"
+REPO = f"quixcontainerregistry.azurecr.io/helm/{CHART_NAME}"
+
+
+def measure(func, repeat: int, setup=None):
+    """
+    Times a function.
+
+    :param func: The function to time.
+    :param repeat: The number of timed runs.
+    :param setup: Optional function run before every timed run, not timed.
+    :return: A dictionary with the statistics of the runs in seconds.
+    """
+    runs = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return {
+        'best': min(runs),
+        'median': statistics.median(runs),
+        'mean': statistics.mean(runs),
+        'runs': repeat,
+    }
+
+
+class Suite:
+    def __init__(self, workdir: str, size_kb: int, depth: int, list_length: int, multiline_ratio: float, latency: float):
+        """
+        Prepares the synthetic data and the fixtures of the stub helm binary.
+
+        :param workdir: The directory of the fixtures and the workspaces of the runs.
+        :param size_kb: The approximate size of the values documents, in kilobytes.
+        :param depth: The nesting depth of the generated values.
+        :param list_length: The length of the generated lists.
+        :param multiline_ratio: The ratio of multi-line strings in the generated values.
+        :param latency: The latency of every command of the stub helm binary, in seconds.
+        """
+        self.workdir = workdir
+        self.defaults = generate_values(size_kb=size_kb, depth=depth, list_length=list_length, multiline_ratio=multiline_ratio)
+        self.release_values = derive_release_values(self.defaults)
+        self.override = generate_override(self.defaults)
+        self.defaults_yaml = FileManager.dump_values(self.defaults)
+        fixtures = os.path.join(workdir, "fixtures")
+        self.helm_bin = write_fixtures(fixtures, self.defaults_yaml, self.release_values, generate_manifests(), namespace=NAMESPACE)
+        self.chart_archive = os.path.join(fixtures, "chart.tgz")
+        self.override_path = os.path.join(workdir, "override.yaml")
+        with open(self.override_path, 'w') as f:
+            f.write(FileManager.dump_values(self.override))
+        os.environ['FAKE_HELM_LATENCY'] = str(latency)
+        helm_manager.HELM_RUNNER.helm_bin = self.helm_bin
+
+    def _run_helm_manager(self, action: str):
+        args = Namespace(action=action, release_name=RELEASE_NAME, namespace=NAMESPACE, timeout=None, override=self.override_path,
+                         repo=f"{REPO}:{CHART_VERSION}", keep_artifacts=False, force=True,
+                         output_dir=os.path.join(self.workdir, "manifests"))
+        deployment = DeploymentManager(tempdir=os.path.join(self.workdir, "runs"))
+        HelmManager(args, deployment=deployment).run()
+
+    def benchmarks(self):
+        """
+        :return: A list of (name, function, setup) tuples.
+        """
+        merged_path = os.path.join(self.workdir, "merged.yaml")
+        extract_dir = os.path.join(self.workdir, "extract")
+        merger = YamlMerger(self.release_values, self.defaults, self.override)
+
+        return [
+            ("e2e.update", lambda: self._run_helm_manager("update"), None),
+            ("e2e.template", lambda: self._run_helm_manager("template"), None),
+            ("micro.yaml_merger_merge", merger.merge, None),
+            ("micro.save_merged_yaml", lambda: merger.save_merged_yaml(merged_path), None),
+            ("micro.extract_tgz", lambda: FileManager.extract_tgz(self.chart_archive, extract_dir),
+             lambda: FileManager.delete_folder(extract_dir)),
+            ("micro.read_values_from_tgz", lambda: FileManager.read_from_tgz(self.chart_archive, f"{CHART_NAME}/values.yaml"), None),
+        ]
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """
+    Compares the medians of two runs.
+
+    :param results: The results of this run.
+    :param baseline: The results of the baseline run.
+    :param threshold: The tolerated slowdown, e.g. 0.2 for 20%.
+    :return: Tuple of the report lines and the names of the regressed benchmarks.
+    """
+    lines = [f"{'BENCHMARK':32} {'BASELINE':>10} {'CURRENT':>10} {'CHANGE':>8}"]
+    regressions = []
+    for name, current in results['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            lines.append(f"{name:32} {'-':>10} {current['median'] * 1000:>8.2f}ms {'new':>8}")
+            continue
+        change = current['median'] / previous['median'] - 1 if previous['median'] else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        lines.append(f"{name:32} {previous['median'] * 1000:>8.2f}ms {current['median'] * 1000:>8.2f}ms {change:>+8.1%}{flag}")
+    return lines, regressions
+
+
+def run_suite(args: Namespace):
+    """
+    Prepares the fixtures and runs the benchmarks selected by the arguments.
+
+    :param args: The parsed arguments.
+    :return: The results as a dictionary.
+    """
+    with tempfile.TemporaryDirectory(prefix="quix-benchmarks-") as workdir:
+        suite = Suite(workdir, args.size_kb, args.depth, args.list_length, args.multiline_ratio, args.latency)
+        results = {
+            'meta': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'pyyaml': yaml.__version__,
+                'libyaml': helm_manager.YamlLoader is not yaml.SafeLoader,
+                'parameters': {key: getattr(args, key) for key in ('repeat', 'size_kb', 'depth', 'list_length', 'multiline_ratio', 'latency')},
+                'defaults_bytes': len(suite.defaults_yaml),
+            },
+            'results': {},
+        }
+        for name, func, setup in suite.benchmarks():
+            if args.filter and args.filter not in name:
+                continue
+            results['results'][name] = measure(func, args.repeat, setup)
+            print(f"{name:32} median {results['results'][name]['median'] * 1000:9.2f}ms  best {results['results'][name]['best'] * 1000:9.2f}ms")
+    return results
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='Compare the results with a previous results file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Tolerated slowdown of a median with --compare (default 0.2, i.e. 20%%)')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs of every benchmark (default 5)')
+    parser.add_argument('--size-kb', type=int, default=300, help='Approximate size of the values documents in KB (default 300)')
+    parser.add_argument('--depth', type=int, default=4, help='Nesting depth of the generated values (default 4)')
+    parser.add_argument('--list-length', type=int, default=5, help='Length of the generated lists (default 5)')
+    parser.add_argument('--multiline-ratio', type=float, default=0.1, help='Ratio of multi-line strings in the generated values (default 0.1)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Latency of every stub helm command in seconds (default 0.05)')
+    parser.add_argument('--filter', help='Only run the benchmarks whose name contains this string')
+    args = parser.parse_args(argv)
+
+    # The runs log at INFO, keep the output to the results
+    logger = std_logging.getLogger('quix-manager')
+    log_level, helm_bin = logger.level, helm_manager.HELM_RUNNER.helm_bin
+    logger.setLevel(std_logging.WARNING)
+    try:
+        results = run_suite(args)
+    finally:
+        logger.setLevel(log_level)
+        helm_manager.HELM_RUNNER.helm_bin = helm_bin
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(results, baseline, args.threshold)
+        print()
+        print("\n".join(lines))
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Generates synthetic values documents shaped like the values of the Quix platform chart.
+
+The documents are deterministic for a given seed, so two benchmark runs work on the same data.
+"""
+import copy, random, yaml
+
+
+def _scalar(rng: random.Random, index: int):
+    kind = index % 4
+    if kind == 0:
+        return rng.randint(0, 10000)
+    if kind == 1:
+        return rng.random() < 0.5
+    if kind == 2:
+        return f"value-{rng.randint(0, 1 << 30):x}"
+    return f"{rng.randint(1, 9)}.{rng.randint(0, 20)}.{rng.randint(0, 99)}"
+
+
+def _multiline(rng: random.Random, lines: int):
+    return "".join(f"line {i} {rng.randint(0, 1 << 20):x}\n" for i in range(lines))
+
+
+def _tree(rng: random.Random, depth: int, width: int, list_length: int, multiline_ratio: float):
+    """
+    Builds a nested mapping of the given depth, with lists of mappings and multi-line strings along the way.
+    """
+    node = {}
+    for index in range(width):
+        key = f"key{index}"
+        if depth > 1 and index == 0:
+            node[key] = _tree(rng, depth - 1, width, list_length, multiline_ratio)
+        elif index == 1 and list_length:
+            node[key] = [{'name': f"item{item}", 'value': _scalar(rng, item)} for item in range(list_length)]
+        elif rng.random() < multiline_ratio:
+            node[key] = _multiline(rng, 5)
+        else:
+            node[key] = _scalar(rng, index)
+    return node
+
+
+def generate_values(size_kb: int = 300, depth: int = 4, width: int = 4, list_length: int = 5, multiline_ratio: float = 0.1, seed: int = 0):
+    """
+    Generates a values document.
+
+    :param size_kb: The approximate size of the document once dumped as YAML, in kilobytes.
+    :param depth: The nesting depth of every service section.
+    :param width: The number of keys of every mapping.
+    :param list_length: The length of the lists of every service, 0 for no lists.
+    :param multiline_ratio: The ratio of values that are multi-line strings.
+    :param seed: The seed of the generator.
+    :return: The values as a dictionary.
+    """
+    rng = random.Random(seed)
+    values = {
+        'global': {'byocZipVersion': '1.0.0', 'domain': 'example.com'},
+        'image': {'repository': 'quix/platform', 'tag': '1.0.0'},
+        'services': {},
+    }
+    # Every service has the same shape, the size of the first one gives the number of services
+    first = _tree(rng, depth, width, list_length, multiline_ratio)
+    service_size = len(yaml.dump({'service0': first}, default_flow_style=False))
+    values['services']['service0'] = first
+    for index in range(1, max(1, (size_kb * 1024) // service_size)):
+        values['services'][f'service{index}'] = _tree(rng, depth, width, list_length, multiline_ratio)
+    return values
+
+
+def derive_release_values(defaults: dict, change_ratio: float = 0.05, removed_ratio: float = 0.02, seed: int = 1):
+    """
+    Derives the values of a deployed release from chart defaults: an older chart, so some keys are
+    missing and some values were customized.
+
+    :param defaults: The chart defaults.
+    :param change_ratio: The ratio of services with a customized value.
+    :param removed_ratio: The ratio of services missing from the release.
+    :param seed: The seed of the generator.
+    :return: The release values as a new dictionary.
+    """
+    rng = random.Random(seed)
+    values = copy.deepcopy(defaults)
+    values['global']['byocZipVersion'] = '0.9.0'
+    values['image']['tag'] = '0.9.0'
+    for name in list(values['services']):
+        draw = rng.random()
+        if draw < removed_ratio:
+            del values['services'][name]
+        elif draw < removed_ratio + change_ratio:
+            values['services'][name]['key3'] = f"custom-{rng.randint(0, 1 << 20):x}"
+    return values
+
+
+def generate_override(defaults: dict, services: int = 10, seed: int = 2):
+    """
+    Generates a small override document touching a few services of the defaults.
+
+    :param defaults: The chart defaults.
+    :param services: The number of services to override.
+    :param seed: The seed of the generator.
+    :return: The override values.
+    """
+    rng = random.Random(seed)
+    names = sorted(defaults['services'])
+    override = {'services': {}}
+    for name in rng.sample(names, min(services, len(names))):
+        override['services'][name] = {'key2': f"override-{rng.randint(0, 1 << 20):x}"}
+    return override
+
+
+def generate_manifests(documents: int = 200, size_kb: int = 2):
+    """
+    Generates a multi-document stream like the output of 'helm template'.
+
+    :param documents: The number of documents.
+    :param size_kb: The approximate size of every document, in kilobytes.
+    :return: The manifests as a string.
+    """
+    data_line = "  key{index}: " + "x" * 60 + "\n"
+    lines_per_document = max(1, size_kb * 1024 // len(data_line.format(index=0)))
+    parts = []
+    for document in range(documents):
+        parts.append(f"---\n# Source: quixplatform-manager/templates/config{document}.yaml\n"
+                     f"apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: config{document}\ndata:\n")
+        parts.extend(data_line.format(index=index) for index in range(lines_per_document))
+    return "".join(parts)
@@ -1,10 +1,20 @@
-import argparse, logging,io, yaml
-from src.helm_manager import  HelmManager
+import sys, time
+# Taken before any other import, so --startup-profile also accounts for them
+STARTED = time.perf_counter()
+PROFILER = None
+if '--startup-profile' in sys.argv:
+    from src.startup import ImportProfiler
+    PROFILER = ImportProfiler.install()
+import argparse, logging
+from src.log_capture import CaptureHandler, DEFAULT_MAX_BYTES
+from src.retry import parse_duration
 
+# The other modules are imported once the arguments are parsed, and only by the actions that use
+# them: every ArgoCD sync starts a new interpreter.
 
 
 # Function to convert logs into a Kubernetes ConfigMap format
-def generate_configmap(logs, configmap_name='quix-manager-log-configmap', namespace = "quix"):
+def generate_configmap(logs, configmap_name='quix-manager-log-configmap', namespace = "quix", metrics = None, compress = False):
     configmap = {
         'apiVersion': 'v1',
         'kind': 'ConfigMap',
@@ -12,17 +22,25 @@ def generate_configmap(logs, configmap_name='quix-manager-log-configmap', namesp
             'name': configmap_name,
             'namespace': namespace
         },
-        'data': {
-            'helm-logs': logs
-        }
+        'data': {}
     }
+    if compress:
+        import gzip, base64
+        # Logs compress well, gzip keeps a long run under the size limit of a ConfigMap
+        configmap['binaryData'] = {'helm-logs.gz': base64.b64encode(gzip.compress(logs.encode('utf-8'), mtime=0)).decode('ascii')}
+    else:
+        configmap['data']['helm-logs'] = logs
+    if metrics:
+        import json
+        # Phase timings of the run, as JSON
+        configmap['data']['helm-metrics'] = json.dumps(metrics, indent=2)
     return configmap
 
-def setup_logging(verbose: bool):
+def setup_logging(verbose: bool, max_bytes: int = DEFAULT_MAX_BYTES):
     # Define the log format
     log_format = '# %(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    # Create an in-memory stream to capture logs
-    log_stream = io.StringIO()
+    # Capture the logs in memory, within a byte budget
+    log_stream = CaptureHandler(max_bytes=max_bytes)
 
     # Configure logger for both stdout and in-memory logging
     logger = logging.getLogger('quix-manager')
@@ -35,9 +53,8 @@ def setup_logging(verbose: bool):
         logger.addHandler(console_handler)
         
         # Handler for capturing logs in memory
-        memory_handler = logging.StreamHandler(log_stream)
-        memory_handler.setFormatter(logging.Formatter(log_format))
-        logger.addHandler(memory_handler)
+        log_stream.setFormatter(logging.Formatter(log_format))
+        logger.addHandler(log_stream)
     
     # Set log level based on verbosity
     logger.setLevel(logging.DEBUG if verbose else logging.INFO)
@@ -50,33 +67,92 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Quix Installer Helm Plugin")
 
     # Add your own script-specific parameters here
-    parser.add_argument('action', choices = ["update","template"], help='Specify the Helm action to perform (e.g., install, upgrade, delete)')
+    parser.add_argument('action', choices = ["update","template","batch"], help='Specify the Helm action to perform (e.g., install, upgrade, delete)')
     parser.add_argument('--release-name', help='Specify the release name for the Helm command')
     parser.add_argument('--repo', help='Specify the Helm chart repository')
     parser.add_argument('--override', help='Override default values for the Helm chart')
     parser.add_argument('--namespace', help='Specify the Kubernetes namespace for the Helm command')
     parser.add_argument('--timeout', help='Specify the timeout for the Helm command')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose output for this script and the Helm command')
+    parser.add_argument('--cache-dir', help='Directory of a persistent chart cache. Charts already in the cache are not pulled again')
+    parser.add_argument('--cache-max-size', type=int, help='Maximum size of the chart cache in MiB (default 512)')
+    parser.add_argument('--manifest', help='Manifest file listing the releases to process with the batch action')
+    parser.add_argument('--parallel', type=int, default=4, help='Number of releases processed at the same time by the batch action (default 4)')
+    parser.add_argument('--tmpfs', action='store_true', help='Create the working directory of the run on tmpfs (/dev/shm) when available')
+    parser.add_argument('--keep-artifacts', action='store_true', help='Keep the current, default and merged values files in the working directory')
+    parser.add_argument('--force', action='store_true', help='Upgrade even if the release already runs the same chart version with the same values')
+    parser.add_argument('--explain', nargs='?', const='-', metavar='PATH', help='Report as JSON which input (release, defaults, override or special) supplied every merged value. Written to stderr, or to PATH if given')
+    parser.add_argument('--output-dir', help='Write the manifests of the template action to this directory, one file per resource (<kind>/<name>.yaml), instead of stdout')
+    parser.add_argument('--deadline', type=parse_duration, help='Time budget of the whole run, e.g. 10m. Shared by every helm call, which is killed when it runs out')
+    parser.add_argument('--retries', type=int, help='Number of retries of a helm call failing with a transient error, e.g. a registry 502 or API server throttling (default 2)')
+    parser.add_argument('--native-reads', action='store_true', help='Read the release state (list, status, history, values) from the helm storage secrets with a single kubectl call instead of running helm for every query. Falls back to helm if kubectl cannot read them or finds none. Ignored unless $HELM_DRIVER is unset or secret')
+    parser.add_argument('--resume', action='store_true', help='Checkpoint the phases of the update on disk, values of the release included, so a retry of a failed attempt resumes after them')
+    parser.add_argument('--metrics-file', help='Write the phase timings of the run to this file in the OpenMetrics text format, e.g. for the node-exporter textfile collector')
+    parser.add_argument('--logs-max-size', type=int, default=DEFAULT_MAX_BYTES // 1024, help='Maximum size of the logs kept for --logs-as-config in KiB, the oldest debug and info lines are dropped first (default 512)')
+    parser.add_argument('--logs-compress', action='store_true', help='Write the logs of --logs-as-config gzip-compressed under binaryData')
+    parser.add_argument('--record-helm', metavar='PATH', help='Record every helm call of the run (arguments, output, exit code and latency) to this JSON lines file')
+    parser.add_argument('--replay-helm', metavar='PATH', help='Serve the helm calls from a file written by --record-helm instead of running helm')
+    parser.add_argument('--replay-latency-scale', type=float, default=0.0, help='Factor applied to the recorded latencies with --replay-helm (default 0, answer at once)')
+    parser.add_argument('--startup-profile', action='store_true', help='Log the startup time of the plugin, the time spent importing modules and the slowest imports')
     parser.add_argument('--logs-as-config', action='store_true', help='Write in the stdout a configmap with all logs happened. This is essentially for argocd')
     
 
     # Get the args from command
     args, _ = parser.parse_known_args()
     # Set up logging
-    logger, log_stream = setup_logging(args.verbose)
+    logger, log_stream = setup_logging(args.verbose, max_bytes=args.logs_max_size * 1024)
 
     logger.info("Starting Helm command execution")
+    if args.action == "batch" and not args.manifest:
+        parser.error("the batch action requires --manifest")
+    if args.record_helm and args.replay_helm:
+        parser.error("--record-helm and --replay-helm cannot be used together")
+    from src.helm_manager import HelmManager, HELM_BACKEND, set_helm_backend, yaml_module
+    from src.helm_runner import HelmCommandError
+    from src.retry import DeadlineExceeded
+    from src.metrics import Metrics
+
     # Log some initial info
-    helm_manager = HelmManager(args)
-    helm_manager.run()
+    exit_code = 0
+    metrics = Metrics()
+    if args.replay_helm:
+        from src.helm_backend import ReplayBackend
+        set_helm_backend(ReplayBackend(args.replay_helm, latency_scale=args.replay_latency_scale))
+    elif args.record_helm:
+        from src.helm_backend import RecordingBackend
+        set_helm_backend(RecordingBackend(HELM_BACKEND, args.record_helm))
+    if PROFILER:
+        PROFILER.ready()
+    try:
+        if args.action == "batch":
+            from src.batch import BatchRunner
+            try:
+                runner = BatchRunner.from_manifest(args.manifest, args)
+            except (OSError, ValueError) as e:
+                # An unreadable or invalid manifest fails the run, the ConfigMap below still gets its logs
+                logger.error(f"{e}")
+                exit_code = 1
+            else:
+                exit_code = runner.run()
+        else:
+            helm_manager = HelmManager(args, metrics=metrics)
+            helm_manager.run()
+    except (HelmCommandError, DeadlineExceeded) as e:
+        logger.error(f"{e}")
+        exit_code = 1
+    except SystemExit as e:
+        # The reason is already logged, the ConfigMap below still gets the logs and metrics of the failed run
+        exit_code = e.code if isinstance(e.code, int) else 1
+    if PROFILER:
+        PROFILER.report(STARTED)
     if args.logs_as_config:
 
         # Retrieve the logs f rom the in-memory log stream
         log_contents = log_stream.getvalue()
     
         # Generate ConfigMap with the captured logs
-        configmap_data = generate_configmap(log_contents)
-        print(yaml.dump(configmap_data, default_flow_style=False))
-
-
-
+        configmap_data = generate_configmap(log_contents, metrics=metrics.to_dict() if metrics.spans else None, compress=args.logs_compress)
+        # A document of its own, after the manifests template may have streamed to stdout
+        print("---")
+        print(yaml_module().dump(configmap_data, default_flow_style=False))
+    sys.exit(exit_code)
@@ -0,0 +1,149 @@
+import os, time, logging
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from src.helm_backend import HelmBackend
+from src.helm_manager import HelmManager, DeploymentManager, load_yaml, retrying_backend
+from src.release import ReleaseSnapshot, parse_release_list
+from src.retry import Deadline, parse_duration
+
+logging = logging.getLogger('quix-manager')
+
+# Per-release settings a manifest can set, with the CLI flag they mirror
+RELEASE_KEYS = ('release_name', 'namespace', 'repo', 'override', 'timeout', 'action', 'cache_dir', 'cache_max_size', 'force', 'deadline', 'retries', 'native_reads', 'output_dir', 'resume')
+
+
+class BatchResult:
+    def __init__(self, namespace: str, release_name: str, action: str):
+        """
+        Holds the outcome of one release of a batch.
+
+        :param namespace: Namespace of the release.
+        :param release_name: Name of the release.
+        :param action: The action run on the release.
+        """
+        self.namespace = namespace
+        self.release_name = release_name
+        self.action = action
+        self.succeeded = False
+        self.error = None
+        self.duration = 0.0
+
+
+class BatchRunner:
+    def __init__(self, releases: list, parallel: int = 4, workdir: str = "./tmp", backend: HelmBackend = None):
+        """
+        Initializes a batch of HelmManager pipelines run on a bounded worker pool.
+
+        :param releases: A list of Namespace objects, one per release, with the same fields as the CLI arguments.
+        :param parallel: The maximum number of releases processed at the same time.
+        :param workdir: The directory under which each release gets its own working directory.
+        :param backend: The backend of the discovery. Default retries HELM_BACKEND without a deadline.
+        """
+        self.releases = releases
+        self.parallel = max(1, parallel)
+        self.workdir = workdir
+        self.backend = backend
+
+    @classmethod
+    def from_manifest(cls, manifest_path: str, args: Namespace):
+        """
+        Builds a batch from a manifest file. The manifest lists the releases under 'releases' and
+        may set shared settings under 'defaults'. CLI arguments are the fallback for both.
+
+        :param manifest_path: The path of the manifest file.
+        :param args: Parsed command-line arguments.
+        :return: A BatchRunner.
+        """
+        with open(manifest_path, 'r') as f:
+            manifest = load_yaml(f) or {}
+        defaults = manifest.get('defaults') or {}
+        entries = manifest.get('releases') or []
+        if not entries:
+            raise ValueError(f"Manifest {manifest_path} does not list any release")
+
+        releases = []
+        for entry in entries:
+            settings = {key: entry.get(key, defaults.get(key, getattr(args, key, None))) for key in RELEASE_KEYS}
+            if settings['action'] in (None, 'batch'):
+                settings['action'] = 'update'
+            releases.append(Namespace(**settings))
+
+        # The releases run concurrently: templates streamed to stdout, or to a shared directory, would interleave
+        output_dirs = [os.path.abspath(release.output_dir) for release in releases if release.action == 'template' and release.output_dir]
+        if any(release.action == 'template' and not release.output_dir for release in releases):
+            raise ValueError(f"Manifest {manifest_path}: every template release needs its own output_dir")
+        if len(set(output_dirs)) != len(output_dirs):
+            raise ValueError(f"Manifest {manifest_path}: template releases cannot share an output_dir")
+        # The discovery is retried and bounded like the helm calls of the releases
+        deadline = Deadline(parse_duration(args.deadline)) if getattr(args, 'deadline', None) else None
+        return cls(releases, parallel=args.parallel or 4, backend=retrying_backend(args, deadline))
+
+    def _discover(self):
+        """
+        Lists every release of the cluster once, so the pipelines do not query helm for their own snapshot.
+
+        :return: A dictionary of ReleaseSnapshot keyed by (namespace, release name).
+        """
+        backend = self.backend or retrying_backend()
+        result = HelmManager._check_result(backend.list(all_namespaces=True))
+        snapshots = {}
+        for release in parse_release_list(result.stdout):
+            snapshots[(release.namespace, release.name)] = ReleaseSnapshot.from_releases(release.name, [release])
+        logging.info(f"Discovered {len(snapshots)} releases in the cluster.")
+        return snapshots
+
+    def _run_release(self, release: Namespace, snapshots: dict):
+        """
+        Runs the HelmManager pipeline of a single release.
+
+        :param release: The settings of the release.
+        :param snapshots: The releases discovered in the cluster.
+        :return: A BatchResult.
+        """
+        release_name = release.release_name or "quixplatform-manager"
+        namespace = release.namespace or os.environ.get('HELM_NAMESPACE')
+        result = BatchResult(namespace, release_name, release.action)
+        start = time.monotonic()
+        try:
+            snapshot = snapshots.get((namespace, release_name)) if namespace else None
+            if namespace and snapshot is None:
+                snapshot = ReleaseSnapshot(release_name)
+            deployment = DeploymentManager(tempdir=os.path.join(self.workdir, f"{namespace or 'default'}-{release_name}"))
+            HelmManager(release, snapshot=snapshot, deployment=deployment).run()
+            result.succeeded = True
+        except SystemExit:
+            # HelmManager already logged the reason before exiting
+            result.error = "exited with an error, see the logs above"
+        except Exception as e:
+            logging.error(f"Release {release_name} in namespace {namespace} failed: {e}")
+            result.error = str(e)
+        result.duration = time.monotonic() - start
+        return result
+
+    def run(self):
+        """
+        Runs every release of the batch and logs a result table.
+
+        :return: The exit code, 0 if every release succeeded, 1 otherwise.
+        """
+        snapshots = self._discover()
+        with ThreadPoolExecutor(max_workers=self.parallel, thread_name_prefix='quix-batch') as executor:
+            results = list(executor.map(lambda release: self._run_release(release, snapshots), self.releases))
+        for line in self.format_results(results):
+            logging.info(line)
+        return 0 if all(result.succeeded for result in results) else 1
+
+    @staticmethod
+    def format_results(results: list):
+        """
+        Formats the batch results as a table.
+
+        :param results: A list of BatchResult.
+        :return: The lines of the table.
+        """
+        rows = [("NAMESPACE", "RELEASE", "ACTION", "RESULT", "DURATION", "ERROR")]
+        for result in results:
+            rows.append((result.namespace or "-", result.release_name, result.action,
+                         "succeeded" if result.succeeded else "failed", f"{result.duration:.1f}s", result.error or ""))
+        widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+        return ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows]
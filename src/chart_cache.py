@@ -0,0 +1,295 @@
+import os, json, time, shutil, hashlib, tempfile, contextlib, logging
+
+logging = logging.getLogger('quix-manager')
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MANIFEST_MAX_BYTES = 128 * 1024 * 1024
+
+
+def file_digest(file_path: str, chunk_size: int = 1024 * 1024):
+    """
+    Computes the sha256 digest of a file without loading it fully in memory.
+
+    :param file_path: The path of the file to hash.
+    :param chunk_size: The size of the blocks read from disk.
+    :return: The digest in the 'sha256:<hex>' form.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+
+class ChartCache:
+    ARCHIVE_NAME = "chart.tgz"
+    VALUES_NAME = "values.yaml"
+    META_NAME = "meta.json"
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Initializes a persistent chart cache. Every entry is keyed by repository and version
+        and holds the pulled archive, its values.yaml and a metadata file with the archive digest.
+
+        :param cache_dir: The root directory of the cache.
+        :param max_bytes: The maximum size of the cache before the least recently used entries are evicted.
+        """
+        self.cache_dir = cache_dir
+        self.charts_dir = os.path.join(cache_dir, "charts")
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def _key(repo: str, version: str):
+        """
+        Builds the cache key for a chart.
+
+        :param repo: The chart repository without the version.
+        :param version: The chart version.
+        :return: A filesystem safe key.
+        """
+        return hashlib.sha256(f"{repo}:{version}".encode('utf-8')).hexdigest()
+
+    def _entry_dir(self, repo: str, version: str):
+        return os.path.join(self.charts_dir, self._key(repo, version))
+
+    @staticmethod
+    def _read_meta(entry_dir: str):
+        with open(os.path.join(entry_dir, ChartCache.META_NAME), 'r') as f:
+            return json.load(f)
+
+    def archive_path(self, entry_dir: str):
+        return os.path.join(entry_dir, self.ARCHIVE_NAME)
+
+    def values_path(self, entry_dir: str):
+        return os.path.join(entry_dir, self.VALUES_NAME)
+
+    def read_values(self, entry_dir: str):
+        """
+        Reads the cached values.yaml of an entry.
+
+        :param entry_dir: The entry directory returned by lookup.
+        :return: The content of values.yaml as bytes.
+        """
+        with open(self.values_path(entry_dir), 'rb') as f:
+            return f.read()
+
+    def entry_digest(self, entry_dir: str):
+        """
+        Reads the archive digest recorded in an entry.
+
+        :param entry_dir: The entry directory returned by lookup or store.
+        :return: The digest in the 'sha256:<hex>' form.
+        """
+        return self._read_meta(entry_dir).get('digest')
+
+    def lookup(self, repo: str, version: str):
+        """
+        Looks up a chart in the cache and verifies the archive against the stored digest.
+        Corrupted entries are removed.
+
+        :param repo: The chart repository without the version.
+        :param version: The chart version.
+        :return: The entry directory if the chart is cached, None otherwise.
+        """
+        entry_dir = self._entry_dir(repo, version)
+        if not os.path.isdir(entry_dir):
+            logging.debug(f"Chart cache miss for {repo}:{version}")
+            return None
+        try:
+            meta = self._read_meta(entry_dir)
+            if not os.path.isfile(self.values_path(entry_dir)) or file_digest(self.archive_path(entry_dir)) != meta.get('digest'):
+                raise ValueError("digest mismatch")
+            # The metadata file modification time is the LRU clock
+            os.utime(os.path.join(entry_dir, self.META_NAME))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Discarding invalid chart cache entry for {repo}:{version}: {e}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        logging.info(f"Chart cache hit for {repo}:{version}")
+        return entry_dir
+
+    def store(self, repo: str, version: str, archive: str, values: bytes):
+        """
+        Stores a pulled chart in the cache and evicts old entries if the cache grew over its limit.
+
+        :param repo: The chart repository without the version.
+        :param version: The chart version.
+        :param archive: The path of the pulled .tgz archive.
+        :param values: The content of the chart values.yaml.
+        :return: The entry directory.
+        """
+        os.makedirs(self.charts_dir, exist_ok=True)
+        entry_dir = self._entry_dir(repo, version)
+        # Build the entry aside and rename it so concurrent readers never see a partial entry
+        staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=self.charts_dir)
+        try:
+            shutil.copyfile(archive, self.archive_path(staging_dir))
+            with open(self.values_path(staging_dir), 'wb') as f:
+                f.write(values)
+            meta = {
+                'repo': repo,
+                'version': version,
+                'digest': file_digest(self.archive_path(staging_dir)),
+                'size': os.path.getsize(self.archive_path(staging_dir)) + os.path.getsize(self.values_path(staging_dir)),
+                'created': time.time(),
+            }
+            with open(os.path.join(staging_dir, self.META_NAME), 'w') as f:
+                json.dump(meta, f)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(staging_dir, entry_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        logging.debug(f"Stored chart {repo}:{version} in cache {entry_dir}")
+        self.evict()
+        return entry_dir
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        The most recently used entry is always kept.
+        """
+        entries = []
+        for name in os.listdir(self.charts_dir):
+            entry_dir = os.path.join(self.charts_dir, name)
+            try:
+                meta = self._read_meta(entry_dir)
+                last_used = os.path.getmtime(os.path.join(entry_dir, self.META_NAME))
+                entries.append((last_used, meta.get('size', 0), entry_dir))
+            except (OSError, ValueError):
+                continue
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            logging.debug(f"Evicted chart cache entry {entry_dir}")
+
+
+class ManifestCache:
+    SUFFIX = ".yaml"
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MANIFEST_MAX_BYTES):
+        """
+        Initializes a persistent cache of rendered manifests, one file per render. The key must cover
+        every input of the render, so an entry never needs to be invalidated, only evicted.
+
+        :param cache_dir: The root directory of the cache, shared with the chart cache.
+        :param max_bytes: The maximum size of the cache before the least recently used entries are evicted.
+        """
+        self.cache_dir = cache_dir
+        self.manifests_dir = os.path.join(cache_dir, "manifests")
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(*parts: str):
+        """
+        Builds the cache key of a render.
+
+        :param parts: The inputs of the render, e.g. chart digest, values hash, release name, namespace and helm version.
+        :return: A filesystem safe key.
+        """
+        return hashlib.sha256("\0".join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key: str):
+        return os.path.join(self.manifests_dir, key + self.SUFFIX)
+
+    def open(self, key: str):
+        """
+        Opens the manifests of a render, to stream them.
+
+        :param key: The key built by key().
+        :return: The manifests as a binary file object, None if they are not cached.
+        """
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            logging.debug(f"Manifest cache miss for {key}")
+            return None
+        try:
+            # The file modification time is the LRU clock
+            os.utime(path)
+        except OSError:
+            pass
+        logging.info(f"Manifest cache hit for {key}")
+        return f
+
+    @contextlib.contextmanager
+    def writer(self, key: str):
+        """
+        Streams the manifests of a render to the cache. The entry is stored when the block exits
+        without an error; a failed write, e.g. on a full disk, only drops the entry.
+
+        :param key: The key built by key().
+        :return: A callable writing bytes to the entry.
+        :raises OSError: If the entry cannot be created.
+        """
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        fd, staging_path = tempfile.mkstemp(prefix=".staging-", dir=self.manifests_dir)
+        f = os.fdopen(fd, 'wb')
+        failed = []
+
+        def write(data: bytes):
+            if failed:
+                return
+            try:
+                f.write(data)
+            except OSError as e:
+                failed.append(e)
+                logging.warning(f"Could not write manifests {key} to cache: {e}")
+
+        def discard():
+            f.close()
+            try:
+                os.remove(staging_path)
+            except OSError:
+                pass
+
+        try:
+            yield write
+        except BaseException:
+            discard()
+            raise
+        try:
+            f.close()
+        except OSError as e:
+            failed.append(e)
+        if failed:
+            discard()
+            return
+        try:
+            os.replace(staging_path, self._path(key))
+        except OSError:
+            discard()
+            raise
+        logging.debug(f"Stored manifests {key} in cache {self.manifests_dir}")
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        The most recently used entry is always kept.
+        """
+        entries = []
+        for name in os.listdir(self.manifests_dir):
+            if not name.endswith(self.SUFFIX) or name.startswith("."):
+                continue
+            path = os.path.join(self.manifests_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            logging.debug(f"Evicted manifest cache entry {path}")
@@ -0,0 +1,168 @@
+import os, json, time, shutil, hashlib, tempfile, threading, logging
+from src.chart_cache import file_digest
+
+logging = logging.getLogger('quix-manager')
+
+# Older checkpoints are not resumed, the release may have been changed by someone else meanwhile
+CHECKPOINT_TTL = 3600
+
+
+def prune_checkpoints(root: str, ttl: float = CHECKPOINT_TTL):
+    """
+    Removes the checkpoints older than their TTL. They are never resumed, and their blobs hold the
+    values of the release, secrets included, so they are not left on disk until the next attempt.
+
+    :param root: The directory holding one checkpoint directory per release.
+    :param ttl: The age in seconds after which a checkpoint is removed.
+    :return: The number of checkpoints removed.
+    """
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    now = time.time()
+    for name in names:
+        directory = os.path.join(root, name)
+        state_path = os.path.join(directory, Checkpoint.STATE_NAME)
+        try:
+            # The state is rewritten on every save, a checkpoint without one is an interrupted first save
+            updated = os.path.getmtime(state_path if os.path.exists(state_path) else directory)
+        except OSError:
+            continue
+        if now - updated > ttl:
+            shutil.rmtree(directory, ignore_errors=True)
+            removed += 1
+    if removed:
+        logging.debug(f"Removed {removed} expired checkpoints from {root}")
+    return removed
+
+
+class Checkpoint:
+    STATE_NAME = "state.json"
+
+    def __init__(self, directory: str, inputs: dict, ttl: float = CHECKPOINT_TTL):
+        """
+        Records the phases a run completed, with their results, so a retry of the same run resumes
+        after the last good phase. Every phase keeps small data in the state file and its results
+        in blobs; the digest of every blob is checked before it is trusted again.
+
+        :param directory: The directory of the checkpoint, kept across runs.
+        :param inputs: The inputs of the run, e.g. release, chart version and override digest. A
+            checkpoint written for other inputs is discarded.
+        :param ttl: The age in seconds after which a checkpoint is discarded.
+        """
+        self.directory = directory
+        self.inputs = inputs
+        self.ttl = ttl
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def path(self, name: str):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        """
+        Reads the checkpoint of a previous attempt.
+
+        :return: The names of the completed phases, empty if there is no usable checkpoint.
+        """
+        try:
+            with open(self.path(self.STATE_NAME)) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            logging.warning(f"Discarding unreadable checkpoint {self.directory}: {e}")
+            self.discard()
+            return []
+        if state.get('inputs') != self.inputs:
+            logging.debug(f"Discarding checkpoint {self.directory} written for other inputs")
+            self.discard()
+            return []
+        if time.time() - state.get('updated', 0) > self.ttl:
+            logging.debug(f"Discarding checkpoint {self.directory} older than {self.ttl}s")
+            self.discard()
+            return []
+        self.phases = state.get('phases', {})
+        return sorted(self.phases)
+
+    def get(self, phase: str):
+        """
+        Returns the data of a completed phase after checking its blobs.
+
+        :param phase: The name of the phase.
+        :return: The data of the phase, None if it is missing or its blobs are damaged.
+        """
+        data = self.phases.get(phase)
+        if data is None:
+            return None
+        for name, digest in data.get('blobs', {}).items():
+            try:
+                intact = file_digest(self.path(name)) == digest
+            except OSError:
+                intact = False
+            if not intact:
+                logging.warning(f"Checkpoint blob {name} of phase {phase} is damaged, running the phase again.")
+                return None
+        return data
+
+    def read(self, name: str):
+        """
+        :return: The content of a blob as bytes.
+        """
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def _replace(self, name: str, write):
+        """
+        Writes a file aside and renames it, so a crash never leaves a partial file.
+        """
+        fd, staging_path = tempfile.mkstemp(prefix=".staging-", dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(staging_path, self.path(name))
+        except BaseException:
+            try:
+                os.remove(staging_path)
+            except OSError:
+                pass
+            raise
+
+    def save(self, phase: str, data: dict = None, blobs: dict = None, files: dict = None):
+        """
+        Records a completed phase. The blobs are written first and the state last, so the state
+        never points to blobs that are not there.
+
+        :param phase: The name of the phase.
+        :param data: JSON serializable results of the phase.
+        :param blobs: Results stored as blobs, bytes keyed by blob name.
+        :param files: Results stored as blobs copied from files, paths keyed by blob name.
+        """
+        data = dict(data or {})
+        digests = {}
+        with self._lock:
+            # Only the user running the plugin may read the values kept here
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            for name, content in (blobs or {}).items():
+                self._replace(name, lambda f: f.write(content))
+                digests[name] = f"sha256:{hashlib.sha256(content).hexdigest()}"
+            for name, source in (files or {}).items():
+                def copy(f, source=source):
+                    with open(source, 'rb') as src:
+                        shutil.copyfileobj(src, f)
+                self._replace(name, copy)
+                digests[name] = file_digest(self.path(name))
+            data['blobs'] = digests
+            self.phases[phase] = data
+            state = {'inputs': self.inputs, 'updated': time.time(), 'phases': self.phases}
+            self._replace(self.STATE_NAME, lambda f: f.write(json.dumps(state).encode('utf-8')))
+        logging.debug(f"Checkpointed phase {phase} in {self.directory}")
+
+    def discard(self):
+        """
+        Removes the checkpoint, e.g. once the run succeeded.
+        """
+        self.phases = {}
+        shutil.rmtree(self.directory, ignore_errors=True)
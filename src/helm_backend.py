@@ -0,0 +1,310 @@
+import os, re, json, time, base64, hashlib, threading, logging
+from src.helm_runner import HelmRunner, HelmResult
+from src.retry import Deadline, RetryPolicy, is_retryable
+
+logging = logging.getLogger('quix-manager')
+
+
+class HelmBackend:
+    """
+    Runs the helm operations of a release. The typed operations build the helm arguments and go
+    through _call, so a backend only has to tell how an invocation is carried out.
+    """
+
+    def run(self, helm_args: list, **kwargs):
+        """
+        Runs helm with the provided arguments.
+
+        :param helm_args: List of arguments for the Helm command.
+        :param kwargs: Passed to HelmRunner.run, e.g. stdin.
+        :return: A HelmResult, whatever the exit code.
+        """
+        raise NotImplementedError
+
+    def _call(self, operation: str, helm_args: list, artifacts: list = None, **kwargs):
+        """
+        Carries out one operation.
+
+        :param operation: The name of the operation, e.g. 'upgrade'.
+        :param helm_args: List of arguments for the Helm command.
+        :param artifacts: The files the operation writes, e.g. the archive of a pull.
+        :param kwargs: Passed to run.
+        :return: A HelmResult.
+        """
+        return self.run(helm_args, **kwargs)
+
+    def version(self):
+        """
+        :return: The output of 'helm version --short', None if helm could not tell.
+        """
+        result = self._call('version', ['version', '--short'])
+        return result.stdout.decode('utf-8', errors='replace').strip() if result.ok else None
+
+    @staticmethod
+    def _namespaced(helm_args: list, namespace: str = None):
+        if namespace:
+            helm_args.extend(['--namespace', namespace])
+        return helm_args
+
+    def list(self, release_name: str = None, namespace: str = None, all_namespaces: bool = False):
+        """
+        Lists the releases in every status.
+
+        :param release_name: Only list the release of this name. Default lists every release.
+        :param namespace: The namespace of the releases.
+        :param all_namespaces: List the releases of every namespace, without paging.
+        """
+        if all_namespaces:
+            return self._call('list', ['list', '--all-namespaces', '--all', '--max', '0', '--output', 'json'])
+        helm_args = ['list', '--all']
+        if release_name:
+            helm_args.extend(['--filter', f"^{re.escape(release_name)}$"])
+        helm_args.extend(['--output', 'json'])
+        return self._call('list', self._namespaced(helm_args, namespace))
+
+    def status(self, release_name: str, namespace: str = None):
+        return self._call('status', self._namespaced(['status', release_name, '--output', 'json'], namespace))
+
+    def history(self, release_name: str, namespace: str = None):
+        return self._call('history', self._namespaced(['history', release_name, '--output', 'json'], namespace))
+
+    def get_values(self, release_name: str, namespace: str = None):
+        return self._call('get_values', self._namespaced(['get', 'values', release_name, '--output', 'json'], namespace))
+
+    def pull(self, repo: str, version: str, destination: str):
+        """
+        Pulls a chart from an OCI registry.
+
+        :param repo: The repository of the chart, without the oci:// scheme.
+        :param version: The version of the chart.
+        :param destination: The directory the archive is written to.
+        """
+        archive = os.path.join(destination, f"{repo.split('/')[-1]}-{version}.tgz")
+        return self._call('pull', ['pull', f"oci://{repo}", '--version', version, '--destination', destination], artifacts=[archive])
+
+    def upgrade(self, release_name: str, chart: list, values: bytes, namespace: str = None, timeout: str = None):
+        """
+        Upgrades or installs a release with values read from the standard input.
+
+        :param chart: The chart arguments, a local archive or an OCI reference and its version.
+        :param values: The values as YAML bytes.
+        """
+        helm_args = self._namespaced(['upgrade', '--install', release_name] + chart + ["--values", "-"], namespace)
+        if timeout:
+            helm_args.extend(["--timeout", timeout])
+        return self._call('upgrade', helm_args, stdin=values)
+
+    def template(self, release_name: str, chart: list, values: bytes, namespace: str = None, timeout: str = None, **kwargs):
+        """
+        Renders the manifests of a release with values read from the standard input.
+
+        :param chart: The chart arguments, a local archive or an OCI reference and its version.
+        :param values: The values as YAML bytes.
+        :param kwargs: Passed to HelmRunner.run, e.g. on_stdout_line to stream the manifests.
+        """
+        helm_args = self._namespaced(['template', release_name] + chart + ["--values", "-"], namespace)
+        if timeout:
+            helm_args.extend(["--timeout", timeout])
+        return self._call('template', helm_args, stdin=values, **kwargs)
+
+    def rollback(self, release_name: str, revision: str, namespace: str = None):
+        return self._call('rollback', self._namespaced(['rollback', release_name, revision], namespace))
+
+
+class SubprocessBackend(HelmBackend):
+    def __init__(self, runner: HelmRunner = None):
+        """
+        Runs the helm binary.
+
+        :param runner: The HelmRunner of the invocations. Default is a runner of its own.
+        """
+        self.runner = runner or HelmRunner()
+
+    def run(self, helm_args: list, **kwargs):
+        return self.runner.run_sync(helm_args, **kwargs)
+
+    def version(self):
+        # The runner queries helm once
+        return self.runner.version()
+
+
+class RetryingBackend(HelmBackend):
+    def __init__(self, backend: HelmBackend, policy: RetryPolicy = None, deadline: Deadline = None, sleep=time.sleep):
+        """
+        Retries the transient failures of another backend, within the deadline of the run when there
+        is one: every call gets the time left as its timeout, and no retry starts once the backoff
+        would run past the deadline. A call that already streamed output is never retried.
+
+        :param backend: The backend doing the actual calls.
+        :param policy: The retry policy. Default retries twice.
+        :param deadline: The deadline shared by every call, None for no deadline.
+        :param sleep: The function waiting between the attempts.
+        """
+        self.backend = backend
+        self.policy = policy or RetryPolicy()
+        self.deadline = deadline
+        self.sleep = sleep
+
+    def run(self, helm_args: list, **kwargs):
+        return self._call(helm_args[0] if helm_args else '', helm_args, **kwargs)
+
+    def version(self):
+        return self.backend.version()
+
+    def _call(self, operation: str, helm_args: list, artifacts: list = None, **kwargs):
+        streamed = [False]
+        on_stdout_line = kwargs.get('on_stdout_line')
+        if on_stdout_line:
+            def watch(line: bytes):
+                streamed[0] = True
+                on_stdout_line(line)
+            kwargs = dict(kwargs, on_stdout_line=watch)
+        retry = 0
+        while True:
+            if self.deadline:
+                self.deadline.check(operation)
+                kwargs['timeout'] = self.deadline.remaining()
+            result = self.backend._call(operation, helm_args, artifacts=artifacts, **kwargs)
+            if retry >= self.policy.retries or streamed[0] or not is_retryable(operation, result):
+                return result
+            delay = self.policy.delay(retry)
+            if self.deadline and delay >= self.deadline.remaining():
+                logging.warning(f"Not retrying helm {operation}, the deadline would pass first.")
+                return result
+            retry += 1
+            reason = "timed out" if result.timed_out else result.stderr.decode('utf-8', errors='replace').strip()
+            logging.warning(f"Helm {operation} failed ({reason}), retry {retry}/{self.policy.retries} in {delay:.1f}s.")
+            self.sleep(delay)
+
+
+def _digest(data: bytes):
+    return f"sha256:{hashlib.sha256(data).hexdigest()}" if data is not None else None
+
+
+def _encode(data: bytes):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _normalize_args(helm_args: list):
+    """
+    Removes from the arguments what changes from one run to the next: the workspace of the run
+    holding the pulled archive.
+
+    :return: The arguments as a tuple.
+    """
+    normalized = []
+    previous = None
+    for arg in helm_args:
+        if previous == '--destination':
+            arg = '<destination>'
+        elif arg.endswith('.tgz'):
+            arg = os.path.basename(arg)
+        normalized.append(arg)
+        previous = arg
+    return tuple(normalized)
+
+
+class RecordingBackend(HelmBackend):
+    def __init__(self, backend: HelmBackend, path: str):
+        """
+        Records the calls of another backend: arguments, a digest of the input, output, exit code
+        and latency. Every call is appended to a JSON lines file as soon as it returns, so the
+        recording of a failed run is kept too.
+
+        :param backend: The backend doing the actual calls.
+        :param path: The recording file, appended to if it exists.
+        """
+        self.backend = backend
+        self.path = path
+        self._lock = threading.Lock()
+
+    def run(self, helm_args: list, **kwargs):
+        return self._call(helm_args[0] if helm_args else '', helm_args, **kwargs)
+
+    def _call(self, operation: str, helm_args: list, artifacts: list = None, **kwargs):
+        streamed = None
+        if kwargs.get('on_stdout_line') and not kwargs.get('capture_stdout', True):
+            # The caller streams the output, keep a copy of it for the recording
+            streamed, on_stdout_line = [], kwargs['on_stdout_line']
+
+            def tee(line: bytes):
+                streamed.append(line)
+                on_stdout_line(line)
+            kwargs = dict(kwargs, on_stdout_line=tee)
+        result = self.backend._call(operation, helm_args, artifacts=artifacts, **kwargs)
+        record = {
+            'operation': operation,
+            'args': list(_normalize_args(helm_args)),
+            'stdin': _digest(kwargs.get('stdin')),
+            'returncode': result.returncode,
+            'timed_out': result.timed_out,
+            'duration': result.duration,
+            'stdout': _encode(b"".join(streamed) if streamed is not None else result.stdout),
+            'stderr': _encode(result.stderr),
+            'artifacts': {},
+        }
+        if result.ok:
+            for artifact in artifacts or []:
+                with open(artifact, 'rb') as f:
+                    record['artifacts'][os.path.basename(artifact)] = _encode(f.read())
+        line = json.dumps(record, separators=(',', ':')) + "\n"
+        with self._lock:
+            # Only readable by the user running the plugin, the output of get values holds the secrets of the release
+            with os.fdopen(os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), 'a') as f:
+                f.write(line)
+        return result
+
+
+class ReplayBackend(HelmBackend):
+    def __init__(self, path: str, latency_scale: float = 0.0):
+        """
+        Serves the calls of a recording. A call is matched on its arguments and the digest of its
+        input; the recorded responses of a call are served in order, the last one again once they
+        are used up. Calls missing from the recording fail like an unknown helm command.
+
+        :param path: The recording file written by RecordingBackend.
+        :param latency_scale: Factor applied to the recorded latencies, 0 to answer at once.
+        """
+        self.path = path
+        self.latency_scale = latency_scale
+        self._responses = {}
+        self._served = {}
+        self._lock = threading.Lock()
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self._responses.setdefault((tuple(record['args']), record['stdin']), []).append(record)
+
+    def run(self, helm_args: list, **kwargs):
+        return self._call(helm_args[0] if helm_args else '', helm_args, **kwargs)
+
+    def _next_record(self, key):
+        with self._lock:
+            records = self._responses.get(key)
+            if not records:
+                return None
+            index = self._served.get(key, 0)
+            self._served[key] = index + 1
+            return records[min(index, len(records) - 1)]
+
+    def _call(self, operation: str, helm_args: list, artifacts: list = None, **kwargs):
+        record = self._next_record((_normalize_args(helm_args), _digest(kwargs.get('stdin'))))
+        command = ['helm'] + list(helm_args)
+        if record is None:
+            logging.warning(f"No recorded response for helm {' '.join(helm_args)}")
+            return HelmResult(command, 1, stderr=f"Error: no recorded response for helm {' '.join(helm_args)}".encode('utf-8'))
+        if self.latency_scale:
+            time.sleep(record['duration'] * self.latency_scale)
+        for artifact in artifacts or []:
+            content = record['artifacts'].get(os.path.basename(artifact))
+            if content is not None:
+                with open(artifact, 'wb') as f:
+                    f.write(base64.b64decode(content))
+        stdout = base64.b64decode(record['stdout'])
+        on_stdout_line = kwargs.get('on_stdout_line')
+        if on_stdout_line:
+            for line in stdout.splitlines(keepends=True):
+                on_stdout_line(line)
+        return HelmResult(command, record['returncode'], stdout if kwargs.get('capture_stdout', True) else b"",
+                          base64.b64decode(record['stderr']), duration=record['duration'], timed_out=record['timed_out'])
@@ -1,18 +1,90 @@
-import os, sys, shutil, subprocess, yaml, tarfile,logging
+import os, re, sys, json, time, atexit, shutil, hashlib, tempfile, threading, contextlib,logging
 from argparse import Namespace
+from src.chart_cache import ChartCache, ManifestCache, DEFAULT_MAX_BYTES, file_digest
+from src.checkpoint import Checkpoint, prune_checkpoints
+from src.helm_backend import HelmBackend, RetryingBackend, SubprocessBackend
+from src.helm_runner import HelmRunner, HelmResult, HelmCommandError
+from src.manifests import ManifestSplitter
+from src.metrics import Metrics, record_bytes, record_helm_result
+from src.phases import PhaseGraph
+from src.retry import Deadline, DeadlineExceeded, RetryPolicy, parse_duration
+from src.release import ReleaseSnapshot, parse_release_list, parse_history, parse_values, last_deployed_revision
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks on this platform, runs on the same release are not serialized
+    fcntl = None
 
 logging = logging.getLogger('quix-manager')
 
+# Shared by every HelmManager, the runner holds no per-call state
+HELM_RUNNER = HelmRunner()
+# Backend of the HelmManagers created without one, replaced e.g. to record or replay the helm calls
+HELM_BACKEND = SubprocessBackend(HELM_RUNNER)
+
+
+def set_helm_backend(backend: HelmBackend):
+    """
+    Sets the backend of the HelmManagers created from now on without one.
+
+    :param backend: The HelmBackend, None to go back to running the helm binary.
+    """
+    global HELM_BACKEND
+    HELM_BACKEND = backend or SubprocessBackend(HELM_RUNNER)
+
+
+def retrying_backend(args: Namespace = None, deadline: Deadline = None, backend: HelmBackend = None):
+    """
+    Wraps a backend in the retries set by the '--retries' argument.
+
+    :param args: Parsed command-line arguments.
+    :param deadline: The deadline of the run, if any.
+    :param backend: The backend running the helm operations. Default is HELM_BACKEND.
+    :return: A RetryingBackend.
+    """
+    retries = getattr(args, 'retries', None)
+    return RetryingBackend(backend or HELM_BACKEND, RetryPolicy() if retries is None else RetryPolicy(retries=retries), deadline)
+
+
+def values_hash(values: dict):
+    """
+    Computes a canonical hash of a values document: the same values give the same hash whatever
+    the order of their keys or the format (YAML or JSON) they were read from.
+
+    :param values: The values as a dictionary.
+    :return: The hash in the 'sha256:<hex>' form.
+    """
+    canonical = json.dumps(values or {}, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return f"sha256:{hashlib.sha256(canonical.encode('utf-8')).hexdigest()}"
+
 class HelmManager:
-    def __init__(self, args: Namespace = None):
+    def __init__(self, args: Namespace = None, snapshot: ReleaseSnapshot = None, deployment: "DeploymentManager" = None, metrics: Metrics = None,
+                 backend: HelmBackend = None):
         """
         Initializes the HelmManager with provided arguments.
 
         :param args: Parsed command-line arguments for the Helm operation.
+        :param snapshot: The state of the release when it is already known, e.g. from a batch discovery.
+        :param deployment: The deployment manager of the working directory. Default is './tmp'.
+        :param metrics: The collector of the phase timings. Default is a collector of its own.
+        :param backend: The backend running the helm operations. Default is HELM_BACKEND.
         """
+        # Time budget of every helm call of the run, counted from now
+        deadline = getattr(args, 'deadline', None)
+        self.deadline = Deadline(parse_duration(deadline)) if deadline else None
+        self.backend = retrying_backend(args, self.deadline, backend)
+        if getattr(args, 'native_reads', False):
+            from src.release_storage import StorageBackend
+            # Outermost, so the queries it answers skip helm and the fallback is still retried
+            self.backend = StorageBackend(self.backend, deadline=self.deadline)
         self.release_name = args.release_name if args.release_name else "quixplatform-manager"
         self.namespace = args.namespace or os.environ.get('HELM_NAMESPACE')
         self.timeout = args.timeout or os.environ.get('HELM_TIMEOUT') or "6m"
+        # Timings of the phases of the run, also written to --metrics-file if given
+        self.metrics = metrics or Metrics()
+        self.metrics.labels.update(release=self.release_name, namespace=self.namespace or "", action=args.action)
+        self.metrics_file = getattr(args, 'metrics_file', None)
 
         # Validate override file
         if args.override:
@@ -26,39 +98,78 @@ class HelmManager:
             logging.debug("No override file provided.")
             self.override_path = None
 
+        # State of the release, read once and shared by every phase of the run
+        self.snapshot = snapshot
+        # An update reads the snapshot again if it had to wait for another run on the release
+        self.snapshot_stale = False
+        self.version_from_release = not args.repo
         if args.repo:
             self.repo, self.version = self._extract_version_and_format(args.repo)
         else:
-            self.version = self._get_remote_version(release_name=self.release_name) if self._check_if_exists(release_name=self.release_name) else None
+            # Resolved from the release by the check state, once the release is locked
+            self.version = None
             self.repo = "quixcontainerregistry.azurecr.io/helm/quixplatform-manager"
 
         self.action = args.action
+        # Keep the intermediate values files on disk for troubleshooting
+        self.keep_artifacts = getattr(args, 'keep_artifacts', False)
+        # Upgrade even if the release already runs the same chart version with the same values
+        self.force = getattr(args, 'force', False)
+        # Where to write the origin of every merged value: a file path, '-' for stderr, None to skip it
+        self.explain = getattr(args, 'explain', None)
+        # Where the template action writes one file per resource, None to stream the manifests to stdout
+        self.output_dir = getattr(args, 'output_dir', None)
+        # Resume the phases a failed update of the same release and inputs completed. Opt-in: the
+        # checkpoints keep the values of the release, secrets included, on disk until they expire
+        self.resume = getattr(args, 'resume', False)
+
+        # Persistent chart cache, disabled unless a directory is given
+        cache_dir = getattr(args, 'cache_dir', None) or os.environ.get('HELM_QUIX_CACHE_DIR')
+        cache_max_size = getattr(args, 'cache_max_size', None)
+        self.chart_cache = ChartCache(cache_dir, max_bytes=cache_max_size * 1024 * 1024 if cache_max_size else DEFAULT_MAX_BYTES) if cache_dir else None
+        # Rendered manifests of the template action, next to the charts they come from
+        self.manifest_cache = ManifestCache(cache_dir) if cache_dir else None
+
         # Initialize deployment manager
-        self.deployment = DeploymentManager()
+        self.deployment = deployment or DeploymentManager(tmpfs=getattr(args, 'tmpfs', False))
         self.deployment.setup()
 
         deployment_dir = self.deployment.get_dir()
         self.current_file_path = os.path.join(deployment_dir, f"{self.release_name}current.yaml")
         self.default_file_path = os.path.join(deployment_dir, f"{self.release_name}default.yaml")
         self.merged_file_path = os.path.join(deployment_dir, f"{self.release_name}merged.yaml")
+        # Intermediate results of the run phases
+        self.current_values = None
+        self.default_values = None
+        self.override_values = None
+        self.merged_values = None
+        self.merged_document = None
+        self.merged_hash = None
+        self.chart_from_cache = False
+        # The local chart archive deployed by the run and its digest when it was pulled
+        self.chart_archive = None
+        self.chart_digest = None
+        # The revision whose values the release holds, and the checkpoint of the run
+        self.values_revision = None
+        self.checkpoint = None
 
 
-    def _run_helm_with_args(self, helm_args: list):
+    @staticmethod
+    def _check_result(result: HelmResult, stdin: bytes = None):
         """
-        Runs a Helm command with the provided arguments.
+        Records the result of a helm operation in the current phase and checks it.
 
-        :param helm_args: List of arguments for the Helm command.
+        :param result: The HelmResult of the operation.
+        :param stdin: The input of the operation, if any.
+        :return: The HelmResult.
+        :raises HelmCommandError: If the command failed.
         """
-        command = ['helm'] + helm_args
-        logging.debug(f"Executing Helm command: {command}")
-
-        try:
-            result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            logging.info("Helm command executed successfully.")
-            return result
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Helm command failed {e.stderr.decode('utf-8')}")
-            sys.exit(1)
+        record_helm_result(result, stdin=stdin)
+        if not result.ok:
+            logging.error(f"Helm command failed {result.stderr.decode('utf-8', errors='replace')}")
+            raise HelmCommandError(result)
+        logging.info("Helm command executed successfully.")
+        return result
 
     def _extract_version_and_format(self, repo):
         """
@@ -76,105 +187,39 @@ class HelmManager:
 
     def _get_values(self, release_name: str):
         """
-        Retrieves the values of a Helm release.
+        Retrieves the user-supplied values of a Helm release.
 
         :param release_name: Name of the Helm release.
-        :return: YAML values of the release.
+        :return: A dictionary with the values of the release.
         """
-        list_args = ['get', 'values', release_name]
-        if self.namespace:
-            list_args.extend(['--namespace', self.namespace])
-        return self._run_helm_with_args(list_args).stdout.decode('utf-8')
-
-    def _extract_version_from_stdout(self, helm_output):
-        """
-        Extracts the chart version from the helm output.
-
-        :param helm_output: Helm output string without header.
-        :return: Extracted chart version.
-        """
-        try:
-            parts = helm_output.split()
-            if len(parts) < 9:
-                raise ValueError(f"Expected at least 9 fields, got {len(parts)}")
-            chart_field = parts[8]
-            version = chart_field.rsplit("-", 1)[-1]
-            logging.debug("Extracted version %s from chart field %s", version, chart_field)
-            return version
-        except Exception as e:
-            logging.error("Error extracting chart version: %s", e)
-
+        return parse_values(self._check_result(self.backend.get_values(release_name, self.namespace)).stdout)
 
     def _check_remote_chart(self, release_name):
         """
-        Checks the remote helm chart for the given release.
+        Lists the given release in every status.
 
         :param release_name: Name of the helm release.
-        :return: Helm output string without header.
+        :return: A list of ReleaseInfo matching the release name.
+        :raises HelmCommandError: If helm list fails.
         """
-        list_args = ['list', '--filter', release_name]
-        if self.namespace:
-            list_args.extend(["--namespace", self.namespace])
-        try:
-            result_obj = self._run_helm_with_args(list_args)
-            result = result_obj.stdout.decode('utf-8')
-        except Exception as e:
-            logging.error("Error running helm command for release %s: %s", release_name, e)
-            raise RuntimeError("Helm command execution failed") from e
-
+        result_obj = self._check_result(self.backend.list(release_name, self.namespace))
         try:
-            lines = result.splitlines()
-            if len(lines) > 1:
-                result_without_header = "\n".join(lines[1:])
-            else:
-                result_without_header = ""
-            logging.debug("Helm output without header: %s", result_without_header)
-            return result_without_header
+            return parse_release_list(result_obj.stdout)
         except Exception as e:
             logging.error("Error processing helm output for release %s: %s", release_name, e)
             raise
 
-    def _get_remote_version(self, release_name):
+    def _get_snapshot(self, refresh: bool = False):
         """
-        Gets the remote helm chart version for the specified release.
+        Returns the snapshot of the release, querying helm only the first time or when a refresh is requested.
 
-        :param release_name: Name of the helm release.
-        :return: Remote chart version.
+        :param refresh: Query helm again, e.g. after the release has been changed.
+        :return: The ReleaseSnapshot of the release.
         """
-        try:
-            helm_output = self._check_remote_chart(release_name)
-            version = self._extract_version_from_stdout(helm_output)
-            logging.info("Retrieved remote version %s for release %s", version, release_name)
-            return version
-        except Exception as e:
-            logging.error("Error retrieving remote version for release %s: %s", release_name, e)
-            raise
-
-    def _check_if_exists(self, release_name):
-        """
-        Checks if a Helm release exists.
-
-        :param release_name: Name of the Helm release.
-        :return: True if the release exists, False otherwise.
-        """ 
-        result = self._check_remote_chart(release_name)
-        return (release_name in result)
-    
-    
-    @staticmethod
-    def parse_output(output_str):
-        """ 
-        Parse the output of a Helm command into a dictionary.
-        """
-        result = {}
-        # Split the output into lines and extract key-value pairs
-        lines = output_str.strip().split('\n')
-        for line in lines:
-            if ':' in line:
-                key, value = line.split(':', 1)  
-                result[key.strip()] = value.strip()
-
-        return result
+        if self.snapshot is None or refresh:
+            with self.metrics.span("check"):
+                self.snapshot = ReleaseSnapshot.from_releases(self.release_name, self._check_remote_chart(self.release_name))
+        return self.snapshot
 
     def _rollback(self, revision: str):
         """
@@ -182,121 +227,559 @@ class HelmManager:
         :param revision: Revision number to rollback to.
 
         """
-        list_args = ['rollback', self.release_name, revision ]
-        if self.namespace:
-            list_args.extend(['--namespace', self.namespace])
-        self._run_helm_with_args(list_args)
+        with self.metrics.span("rollback"):
+            self._check_result(self.backend.rollback(self.release_name, revision, self.namespace))
 
         logging.info(f"Rolled back to revision {revision}.")
 
-    def _get_release_status(self):
+    def _get_history(self):
         """
-        Retrieves the current status of a Helm release.
+        Retrieves the revision history of the Helm release.
 
-        :param release_name: Name of the Helm release.
-        :return: Status of the release.
+        :return: A list of Revision, oldest first.
         """
-        list_args = ['status', self.release_name]
-        if self.namespace:
-            list_args.extend(['--namespace', self.namespace])
-        status_result = self._run_helm_with_args(list_args)
-        status_output = self.parse_output(status_result.stdout.decode('utf-8'))
-
-        logging.info(f"The status of the Helm chart {self.release_name} is: {status_output.get('STATUS')}")
-        return status_output
+        return parse_history(self._check_result(self.backend.history(self.release_name, self.namespace)).stdout)
     
     def _pull_repo(self):
         """
         Pulls the Helm chart from the specified repository.
         """
         try:
-            helm_args = ['pull', f"oci://{self.repo}", '--version', self.version, '--destination', self.deployment.get_dir()]
-            self._run_helm_with_args(helm_args)
-            logging.info(f"Chart {self.repo} pulled successfully.")
+            self._check_result(self.backend.pull(self.repo, self.version, self.deployment.get_dir()))
+            self.chart_archive = self._chart_archive_path()
+            self.chart_digest = file_digest(self.chart_archive)
+            # helm writes the chart to disk and only prints where it went
+            record_bytes(bytes_out=os.path.getsize(self.chart_archive))
+            logging.info(f"Chart {self.repo} pulled successfully ({self.chart_digest}).")
         except Exception as e:
             logging.error(f"Error pulling chart: {e}")
-            sys.exit(1)
+            raise
+
+    def _chart_archive_path(self):
+        """
+        Returns the path where helm pull leaves the chart archive.
+
+        :return: The path of the pulled .tgz archive.
+        """
+        chart_name = self.repo.split("/")[-1]
+        return os.path.join(self.deployment.get_dir(), f"{chart_name}-{self.version}.tgz")
 
     def _extract_chart(self):
         """
-        Extracts the pulled Helm chart from a .tgz file.
+        Reads the chart values.yaml from the pulled .tgz file without extracting the rest of the chart.
         """
         try:
             chart_name = self.repo.split("/")[-1]
-            chart_archive = os.path.join(self.deployment.get_dir(), f"{chart_name}-{self.version}.tgz")
-            values_path = os.path.join(self.deployment.get_dir(), chart_name, "values.yaml")
-            FileManager.extract_tgz(archive=chart_archive, path=self.deployment.get_dir())
-            FileManager.copy_and_rename(from_path=values_path, new_filename=self.default_file_path)
+            self.default_values = FileManager.read_from_tgz(archive=self._chart_archive_path(), member=f"{chart_name}/values.yaml")
+            record_bytes(bytes_out=len(self.default_values))
             logging.info(f"Chart {chart_name} extracted successfully.")
         except Exception as e:
             logging.error(f"Error extracting chart: {e}")
-            sys.exit(1)
+            raise
+
+    def _restore_chart_from_cache(self):
+        """
+        Restores the chart default values from the chart cache, skipping the pull.
+
+        :return: True if the chart was found in the cache, False otherwise.
+        """
+        if not self.chart_cache:
+            return False
+        entry = self.chart_cache.lookup(self.repo, self.version)
+        if not entry:
+            return False
+        try:
+            # Work on a copy, the cache entry may be evicted or replaced by another run meanwhile
+            archive = self._chart_archive_path()
+            shutil.copyfile(self.chart_cache.archive_path(entry), archive)
+            self.chart_digest = self.chart_cache.entry_digest(entry)
+            self.chart_archive = archive
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not restore chart {self.repo}:{self.version} from cache, pulling it: {e}")
+            return False
+        self.default_values = self.chart_cache.read_values(entry)
+        return True
+
+    def _store_chart_in_cache(self):
+        """
+        Stores the pulled chart and its default values in the chart cache.
+        A failure here is not fatal, the chart is simply pulled again on the next run.
+        """
+        if not self.chart_cache:
+            return
+        try:
+            self.chart_cache.store(self.repo, self.version, archive=self._chart_archive_path(), values=self.default_values)
+        except OSError as e:
+            logging.warning(f"Could not store chart {self.repo}:{self.version} in cache: {e}")
+
+    def _chart_reference(self):
+        """
+        Builds the chart arguments of upgrade and template. The archive pulled for the defaults is
+        deployed as is, after checking it is still the chart that was pulled, so helm does not fetch it again.
+
+        :return: The local archive, or the OCI reference and version when no archive was pulled.
+        """
+        if not self.chart_archive:
+            return [f"oci://{self.repo}", "--version", self.version]
+        digest = file_digest(self.chart_archive)
+        if digest != self.chart_digest:
+            raise RuntimeError(f"Chart archive {self.chart_archive} changed since it was pulled: expected {self.chart_digest}, found {digest}")
+        return [self.chart_archive]
+
+    def _get_merged_hash(self):
+        """
+        :return: The canonical hash of the merged values, computed once.
+        """
+        if self.merged_hash is None:
+            self.merged_hash = values_hash(self.merged_document)
+        return self.merged_hash
+
+    def _is_up_to_date(self):
+        """
+        Checks whether the release is deployed with the chart version and the values an upgrade would apply.
+
+        :return: True if the upgrade would not change anything.
+        """
+        snapshot = self._get_snapshot()
+        if snapshot.status != 'deployed' or snapshot.chart_version != self.version:
+            return False
+        return values_hash(self.current_values) == self._get_merged_hash()
 
     def _update_with_merged_values(self):
         """
-        Updates or installs the Helm release with the merged values.
+        Updates or installs the Helm release with the merged values, unless the release is already
+        deployed with the same chart version and values.
         """
+        if not self.force and self._is_up_to_date():
+            logging.info(f"Release {self.release_name} is already deployed with chart version {self.version} and the same values, skipping the upgrade. Use --force to upgrade anyway.")
+            return
         logging.info("Updating Helm release with merged values.")
-        list_args = ['upgrade', '--install', "quixplatform-manager", f"oci://{self.repo}", "--version", self.version, "--values", self.merged_file_path]
-        if self.namespace:
-            list_args.extend(["--namespace", self.namespace])
-        if self.timeout:    
-            list_args.extend(["--timeout", self.timeout])
-        self._run_helm_with_args(list_args)
+        result = self.backend.upgrade(self.release_name, self._chart_reference(), self.merged_values, self.namespace, self._helm_timeout())
+        self._check_result(result, stdin=self.merged_values)
+
+    def _helm_timeout(self):
+        """
+        Returns the --timeout of upgrade and template: the configured one, shortened to fit in the deadline.
+
+        :return: The timeout as a helm duration.
+        """
+        if not self.deadline:
+            return self.timeout
+        try:
+            configured = parse_duration(self.timeout)
+        except ValueError:
+            return self.timeout
+        # Leave helm a moment to report its own timeout before it is killed
+        budget = self.deadline.remaining() * 0.9
+        return f"{max(1, int(min(configured, budget)))}s"
+
+    def _manifest_cache_key(self):
+        """
+        Builds the manifest cache key of the render: chart digest, merged values, release, namespace and helm version.
 
-    def _template_with_merged_values(self):
+        :return: The key, None if the render cannot be cached.
         """
-        Templates the Helm release with the merged values.
+        if not self.manifest_cache or not self.chart_digest:
+            return None
+        helm_version = self.backend.version()
+        if not helm_version:
+            return None
+        return self.manifest_cache.key(self.chart_digest, self._get_merged_hash(), self.release_name, self.namespace or "", helm_version)
+
+    def _template_with_merged_values(self, on_line=None):
+        """
+        Templates the Helm release with the merged values. The manifests are streamed line by line
+        as helm prints them. Renders already done with the same inputs are served from the manifest
+        cache, new renders are written to it on the way.
+
+        :param on_line: Callable receiving every line of the manifests as bytes. Default keeps them in the stdout of the result.
+        :return: The HelmResult of the render.
         """
         logging.info("Templating Helm release with merged values.")
-        list_args = ['template', "quixplatform-manager", f"oci://{self.repo}", "--version", self.version, "--values", self.merged_file_path]
-        if self.namespace:
-            list_args.extend(["--namespace", self.namespace])
-        if self.timeout:    
-            list_args.extend(["--timeout", self.timeout])
-        return self._run_helm_with_args(list_args)
+        lines = None
+        if on_line is None:
+            lines = []
+            on_line = lines.append
+        chart = self._chart_reference()
+        cache_key = self._manifest_cache_key()
+        result = None
+        if cache_key:
+            cached = self.manifest_cache.open(cache_key)
+            if cached is not None:
+                with cached:
+                    for line in cached:
+                        on_line(line)
+                result = HelmResult(['template', self.release_name] + chart, 0)
+        if result is None:
+            with contextlib.ExitStack() as stack:
+                write = on_line
+                if cache_key:
+                    try:
+                        cache_write = stack.enter_context(self.manifest_cache.writer(cache_key))
+                    except OSError as e:
+                        logging.warning(f"Could not store the manifests of {self.release_name} in cache: {e}")
+                    else:
+                        def write_and_cache(line: bytes):
+                            on_line(line)
+                            cache_write(line)
+                        write = write_and_cache
+                result = self.backend.template(self.release_name, chart, self.merged_values, self.namespace, self._helm_timeout(),
+                                               capture_stdout=False, on_stdout_line=write)
+                # A failed render leaves the cache untouched
+                self._check_result(result, stdin=self.merged_values)
+        if lines is not None:
+            result.stdout = b"".join(lines)
+        return result
+
+    def _write_templates(self):
+        """
+        Streams the rendered manifests to stdout, or to one file per resource in the output directory.
+        """
+        size = 0
+
+        def counted(write):
+            def write_line(line: bytes):
+                nonlocal size
+                size += len(line)
+                write(line)
+            return write_line
+
+        if not self.output_dir:
+            stdout = sys.stdout.buffer
+            self._template_with_merged_values(on_line=counted(stdout.write))
+            stdout.flush()
+            record_bytes(bytes_out=size)
+            return
+        splitter = ManifestSplitter(self.output_dir)
+        try:
+            self._template_with_merged_values(on_line=counted(splitter.write_line))
+        except BaseException:
+            splitter.discard()
+            raise
+        splitter.close()
+        # The manifests are streamed, not captured in the result of helm
+        record_bytes(bytes_out=size)
+        logging.info(f"Wrote {len(splitter.paths)} manifests to {self.output_dir}.")
+
+    def _fetch_values(self):
+        """
+        Phase: retrieves the values of the deployed release.
+        """
+        if self._restore_values():
+            return
+        self.current_values = self._get_values(release_name=self.release_name)
+        self._save_checkpoint("values", data={'revision': self.values_revision},
+                              blobs={'values.json': json.dumps(self.current_values).encode('utf-8')})
+
+    def _fetch_chart(self):
+        """
+        Phase: gets the chart from the checkpoint or the cache, or pulls it from the registry.
+        """
+        # A chart restored from the checkpoint comes with its defaults, like a cached one
+        self.chart_from_cache = self._restore_chart_from_checkpoint() or self._restore_chart_from_cache()
+        if not self.chart_from_cache:
+            self._pull_repo()
+
+    def _read_chart_defaults(self):
+        """
+        Phase: reads the default values of a freshly pulled chart and caches the chart.
+        """
+        if not self.chart_from_cache:
+            self._extract_chart()
+            self._store_chart_in_cache()
+        if self.chart_archive and self.default_values is not None and not self._checkpointed("chart"):
+            self._save_checkpoint("chart", data={'digest': self.chart_digest},
+                                  blobs={'defaults.yaml': self.default_values}, files={'chart.tgz': self.chart_archive})
+
+    def _load_override(self):
+        """
+        Phase: loads the override file, if any.
+        """
+        if self.override_path:
+            with open(self.override_path, 'r') as f:
+                self.override_values = load_yaml(f) or {}
+
+    def _merge_values(self):
+        """
+        Phase: merges the release values, the chart defaults and the overrides in memory.
+        """
+        if self._restore_merged():
+            return
+        yaml_merger = YamlMerger(source_file=self.current_values, new_fields_file=self.default_values, override_file=self.override_values)
+        provenance = {} if self.explain else None
+        self.merged_document = yaml_merger.merged_values(provenance=provenance)
+        self.merged_hash = None
+        logging.info("Merged YAML values created.")
+        if provenance is not None:
+            self._write_explain(provenance)
+
+    def _serialize_values(self):
+        """
+        Phase: serializes the merged values. The document is piped to helm, files are only written with --keep-artifacts.
+        """
+        if self.merged_values is None:
+            self.merged_values = FileManager.dump_values(self.merged_document).encode('utf-8')
+            self._save_checkpoint("merged", data={'hash': self._get_merged_hash(), 'values_revision': self.values_revision,
+                                                  'chart_digest': self.chart_digest}, blobs={'merged.yaml': self.merged_values})
+        record_bytes(bytes_out=len(self.merged_values))
+        if self.keep_artifacts:
+            FileManager.write_values(file_path=self.current_file_path, values=self.current_values)
+            FileManager.write_values(file_path=self.default_file_path, values=self.default_values.decode('utf-8'))
+            FileManager.write_values(file_path=self.merged_file_path, values=self.merged_values.decode('utf-8'))
+            logging.info(f"Values files kept in {self.deployment.get_dir()}.")
+
+    def _write_explain(self, provenance: dict):
+        """
+        Writes the merge provenance report as JSON, to stderr or to the --explain file. Never to
+        stdout, which carries the manifests of the template action.
+
+        :param provenance: The origin of every merged value, keyed by dotted path.
+        """
+        origins = {}
+        for origin in provenance.values():
+            origins[origin] = origins.get(origin, 0) + 1
+        report = {
+            'release': self.release_name,
+            'namespace': self.namespace,
+            'chart_version': self.version,
+            'origins': origins,
+            'values': provenance,
+        }
+        if self.explain == '-':
+            sys.stderr.write(json.dumps(report, indent=2) + "\n")
+            sys.stderr.flush()
+        else:
+            with open(self.explain, 'w') as f:
+                json.dump(report, f, indent=2)
+            logging.info(f"Merge provenance written to {self.explain}.")
+
+    def _apply_action(self):
+        """
+        Phase: updates the release or generates its templates with the merged values.
+        """
+        if self.action == "update":
+            self._update_with_merged_values()
+            logging.debug(f"Action {self.action} completed successfully.")
+        elif self.action == "template":
+            self._write_templates()
+            logging.debug(f"Action {self.action} completed successfully.")
+        else:
+            #If you use this Class from command line, will not reach cause there is a restriction of choices at the top level
+            logging.error(f"Action {self.action} cannot be used")
+
+    def _open_checkpoint(self):
+        """
+        Opens the checkpoint of the update and loads the phases a previous attempt completed.
+        Only updates are checkpointed, they are serialized by the release lock.
+        """
+        if not self.resume or self.action != "update":
+            return
+        inputs = {
+            'release': self.release_name,
+            'namespace': self.namespace or "",
+            'repo': self.repo,
+            'version': self.version,
+            'override': file_digest(self.override_path) if self.override_path else None,
+        }
+        self.checkpoint = Checkpoint(self.deployment.checkpoint_dir(f"{self.namespace or 'default'}-{self.release_name}"), inputs)
+        completed = self.checkpoint.load()
+        if completed:
+            logging.info(f"Resuming {self.release_name} from a previous attempt, completed phases: {', '.join(completed)}.")
+
+    def _checkpointed(self, phase: str):
+        """
+        :return: The data of a phase completed by a previous attempt, None if it must run.
+        """
+        return self.checkpoint.get(phase) if self.checkpoint else None
+
+    def _save_checkpoint(self, phase: str, **kwargs):
+        """
+        Records a completed phase. A failure here is not fatal, the phase simply runs again on a retry.
+        """
+        if not self.checkpoint:
+            return
+        try:
+            self.checkpoint.save(phase, **kwargs)
+        except OSError as e:
+            logging.warning(f"Could not checkpoint phase {phase} of {self.release_name}: {e}")
+
+    def _restore_values(self):
+        """
+        Restores the values of the release fetched by a previous attempt, if the release still holds them.
+
+        :return: True if the values were restored.
+        """
+        data = self._checkpointed("values")
+        if not data or data.get('revision') != self.values_revision:
+            return False
+        self.current_values = json.loads(self.checkpoint.read('values.json'))
+        logging.info(f"Values of revision {self.values_revision} restored from checkpoint.")
+        return True
+
+    def _restore_chart_from_checkpoint(self):
+        """
+        Restores the chart and its default values pulled by a previous attempt.
+
+        :return: True if the chart was restored.
+        """
+        data = self._checkpointed("chart")
+        if not data:
+            return False
+        archive = self._chart_archive_path()
+        try:
+            shutil.copyfile(self.checkpoint.path('chart.tgz'), archive)
+            self.default_values = self.checkpoint.read('defaults.yaml')
+        except OSError as e:
+            logging.warning(f"Could not restore chart {self.repo}:{self.version} from checkpoint, pulling it: {e}")
+            return False
+        self.chart_archive, self.chart_digest = archive, data['digest']
+        logging.info(f"Chart {self.repo}:{self.version} restored from checkpoint.")
+        return True
+
+    def _restore_merged(self):
+        """
+        Restores the merged values of a previous attempt, if it merged the same values and chart.
+        The merge runs again when its provenance is asked for.
+
+        :return: True if the merged values were restored.
+        """
+        data = self._checkpointed("merged")
+        if self.explain or not data or data.get('values_revision') != self.values_revision or data.get('chart_digest') != self.chart_digest:
+            return False
+        self.merged_values = self.checkpoint.read('merged.yaml')
+        self.merged_hash = data['hash']
+        logging.info("Merged values restored from checkpoint.")
+        return True
+
+    def _build_phases(self):
+        """
+        Builds the dependency graph of a run. The cluster query, the registry pull and the override
+        load do not depend on each other and run concurrently:
+
+            get values ----------------------------\
+            pull -> extract ------------------------> merge -> serialize -> update/template
+            load override -------------------------/
+
+        Every phase is measured as a span of the run metrics.
+
+        :return: A PhaseGraph.
+        """
+        timed = self.metrics.timed
+        graph = PhaseGraph()
+        graph.add("get_values", timed("get_values", self._fetch_values))
+        graph.add("pull", timed("pull", self._fetch_chart))
+        graph.add("extract", timed("extract", self._read_chart_defaults), requires=("pull",))
+        graph.add("load_override", timed("load_override", self._load_override))
+        graph.add("merge", timed("merge", self._merge_values), requires=("get_values", "extract", "load_override"))
+        graph.add("serialize", timed("serialize", self._serialize_values), requires=("merge",))
+        graph.add(self.action, timed(self.action, self._apply_action), requires=("serialize",))
+        return graph
 
     def run(self):
         """
         Executes the main logic: checks if the release exists, retrieves values, merges YAML files, 
         and either updates the release or generates a template.
+        The workspace is removed whatever the outcome, unless the artifacts are kept.
+        """
+        succeeded = False
+        try:
+            # Only runs changing the same release wait on each other, templates never do
+            lock_name = f"{self.namespace or 'default'}-{self.release_name}"
+            with self.deployment.lock(lock_name, self.deadline) if self.action == "update" else contextlib.nullcontext(False) as waited:
+                # The snapshot given by a batch discovery predates the run that held the lock
+                self.snapshot_stale = waited
+                self._run()
+            succeeded = True
+        finally:
+            self._report_metrics(succeeded)
+            if self.keep_artifacts:
+                self.deployment.keep()
+            else:
+                self.deployment.cleanup()
+
+    def _report_metrics(self, succeeded: bool):
         """
-        exist_release = self._check_if_exists(release_name=self.release_name)
-        if exist_release:
+        Logs the phase timings and writes them to the metrics file, if any.
+        A failure to write the metrics never fails the run.
+
+        :param succeeded: True if the run succeeded.
+        """
+        self.metrics.finish(succeeded)
+        logging.info(self.metrics.summary())
+        if self.metrics_file:
             try:
-                values = self._get_values(release_name=self.release_name)
-                self._pull_repo()
-                self._extract_chart()
-                FileManager.write_values(file_path=self.current_file_path, values=values)
-                yaml_merger = YamlMerger(source_file=self.current_file_path, new_fields_file=self.default_file_path, override_file=self.override_path)
-                yaml_merger.save_merged_yaml(file_path=self.merged_file_path)
-                logging.info("Merged YAML file created.")
-                if self.action == "update":
-                    self._update_with_merged_values()
-                    logging.debug(f"Action {self.action} completed successfully.")
-                elif self.action == "template":
-                    templates = self._template_with_merged_values()
-                    logging.info(f"{templates.stdout.decode('utf-8')}")
-                    logging.debug(f"Action {self.action} completed successfully.")
-                else:
-                    #If you use this Class from command line, will not reach cause there is a restriction of choices at the top level
-                    logging.error(f"Action {self.action} cannot be used")
-                FileManager.delete_folder(self.deployment.get_dir())
-                logging.info(f"{self.action} has been completed successfully.")
-            except Exception as e:
-                logging.error(f"Error during execution: {e}")
-                sys.exit(1)
-        else:
-            status = self._get_release_status()
-            if status.get('STATUS') == 'pending-upgrade':
-                logging.debug(f"Release {self.release_name} is in pending-upgrade status.")
-                revision = str(int(status.get('REVISION'))-1)
-                self._rollback(revision)
-                logging.debug(f"Release {self.release_name} has been rolled back and running the upgrade.")
-                self.run()
-            else:    
-                logging.error(f"Release {self.release_name} does not exist. You need to install it first.")
-                sys.exit(1)
+                self.metrics.write_openmetrics(self.metrics_file)
+            except OSError as e:
+                logging.warning(f"Could not write the metrics file {self.metrics_file}: {e}")
+
+    def _run(self):
+        """
+        Runs the states of the run until it is done:
+
+            check --> recover --> phases
+              |                    ^
+              +--------------------+
+
+        check reads the release, recover rolls an interrupted upgrade back to the last deployed
+        revision, phases runs the pipeline, resuming after the phases a failed attempt completed.
+        Every state runs at most once.
+        """
+        state = self._check_release
+        while state is not None:
+            state = state()
+
+    def _check_release(self):
+        """
+        State: reads the release and decides whether it must be recovered first. An update reads
+        it under the release lock, and reads a snapshot given by a batch discovery again only
+        when it waited for another run.
+        """
+        snapshot = self._get_snapshot(refresh=self.snapshot_stale)
+        if self.version_from_release:
+            self.version = snapshot.chart_version if snapshot.exists else None
+        if snapshot.status == 'pending-upgrade':
+            logging.debug(f"Release {self.release_name} is in pending-upgrade status.")
+            return self._recover_release
+        if not snapshot.exists:
+            logging.error(f"Release {self.release_name} does not exist. You need to install it first.")
+            sys.exit(1)
+        self.values_revision = snapshot.revision
+        return self._run_phases
+
+    def _recover_release(self):
+        """
+        State: rolls an interrupted upgrade back to the last deployed revision of the release.
+        """
+        target = last_deployed_revision(self._get_history())
+        if target is None:
+            logging.error(f"Release {self.release_name} is in pending-upgrade status and has no deployed revision to roll back to.")
+            sys.exit(1)
+        self._rollback(str(target.revision))
+        snapshot = self._get_snapshot(refresh=True)
+        if not snapshot.exists:
+            logging.error(f"Release {self.release_name} is in {snapshot.status} status after the rollback to revision {target.revision}.")
+            sys.exit(1)
+        if self.version_from_release:
+            self.version = snapshot.chart_version
+        # The rollback restored the values of the target revision
+        self.values_revision = target.revision
+        logging.debug(f"Release {self.release_name} has been rolled back to revision {target.revision}, running the upgrade.")
+        return self._run_phases
+
+    def _run_phases(self):
+        """
+        State: runs the phases of the action, the ones checkpointed by a failed attempt are restored.
+        """
+        try:
+            self._open_checkpoint()
+            self._build_phases().run()
+        except Exception as e:
+            logging.error(f"Error during execution: {e}")
+            sys.exit(1)
+        if self.checkpoint:
+            self.checkpoint.discard()
+        logging.info(f"{self.action} has been completed successfully.")
+        return None
 
 
 
@@ -319,18 +802,47 @@ class FileManager:
     def extract_tgz(archive: str, path: str):
         """
         Extracts a .tgz archive to the specified directory.
+        Members escaping the destination directory are rejected when the interpreter supports extraction filters.
 
         :param archive: The path to the .tgz archive.
         :param path: The path where the archive should be extracted.
         """
+        # Only the runs extracting a chart need it
+        import tarfile
         try:
             with tarfile.open(archive, "r:gz") as tar:
-                tar.extractall(path, filter=lambda tarinfo, dest: tarinfo)
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extractall(path, filter='data')
+                else:
+                    tar.extractall(path)
             logging.debug(f"Extracted archive {archive} to {path}")
         except Exception as e:
             logging.error(f"Error extracting the file {archive}: {e}")
             raise
 
+    @staticmethod
+    def read_from_tgz(archive: str, member: str):
+        """
+        Reads a single file from a .tgz archive in one streaming pass, without writing anything to disk.
+
+        :param archive: The path to the .tgz archive.
+        :param member: The path of the file inside the archive (e.g. 'chart/values.yaml').
+        :return: The content of the file as bytes.
+        """
+        import tarfile
+        try:
+            with tarfile.open(archive, "r|gz") as tar:
+                for tarinfo in tar:
+                    if tarinfo.isfile() and os.path.normpath(tarinfo.name) == member:
+                        content = tar.extractfile(tarinfo).read()
+                        logging.debug(f"Read {member} ({len(content)} bytes) from archive {archive}")
+                        return content
+        except Exception as e:
+            logging.error(f"Error reading {member} from the file {archive}: {e}")
+            raise
+        logging.error(f"File {member} not found in archive {archive}")
+        raise FileNotFoundError(f"{member} not found in {archive}")
+
     @staticmethod
     def create_folder(directory: str):
         """
@@ -363,6 +875,16 @@ class FileManager:
         else:
             logging.error(f"File not found: {from_path}")
 
+    @staticmethod
+    def dump_values(values: dict):
+        """
+        Serializes values to YAML, keeping the key order and writing multi-line strings as block literals.
+
+        :param values: The values to serialize.
+        :return: The YAML document as a string.
+        """
+        return yaml_module().dump(values, Dumper=yaml_dumper(), default_flow_style=False, sort_keys=False)
+
     @staticmethod
     def write_values(file_path: str, values: str):
         """
@@ -374,7 +896,7 @@ class FileManager:
         try:
             with open(file_path, "w") as f:
                 if isinstance(values, dict):
-                    yaml.dump(values, f, default_flow_style=False, sort_keys=False)
+                    f.write(FileManager.dump_values(values))
                 else:
                     f.write(str(values))
             logging.debug(f"Wrote values to {file_path}")
@@ -384,45 +906,157 @@ class FileManager:
 
 
 
+# Shared memory filesystem used for the workspaces with tmpfs=True, when available
+TMPFS_DIR = "/dev/shm"
+
+# Seconds between two attempts to take a lock held by another run, when the run has a deadline
+LOCK_POLL_INTERVAL = 0.2
+
+# Workspaces not cleaned up yet, removed at interpreter exit whatever the exit path
+_ACTIVE_WORKSPACES = set()
+_ACTIVE_WORKSPACES_LOCK = threading.Lock()
+
+
+@atexit.register
+def _remove_active_workspaces():
+    with _ACTIVE_WORKSPACES_LOCK:
+        workspaces = list(_ACTIVE_WORKSPACES)
+        _ACTIVE_WORKSPACES.clear()
+    for workspace in workspaces:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
 class DeploymentManager:
-    def __init__(self, tempdir="./tmp"):
+    LOCKS_DIR = ".locks"
+    CHECKPOINTS_DIR = ".checkpoints"
+    DEFAULT_TEMPDIR = "./tmp"
+
+    def __init__(self, tempdir=None, tmpfs: bool = False):
         """
-        Initializes the DeploymentManager with a temporary directory.
+        Initializes the DeploymentManager with a temporary directory. Every run gets its own workspace
+        inside it, so concurrent runs from the same directory never share files.
 
-        :param tempdir: The path to the temporary directory to be used. Default is './tmp'.
+        :param tempdir: The path to the temporary directory to be used. Default is DEFAULT_TEMPDIR, './tmp'.
+        :param tmpfs: Create the workspace on tmpfs (/dev/shm) instead, when it is available.
         """
+        tempdir = tempdir or self.DEFAULT_TEMPDIR
+        if tmpfs:
+            if os.path.isdir(TMPFS_DIR) and os.access(TMPFS_DIR, os.W_OK):
+                tempdir = os.path.join(TMPFS_DIR, "quix-manager")
+            else:
+                logging.debug(f"{TMPFS_DIR} is not available, using {tempdir} for the workspace.")
         self.tempdir = tempdir
+        self.workspace = None
         self.file_manager = FileManager()
         
     def get_dir(self):
         """
-        Returns the path to the temporary directory.
+        Returns the path to the workspace of the run, or to the temporary directory before setup.
 
-        :return: The path of the temporary directory.
+        :return: The path of the workspace.
         """
-        return self.tempdir
+        return self.workspace or self.tempdir
 
     def setup(self):
         """
-        Creates the temporary directory using FileManager and logs the action.
+        Creates the temporary directory using FileManager and a unique workspace for the run inside it,
+        and removes the expired checkpoints of earlier runs.
 
         :return: True if the directory is successfully set up.
         """
         self.file_manager.create_folder(self.tempdir)
+        prune_checkpoints(os.path.join(self.tempdir, self.CHECKPOINTS_DIR))
+        if self.workspace is None:
+            self.workspace = tempfile.mkdtemp(prefix="run-", dir=self.tempdir)
+            with _ACTIVE_WORKSPACES_LOCK:
+                _ACTIVE_WORKSPACES.add(self.workspace)
+            logging.debug(f"Created workspace {self.workspace}")
         return True
 
+    def cleanup(self):
+        """
+        Deletes the workspace of the run. Safe to call more than once.
+        """
+        if self.workspace is None:
+            return
+        with _ACTIVE_WORKSPACES_LOCK:
+            _ACTIVE_WORKSPACES.discard(self.workspace)
+        self.file_manager.delete_folder(self.workspace)
+
+    def keep(self):
+        """
+        Keeps the workspace of the run on disk after the process exits.
+        """
+        with _ACTIVE_WORKSPACES_LOCK:
+            _ACTIVE_WORKSPACES.discard(self.workspace)
+
+    @staticmethod
+    def _safe_name(name: str):
+        return re.sub(r'[^A-Za-z0-9_.-]', '_', name)
 
+    def checkpoint_dir(self, name: str):
+        """
+        Returns the checkpoint directory of a run, e.g. one per release. Unlike the workspace it is
+        kept after a failed run, so a retry finds it, until it expires: every setup removes the
+        expired checkpoints. It lives in the temporary directory, on tmpfs with tmpfs=True.
 
-class LiteralDumper(yaml.Dumper):
-    def increase_indent(self, flow=False, indentless=False):
+        :param name: The name of the checkpoint.
+        :return: The path of the directory, not created.
         """
-        Increases indentation when dumping YAML content.
-        
-        :param flow: Determines if the flow style is used (default is False).
-        :param indentless: If True, omits indentation (default is False).
-        :return: Calls the parent class method to handle indentation.
+        return os.path.join(self.tempdir, self.CHECKPOINTS_DIR, self._safe_name(name))
+
+    @staticmethod
+    def _wait_for_lock(lock_file, name: str, deadline: Deadline):
+        """
+        Polls the lock until it is free, within the deadline.
+        """
+        while True:
+            remaining = deadline.remaining()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"Deadline of {deadline.seconds:g}s exceeded waiting for another run on {name}")
+            time.sleep(min(LOCK_POLL_INTERVAL, remaining))
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                pass
+
+    @contextlib.contextmanager
+    def lock(self, name: str, deadline: Deadline = None):
         """
-        return super(LiteralDumper, self).increase_indent(flow, indentless)
+        Holds an advisory lock shared by every run using the same temporary directory, e.g. one per release.
+        Runs on other names are not blocked.
+
+        :param name: The name of the lock.
+        :param deadline: The time budget of the run. Default waits for the lock as long as it takes.
+        :return: True if the lock was held by another run and had to be waited for.
+        :raises DeadlineExceeded: If the lock is still held by another run when the deadline passes.
+        """
+        if fcntl is None:
+            yield False
+            return
+        locks_dir = os.path.join(self.tempdir, self.LOCKS_DIR)
+        os.makedirs(locks_dir, exist_ok=True)
+        lock_path = os.path.join(locks_dir, self._safe_name(name) + ".lock")
+        with open(lock_path, 'a') as lock_file:
+            waited = False
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                waited = True
+                logging.info(f"Waiting for another run on {name} to finish.")
+                start = time.monotonic()
+                if deadline is None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                else:
+                    self._wait_for_lock(lock_file, name, deadline)
+                logging.debug(f"Lock {name} acquired after {time.monotonic() - start:.1f}s")
+            try:
+                yield waited
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
 
 def str_presenter(dumper, data):
     """
@@ -439,19 +1073,206 @@ def str_presenter(dumper, data):
         return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
     return dumper.represent_scalar('tag:yaml.org,2002:str', data)
 
-# Add the custom string presenter to handle multi-line strings in YAML
-yaml.add_representer(str, str_presenter)
+_YAML = None
+
+
+def yaml_module():
+    """
+    Imports PyYAML on first use and adds the custom string presenter to its dumpers, so the runs
+    that never read or write YAML (e.g. --help) do not pay for the import.
+
+    :return: The yaml module.
+    """
+    global _YAML
+    if _YAML is None:
+        import yaml
+        yaml.add_representer(str, str_presenter)
+        dumper = getattr(yaml, 'CDumper', yaml.Dumper)
+        if dumper is not yaml.Dumper:
+            yaml.add_representer(str, str_presenter, Dumper=dumper)
+        _YAML = yaml
+    return _YAML
+
+
+# libyaml bindings are optional. The C loader and dumper are several times faster on large values
+# files and emit the same documents as the pure Python ones.
+def yaml_loader():
+    yaml = yaml_module()
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def yaml_dumper():
+    yaml = yaml_module()
+    return getattr(yaml, 'CDumper', yaml.Dumper)
+
+
+def __getattr__(name):
+    # YamlLoader and YamlDumper are resolved on first access, see yaml_module
+    if name == 'YamlLoader':
+        return yaml_loader()
+    if name == 'YamlDumper':
+        return yaml_dumper()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def load_yaml(stream):
+    """
+    Safely loads a YAML document with the fastest available loader.
+
+    :param stream: The YAML document as str, bytes or a readable stream.
+    :return: The loaded document.
+    """
+    return yaml_module().load(stream, Loader=yaml_loader())
+
+
+# Merge modes of a layer: FILL only adds missing keys, OVERRIDE replaces existing values
+FILL = 'fill'
+OVERRIDE = 'override'
+_MISSING = object()
+
+# Origins reported by the merge provenance of YamlMerger
+ORIGIN_RELEASE = 'release'
+ORIGIN_DEFAULTS = 'defaults'
+ORIGIN_OVERRIDE = 'override'
+ORIGIN_SPECIAL = 'special'
+
+
+def child_path(path: str, key):
+    """
+    Builds the dotted path of a key. Keys that are not plain names (e.g. annotations with dots) are quoted.
+
+    :param path: The path of the parent, None for the root.
+    :param key: The key of the child.
+    :return: The interned path of the child.
+    """
+    if isinstance(key, str) and key and '.' not in key and '"' not in key:
+        name = key
+    else:
+        name = json.dumps(key if isinstance(key, str) else str(key))
+    return sys.intern(name if path is None else f"{path}.{name}")
+
+
+class _MergeFrame:
+    __slots__ = ('base', 'origin', 'layers', 'keys', 'index', 'out', 'parent_key', 'path')
+
+    def __init__(self, base: dict, origin: int, layers: list, parent_key, path: str):
+        """
+        A dictionary being merged by merge_values, kept on an explicit stack instead of a call frame.
+
+        :param base: The dictionary the layers are merged into.
+        :param origin: The index of the input the base dictionary comes from.
+        :param layers: The (dictionary, mode, origin) layers applying to this level, in order.
+        :param parent_key: The key of this dictionary in its parent.
+        :param path: The dotted path of this dictionary, only tracked for the provenance.
+        """
+        self.base = base
+        self.origin = origin
+        self.layers = layers
+        self.index = 0
+        self.out = None
+        self.parent_key = parent_key
+        self.path = path
+        # Keys of the base first, then new keys in the order the layers bring them
+        self.keys = list(base)
+        seen = None
+        for layer, _, _ in layers:
+            for key in layer:
+                if key not in base:
+                    if seen is None:
+                        seen = set()
+                    if key not in seen:
+                        seen.add(key)
+                        self.keys.append(key)
+
+    def set(self, key, value):
+        """
+        Sets a merged value, copying the base dictionary the first time it changes.
+        """
+        if self.out is None:
+            if self.base.get(key, _MISSING) is value:
+                return
+            self.out = dict(self.base)
+        self.out[key] = value
+
+    def result(self):
+        return self.base if self.out is None else self.out
+
+
+def _resolve_key(base: dict, origin: int, layers: list, key):
+    """
+    Resolves a key across the layers.
+
+    :return: Tuple of the value the key takes, the index of the input it comes from and the layers
+             still to merge into it when it is a dictionary.
+    """
+    current = base.get(key, _MISSING)
+    child_layers = []
+    for layer, mode, layer_origin in layers:
+        value = layer.get(key, _MISSING)
+        if value is _MISSING:
+            continue
+        if current is _MISSING:
+            current, origin = value, layer_origin
+            child_layers = []
+        elif isinstance(value, dict) and isinstance(current, dict):
+            child_layers.append((value, mode, layer_origin))
+        elif mode == OVERRIDE:
+            current, origin = value, layer_origin
+            child_layers = []
+    return current, origin, child_layers
+
+
+def merge_values(base: dict, layers: list, provenance: dict = None, origins: tuple = None):
+    """
+    Merges layers of values into a base document, walking the documents with an explicit stack.
+    Inputs are never mutated: dictionaries are copied only where a layer changes them, and unchanged
+    subtrees of every input are shared with the result.
+
+    :param base: The base document.
+    :param layers: A list of (dictionary, mode) tuples applied in order, mode being FILL or OVERRIDE.
+    :param provenance: Dictionary filled, during the same walk, with the dotted path of every leaf value
+                       and the name of the input it comes from. None to skip the bookkeeping.
+    :param origins: The names of the inputs for the provenance, the base first and then one per layer.
+    :return: The merged document.
+    """
+    if not isinstance(base, dict):
+        base = {}
+    if provenance is not None and origins is None:
+        origins = ('base',) + tuple(f"layer{index}" for index in range(len(layers)))
+    layers = [(layer, mode, index) for index, (layer, mode) in enumerate(layers, start=1) if isinstance(layer, dict) and layer]
+    if not layers and provenance is None:
+        return base
+    stack = [_MergeFrame(base, 0, layers, None, None)]
+    while True:
+        frame = stack[-1]
+        while frame.index < len(frame.keys):
+            key = frame.keys[frame.index]
+            frame.index += 1
+            value, origin, child_layers = _resolve_key(frame.base, frame.origin, frame.layers, key)
+            if child_layers or (provenance is not None and isinstance(value, dict) and value):
+                # Without layers the subtree is only walked for the provenance and stays shared
+                path = child_path(frame.path, key) if provenance is not None else None
+                stack.append(_MergeFrame(value, origin, child_layers, key, path))
+                break
+            if provenance is not None:
+                provenance[child_path(frame.path, key)] = origins[origin]
+            frame.set(key, value)
+        else:
+            stack.pop()
+            if not stack:
+                return frame.result()
+            stack[-1].set(frame.parent_key, frame.result())
 
 
 class YamlMerger:
-    def __init__(self, source_file: str, new_fields_file: str, override_file: str = None):
+    def __init__(self, source_file, new_fields_file, override_file=None):
         """
-        Initializes the class with file paths for the source of truth YAML, the new fields YAML, 
-        and an optional override YAML.
+        Initializes the class with the source of truth YAML, the new fields YAML, and an optional override YAML.
+        Each of them can be a file path, the YAML content as bytes, a readable stream or an already loaded dictionary.
         
-        :param source_file: The YAML file representing the source of truth.
-        :param new_fields_file: The YAML file with potential new fields.
-        :param override_file: The YAML file with override fields (optional).
+        :param source_file: The YAML representing the source of truth.
+        :param new_fields_file: The YAML with potential new fields.
+        :param override_file: The YAML with override fields (optional).
         """
         self.source_file = source_file
         self.new_fields_file = new_fields_file
@@ -462,66 +1283,86 @@ class YamlMerger:
         self.new_fields_data = self._load_yaml(self.new_fields_file)
         self.override_data = self._load_yaml(self.override_file) if self.override_file else {}
 
-    def _load_yaml(self, file_path: str):
+    def _load_yaml(self, file_path):
         """
-        Loads a YAML file and returns its content as a dictionary.
+        Loads a YAML document and returns its content as a dictionary.
 
-        :param file_path: The path to the YAML file.
+        :param file_path: The path to the YAML file, its content as bytes, a readable stream or an already loaded dictionary.
         :return: A dictionary representing the YAML content.
         """
+        if isinstance(file_path, dict):
+            return file_path
+        if isinstance(file_path, bytes) or hasattr(file_path, 'read'):
+            return load_yaml(file_path) or {}
         if file_path:
             with open(file_path, 'r') as f:
-                return yaml.safe_load(f)
+                return load_yaml(f)
         return {}
 
-    def merge(self):
+    def merge(self, provenance: dict = None):
         """
         Merges the new fields into the source YAML without overwriting existing fields, 
         and applies the overrides if an override file is provided.
 
+        :param provenance: Optional dictionary filled with the origin of every value, keyed by dotted path.
         :return: A dictionary with the merged YAML content.
         """
-        # Step 1: Merge new fields into the source without overwriting
-        merged_data = self._merge_new_fields(self.source_data, self.new_fields_data)
-
-        # Step 2: Apply overrides if the override file exists
-        if self.override_data:
-            merged_data = self._apply_overrides(merged_data, self.override_data)
-
-        return merged_data
+        # New fields are merged into the source without overwriting, then the overrides are applied,
+        # both in a single walk. The loaded documents are left untouched, so they can be merged again.
+        return merge_values(self.source_data, [(self.new_fields_data, FILL), (self.override_data, OVERRIDE)],
+                            provenance=provenance, origins=(ORIGIN_RELEASE, ORIGIN_DEFAULTS, ORIGIN_OVERRIDE))
 
     def _merge_new_fields(self, source: dict, new_fields: dict):
         """
-        Recursively merges new fields into the source without overwriting existing values.
+        Merges new fields into the source without overwriting existing values.
 
         :param source: The original YAML data.
         :param new_fields: The new fields to add.
-        :return: A dictionary with the new fields merged into the source.
+        :return: A new dictionary with the new fields merged into the source.
         """
-        for key, value in new_fields.items():
-            if key not in source:
-                source[key] = value
-            elif isinstance(value, dict) and isinstance(source.get(key), dict):
-                # Recursively merge dictionaries
-                source[key] = self._merge_new_fields(source[key], value)
-        return source
+        return merge_values(source, [(new_fields, FILL)])
 
     def _apply_overrides(self, data: dict, overrides: dict):
         """
-        Recursively applies override values to the existing data.
+        Applies override values to the existing data.
 
         :param data: The original or merged YAML data.
         :param overrides: The override fields to apply.
-        :return: A dictionary with the overrides applied.
+        :return: A new dictionary with the overrides applied.
         """
-        for key, value in overrides.items():
-            if isinstance(value, dict) and key in data and isinstance(data[key], dict):
-                # Recursively apply overrides if both are dictionaries
-                data[key] = self._apply_overrides(data[key], value)
-            else:
-                # Otherwise, override the value
-                data[key] = value
-        return data
+        return merge_values(data, [(overrides, OVERRIDE)])
+
+    def merged_values(self, provenance: dict = None):
+        """
+        Merges the YAML documents and applies the special overrides.
+
+        :param provenance: Optional dictionary filled with the origin of every value, keyed by dotted path.
+        :return: A dictionary with the final values.
+        """
+        #Special overrides. Always it is more important the new one
+        special_overrides = {
+            'global': {'byocZipVersion': self.new_fields_data['global']['byocZipVersion']},
+            'image': {'tag': self.new_fields_data['image']['tag']},
+        }
+        source_data = self.source_data
+        # Delete User-Supplied Values, the header of the plain text output of helm get values
+        if isinstance(source_data, dict) and 'USER-SUPPLIED VALUES' in source_data:
+            source_data = {key: value for key, value in source_data.items() if key != 'USER-SUPPLIED VALUES'}
+        return merge_values(
+            source_data,
+            [(self.new_fields_data, FILL), (self.override_data, OVERRIDE), (special_overrides, OVERRIDE)],
+            provenance=provenance,
+            origins=(ORIGIN_RELEASE, ORIGIN_DEFAULTS, ORIGIN_OVERRIDE, ORIGIN_SPECIAL),
+        )
+
+    def merged_yaml(self, provenance: dict = None):
+        """
+        Serializes the final values, ready to be piped to helm.
+
+        :param provenance: Optional dictionary filled with the origin of every value, keyed by dotted path.
+        :return: The merged YAML document as bytes.
+        """
+        return FileManager.dump_values(self.merged_values(provenance=provenance)).encode('utf-8')
 
     def save_merged_yaml(self, file_path: str):
         """
@@ -529,10 +1370,4 @@ class YamlMerger:
 
         :param file_path: The file path where the merged YAML will be saved.
         """
-        merged_data = self.merge()
-        #Special overrides. Always it is more important the new one
-        merged_data['global']['byocZipVersion'] = self.new_fields_data['global']['byocZipVersion']
-        merged_data['image']['tag'] = self.new_fields_data['image']['tag']
-        # Delete User-Supplied Values
-        del merged_data['USER-SUPPLIED VALUES']
-        FileManager.write_values(file_path=file_path,values=merged_data)
\ No newline at end of file
+        FileManager.write_values(file_path=file_path,values=self.merged_values())
\ No newline at end of file
@@ -0,0 +1,210 @@
+import os, time, asyncio, logging
+from logging import DEBUG
+
+logging = logging.getLogger('quix-manager')
+
+# Size of the blocks read from the helm pipes. Lines are split from the blocks, so a line longer
+# than this (e.g. 'helm get values -o json' prints a single line) is not a problem.
+CHUNK_SIZE = 64 * 1024
+
+
+class HelmResult:
+    def __init__(self, args: list, returncode: int, stdout: bytes = b"", stderr: bytes = b"", duration: float = 0.0, timed_out: bool = False):
+        """
+        Holds the outcome of a helm invocation.
+
+        :param args: The full command, helm binary included.
+        :param returncode: The exit code of helm.
+        :param stdout: The captured standard output, empty if it was not captured.
+        :param stderr: The captured standard error.
+        :param duration: The wall time of the invocation in seconds.
+        :param timed_out: True if helm was killed because it ran over its timeout.
+        """
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def check(self):
+        """
+        Raises a HelmCommandError if helm failed.
+
+        :return: The result itself, so calls can be chained.
+        """
+        if not self.ok:
+            raise HelmCommandError(self)
+        return self
+
+    def __repr__(self):
+        return f"HelmResult({self.args!r}, returncode={self.returncode!r}, duration={self.duration:.3f}, timed_out={self.timed_out!r})"
+
+
+class HelmCommandError(RuntimeError):
+    def __init__(self, result: HelmResult):
+        """
+        Raised when a helm invocation fails.
+
+        :param result: The HelmResult of the failed invocation.
+        """
+        self.result = result
+        if result.timed_out:
+            message = f"Helm command {result.args[1:2]} timed out after {result.duration:.1f}s"
+        else:
+            message = f"Helm command {result.args[1:2]} failed with exit code {result.returncode}: {result.stderr.decode('utf-8', errors='replace').strip()}"
+        super().__init__(message)
+
+
+class HelmRunner:
+    def __init__(self, helm_bin: str = None):
+        """
+        Runs helm as an asyncio subprocess. Many invocations can be in flight from one event loop,
+        the standard error is streamed line by line to the logger and failures are returned, never
+        turned into an exit. The standard output is never logged, only its size: the output of the
+        queries holds the values of the release, secrets included.
+
+        :param helm_bin: The helm binary. Default is $HELM_BIN, set by helm for its plugins, or 'helm'.
+        """
+        self.helm_bin = helm_bin or os.environ.get('HELM_BIN') or 'helm'
+        self._version = None
+
+    @staticmethod
+    async def _pump(stream, sink: list, on_line):
+        """
+        Reads a pipe until EOF, passing every line to on_line and every block to sink.
+
+        :param stream: The asyncio stream of the pipe.
+        :param sink: The list collecting the blocks, None to discard them.
+        :param on_line: Callable receiving every line as bytes, newline included.
+        """
+        pending = bytearray()
+        while True:
+            chunk = await stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if sink is not None:
+                sink.append(chunk)
+            pending += chunk
+            start = 0
+            end = pending.find(b"\n", start)
+            while end != -1:
+                on_line(bytes(pending[start:end + 1]))
+                start = end + 1
+                end = pending.find(b"\n", start)
+            del pending[:start]
+        if pending:
+            on_line(bytes(pending))
+
+    @staticmethod
+    async def _feed(stream, data: bytes):
+        """
+        Writes data to the standard input of helm and closes it.
+        """
+        try:
+            stream.write(data)
+            await stream.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # helm exited without reading its input, its exit code tells why
+            pass
+        finally:
+            stream.close()
+
+    @staticmethod
+    def _log_line(prefix: str):
+        """
+        Builds a line handler logging every line at DEBUG.
+
+        :param prefix: The prefix of the logged lines.
+        """
+        def log(line: bytes):
+            if logging.isEnabledFor(DEBUG):
+                logging.debug(f"{prefix}{line.decode('utf-8', errors='replace').rstrip()}")
+        return log
+
+    async def run(self, helm_args: list, timeout: float = None, stdin: bytes = None, capture_stdout: bool = True, on_stdout_line=None):
+        """
+        Runs helm with the provided arguments.
+
+        :param helm_args: List of arguments for the Helm command.
+        :param timeout: Seconds after which helm is killed, None to wait forever.
+        :param stdin: Bytes written to the standard input of helm.
+        :param capture_stdout: Keep the standard output in the result. Disable it for large outputs handled by on_stdout_line.
+        :param on_stdout_line: Callable receiving every line of the standard output as bytes. Default only counts its bytes.
+        :return: A HelmResult, whatever the exit code.
+        """
+        command = [self.helm_bin] + list(helm_args)
+        logging.debug(f"Executing Helm command: {command}")
+        start = time.monotonic()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            # Same exit code a shell gives for a command it cannot run
+            return HelmResult(command, 127, stderr=str(e).encode('utf-8'), duration=time.monotonic() - start)
+        stdout, stderr = ([] if capture_stdout else None), []
+        stdout_bytes = [0]
+
+        def count(line: bytes):
+            stdout_bytes[0] += len(line)
+
+        tasks = [
+            self._pump(process.stdout, stdout, on_stdout_line or count),
+            self._pump(process.stderr, stderr, self._log_line("helm stderr: ")),
+        ]
+        if stdin is not None:
+            tasks.append(self._feed(process.stdin, stdin))
+
+        timed_out = False
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks, process.wait()), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            logging.error(f"Helm command {command[1:2]} timed out after {timeout}s, killing it.")
+            await self._kill(process)
+        except asyncio.CancelledError:
+            logging.debug(f"Helm command {command[1:2]} cancelled, killing it.")
+            await self._kill(process)
+            raise
+
+        if on_stdout_line is None:
+            logging.debug(f"Helm command {command[1:2]} printed {stdout_bytes[0]} bytes")
+        return HelmResult(command, process.returncode, b"".join(stdout or []), b"".join(stderr),
+                          duration=time.monotonic() - start, timed_out=timed_out)
+
+    @staticmethod
+    async def _kill(process):
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+
+    def run_sync(self, helm_args: list, **kwargs):
+        """
+        Runs helm from synchronous code on a private event loop. Takes the same arguments as run.
+
+        :return: A HelmResult, whatever the exit code.
+        """
+        return asyncio.run(self.run(helm_args, **kwargs))
+
+    def version(self):
+        """
+        Returns the version of helm, queried once per runner.
+
+        :return: The output of 'helm version --short', None if helm could not tell.
+        """
+        if self._version is None:
+            result = self.run_sync(['version', '--short'])
+            if result.ok:
+                self._version = result.stdout.decode('utf-8', errors='replace').strip()
+        return self._version
@@ -0,0 +1,77 @@
+import collections, logging
+
+# Kubernetes refuses objects over 1 MiB, keep the logs well under it with room for the metrics
+DEFAULT_MAX_BYTES = 512 * 1024
+DEFAULT_MAX_RECORD_BYTES = 64 * 1024
+
+
+class CaptureHandler(logging.Handler):
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, max_record_bytes: int = DEFAULT_MAX_RECORD_BYTES):
+        """
+        Captures the formatted log records in memory, within a byte budget. When the budget is
+        exceeded the oldest records of the lowest level go first, so the warnings and errors of a
+        long run are kept over its debug and info lines. Dropped and truncated lines are replaced
+        by markers, so the capture tells what is missing.
+
+        :param max_bytes: The budget of the captured records, in bytes of UTF-8.
+        :param max_record_bytes: Records longer than this are truncated, e.g. a rendered chart.
+        """
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.max_record_bytes = min(max_record_bytes, max_bytes)
+        # One queue per level: (sequence number, line, size), oldest first
+        self._records = {}
+        self._size = 0
+        self._sequence = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+
+    @staticmethod
+    def _truncate(line: str, limit: int):
+        encoded = line.encode('utf-8')
+        if len(encoded) <= limit:
+            return line, len(encoded)
+        marker = f"... [truncated {len(encoded) - limit} bytes]\n"
+        line = encoded[:max(0, limit - len(marker))].decode('utf-8', errors='ignore') + marker
+        return line, len(line.encode('utf-8'))
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            line, size = self._truncate(self.format(record) + "\n", self.max_record_bytes)
+        except Exception:
+            self.handleError(record)
+            return
+        self._records.setdefault(record.levelno, collections.deque()).append((self._sequence, line, size))
+        self._sequence += 1
+        self._size += size
+        while self._size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        level = min(level for level, records in self._records.items() if records)
+        _, _, size = self._records[level].popleft()
+        self._size -= size
+        self.dropped += 1
+        self.dropped_bytes += size
+
+    def getvalue(self):
+        """
+        :return: The captured lines in the order they were logged, with a marker where lines were dropped.
+        """
+        self.acquire()
+        try:
+            records = sorted(record for queue in self._records.values() for record in queue)
+            parts = []
+            if self.dropped:
+                parts.append(f"# [log capture limited to {self.max_bytes} bytes: {self.dropped} lines, {self.dropped_bytes} bytes dropped]\n")
+            expected = 0
+            for sequence, line, _ in records:
+                if sequence > expected:
+                    parts.append(f"# [... {sequence - expected} lines dropped ...]\n")
+                parts.append(line)
+                expected = sequence + 1
+            if self._sequence > expected:
+                parts.append(f"# [... {self._sequence - expected} lines dropped ...]\n")
+            return "".join(parts)
+        finally:
+            self.release()
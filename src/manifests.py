@@ -0,0 +1,122 @@
+import os, re, tempfile, logging
+
+logging = logging.getLogger('quix-manager')
+
+_KIND = re.compile(rb'^kind:\s*(.+?)\s*$')
+_METADATA = re.compile(rb'^metadata:\s*$')
+_NAME = re.compile(rb'^(\s+)name:\s*(.+?)\s*$')
+_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+class ManifestSplitter:
+    def __init__(self, output_dir: str):
+        """
+        Splits a stream of rendered manifests into one file per resource, '<kind>/<name>.yaml' under
+        the output directory. Lines are written as they come, only the kind and the name of the
+        current document are kept in memory.
+
+        :param output_dir: The directory of the files, created if needed. Files already there are overwritten.
+        """
+        self.output_dir = output_dir
+        self.paths = []
+        self._taken = set()
+        self._file = None
+        self._staging_path = None
+        self._reset()
+
+    def _reset(self):
+        self._kind = None
+        self._name = None
+        self._metadata_indent = None
+        self._in_metadata = False
+        self._has_content = False
+
+    def write_line(self, line: bytes):
+        """
+        Handles one line of the stream, newline included.
+        """
+        stripped = line.strip()
+        if stripped == b'---' or line.startswith(b'--- '):
+            self._finish_document()
+            return
+        if self._file is None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            fd, self._staging_path = tempfile.mkstemp(prefix=".document-", suffix=".partial", dir=self.output_dir)
+            self._file = os.fdopen(fd, 'wb')
+        self._file.write(line)
+        if not stripped or stripped.startswith(b'#'):
+            return
+        self._has_content = True
+        self._parse(line)
+
+    def _parse(self, line: bytes):
+        """
+        Picks the kind and the metadata.name of the document from its top level lines.
+        """
+        if not line[:1].isspace():
+            self._in_metadata = bool(_METADATA.match(line))
+            match = _KIND.match(line)
+            if match and self._kind is None:
+                self._kind = self._scalar(match.group(1))
+            return
+        if not self._in_metadata:
+            return
+        match = _NAME.match(line)
+        indent = len(line) - len(line.lstrip())
+        if self._metadata_indent is None:
+            self._metadata_indent = indent
+        if match and indent == self._metadata_indent and self._name is None:
+            self._name = self._scalar(match.group(2))
+
+    @staticmethod
+    def _scalar(value: bytes):
+        text = value.decode('utf-8', errors='replace')
+        if len(text) > 1 and text[0] == text[-1] and text[0] in "'\"":
+            text = text[1:-1]
+        return _UNSAFE.sub('_', text) or '_'
+
+    def _target_path(self):
+        if self._kind and self._name:
+            directory, stem = os.path.join(self.output_dir, self._kind), self._name
+        else:
+            directory, stem = self.output_dir, f"document-{len(self.paths)}"
+        # The same kind and name in two namespaces, e.g. a Role, gets a suffix
+        path, index = os.path.join(directory, f"{stem}.yaml"), 1
+        while path in self._taken:
+            index += 1
+            path = os.path.join(directory, f"{stem}-{index}.yaml")
+        return path
+
+    def _finish_document(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if not self._has_content:
+            # Separators and comments only, e.g. a template rendering to nothing
+            os.remove(self._staging_path)
+        else:
+            path = self._target_path()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self._staging_path, path)
+            self._taken.add(path)
+            self.paths.append(path)
+        self._staging_path = None
+        self._reset()
+
+    def close(self):
+        """
+        Writes the last document of the stream.
+        """
+        self._finish_document()
+
+    def discard(self):
+        """
+        Drops the document being written, e.g. when the render failed.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._staging_path)
+            self._staging_path = None
+        self._reset()
@@ -0,0 +1,223 @@
+import os, time, tempfile, threading, contextlib, contextvars, logging
+
+logging = logging.getLogger('quix-manager')
+
+# Prefix of the metric names in the OpenMetrics output
+METRIC_PREFIX = "quix_manager"
+
+# The span of the phase running in the current thread or task, so helm calls are attributed to it
+CURRENT_SPAN = contextvars.ContextVar('quix_manager_span', default=None)
+
+
+class Span:
+    __slots__ = ('name', 'start', 'duration', 'exit_code', 'bytes_in', 'bytes_out', 'succeeded')
+
+    def __init__(self, name: str):
+        """
+        The measures of a phase of a run.
+
+        :param name: The name of the phase.
+        """
+        self.name = name
+        self.start = time.monotonic()
+        self.duration = 0.0
+        # Exit code of the helm commands of the phase, None if it ran none
+        self.exit_code = None
+        # Bytes fed to the phase (e.g. helm stdin) and produced by it (e.g. helm stdout, serialized values)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.succeeded = False
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'duration': round(self.duration, 6),
+            'exit_code': self.exit_code,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'succeeded': self.succeeded,
+        }
+
+
+def record_helm_result(result, stdin: bytes = None):
+    """
+    Attributes a helm invocation to the span of the running phase, if any.
+    The first failing exit code of the phase is kept.
+
+    :param result: The HelmResult of the invocation.
+    :param stdin: The bytes written to the standard input of helm.
+    """
+    span = CURRENT_SPAN.get()
+    if span is None:
+        return
+    if span.exit_code in (None, 0):
+        span.exit_code = -1 if result.timed_out else result.returncode
+    span.bytes_in += len(stdin or b"")
+    span.bytes_out += len(result.stdout or b"")
+
+
+def record_bytes(bytes_in: int = 0, bytes_out: int = 0):
+    """
+    Adds byte counts to the span of the running phase, if any.
+    """
+    span = CURRENT_SPAN.get()
+    if span is not None:
+        span.bytes_in += bytes_in
+        span.bytes_out += bytes_out
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_size(size: int):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024 or unit == "MiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+class Metrics:
+    def __init__(self, labels: dict = None):
+        """
+        Collects the spans of a run. Phases may run concurrently, spans are recorded from any thread.
+
+        :param labels: Labels of every metric in the OpenMetrics output, e.g. release and namespace.
+        """
+        self.labels = dict(labels or {})
+        self.spans = []
+        self.start = time.monotonic()
+        self.duration = None
+        self.succeeded = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        """
+        Measures the wall time of a block and makes it the current span for the helm calls it makes.
+
+        :param name: The name of the phase.
+        :return: The Span, filled when the block exits.
+        """
+        span = Span(name)
+        token = CURRENT_SPAN.set(span)
+        try:
+            yield span
+            span.succeeded = True
+        finally:
+            CURRENT_SPAN.reset(token)
+            span.duration = time.monotonic() - span.start
+            with self._lock:
+                self.spans.append(span)
+
+    def timed(self, name: str, func):
+        """
+        Wraps a phase function so every call is measured as a span.
+
+        :param name: The name of the phase.
+        :param func: The function of the phase.
+        :return: The wrapped function.
+        """
+        def run_timed():
+            with self.span(name):
+                return func()
+        return run_timed
+
+    def finish(self, succeeded: bool):
+        """
+        Records the end of the run.
+
+        :param succeeded: True if the run succeeded.
+        """
+        self.duration = time.monotonic() - self.start
+        self.succeeded = succeeded
+
+    def _ordered_spans(self):
+        with self._lock:
+            return sorted(self.spans, key=lambda span: span.start)
+
+    def to_dict(self):
+        """
+        :return: The run and its spans as a JSON serializable dictionary.
+        """
+        duration = self.duration if self.duration is not None else time.monotonic() - self.start
+        return {
+            'labels': self.labels,
+            'duration': round(duration, 6),
+            'succeeded': self.succeeded,
+            'spans': [span.to_dict() for span in self._ordered_spans()],
+        }
+
+    def summary(self):
+        """
+        :return: A one line summary of the spans, in start order.
+        """
+        parts = []
+        for span in self._ordered_spans():
+            details = []
+            if span.exit_code is not None:
+                details.append(f"exit {span.exit_code}")
+            if span.bytes_out:
+                details.append(f"{_format_size(span.bytes_out)} out")
+            if not span.succeeded:
+                details.append("failed")
+            parts.append(f"{span.name} {span.duration:.2f}s" + (f" ({', '.join(details)})" if details else ""))
+        duration = self.duration if self.duration is not None else time.monotonic() - self.start
+        return f"Phase timings: {', '.join(parts) or 'none'}; total {duration:.2f}s"
+
+    def to_openmetrics(self):
+        """
+        Formats the run in the OpenMetrics text format, readable by the node-exporter textfile collector.
+
+        :return: The exposition as a string.
+        """
+        def labels(**extra):
+            items = list(self.labels.items()) + list(extra.items())
+            return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in items if value is not None) + "}"
+
+        def family(name: str, metric_type: str, help_text: str, unit: str = None):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+            if unit:
+                lines.append(f"# UNIT {METRIC_PREFIX}_{name} {unit}")
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+
+        spans = self._ordered_spans()
+        lines = []
+        family("phase_duration_seconds", "gauge", "Wall time of the phase in the last run.", unit="seconds")
+        for span in spans:
+            lines.append(f"{METRIC_PREFIX}_phase_duration_seconds{labels(phase=span.name)} {span.duration:.6f}")
+        family("phase_exit_code", "gauge", "Exit code of the helm commands of the phase in the last run.")
+        for span in spans:
+            if span.exit_code is not None:
+                lines.append(f"{METRIC_PREFIX}_phase_exit_code{labels(phase=span.name)} {span.exit_code}")
+        family("phase_bytes", "gauge", "Bytes fed to and produced by the phase in the last run.", unit="bytes")
+        for span in spans:
+            lines.append(f"{METRIC_PREFIX}_phase_bytes{labels(phase=span.name, direction='in')} {span.bytes_in}")
+            lines.append(f"{METRIC_PREFIX}_phase_bytes{labels(phase=span.name, direction='out')} {span.bytes_out}")
+        family("run_duration_seconds", "gauge", "Wall time of the last run.", unit="seconds")
+        duration = self.duration if self.duration is not None else time.monotonic() - self.start
+        lines.append(f"{METRIC_PREFIX}_run_duration_seconds{labels()} {duration:.6f}")
+        family("run_success", "gauge", "1 if the last run succeeded, 0 otherwise.")
+        lines.append(f"{METRIC_PREFIX}_run_success{labels()} {1 if self.succeeded else 0}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_openmetrics(self, file_path: str):
+        """
+        Writes the OpenMetrics exposition to a file, atomically so a collector never reads a partial file.
+
+        :param file_path: The path of the metrics file.
+        """
+        directory = os.path.dirname(os.path.abspath(file_path))
+        fd, staging_path = tempfile.mkstemp(prefix=".metrics-", dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.to_openmetrics())
+            os.chmod(staging_path, 0o644)
+            os.replace(staging_path, file_path)
+        except BaseException:
+            try:
+                os.remove(staging_path)
+            except OSError:
+                pass
+            raise
@@ -0,0 +1,83 @@
+import asyncio, logging
+
+logging = logging.getLogger('quix-manager')
+
+
+class Phase:
+    def __init__(self, name: str, func, requires: tuple = ()):
+        """
+        A step of a run and the phases it depends on.
+
+        :param name: The name of the phase.
+        :param func: The callable of the phase, a plain function or a coroutine function.
+        :param requires: The names of the phases that must complete before this one starts.
+        """
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+
+
+class PhaseGraph:
+    def __init__(self):
+        """
+        A dependency graph of phases. Every phase starts as soon as the phases it requires are done,
+        so independent phases run concurrently. Plain functions run in worker threads, coroutine
+        functions on the event loop.
+        """
+        self.phases = {}
+
+    def add(self, name: str, func, requires: tuple = ()):
+        """
+        Adds a phase to the graph. Dependencies must be added first, which keeps the graph acyclic.
+
+        :param name: The name of the phase.
+        :param func: The callable of the phase.
+        :param requires: The names of the phases that must complete before this one starts.
+        :return: The graph itself, so calls can be chained.
+        """
+        if name in self.phases:
+            raise ValueError(f"Phase {name} is already defined")
+        for requirement in requires:
+            if requirement not in self.phases:
+                raise ValueError(f"Phase {name} requires unknown phase {requirement}")
+        self.phases[name] = Phase(name, func, requires)
+        return self
+
+    async def _run_phase(self, phase: Phase, tasks: dict):
+        if phase.requires:
+            await asyncio.gather(*(tasks[requirement] for requirement in phase.requires))
+        logging.debug(f"Starting phase {phase.name}")
+        if asyncio.iscoroutinefunction(phase.func):
+            result = await phase.func()
+        else:
+            result = await asyncio.to_thread(phase.func)
+        logging.debug(f"Phase {phase.name} completed")
+        return result
+
+    async def run_async(self):
+        """
+        Runs every phase of the graph. When a phase fails, the phases not started yet are cancelled
+        and the error is raised.
+
+        :return: A dictionary with the result of every phase, keyed by name.
+        """
+        tasks = {}
+        # Phases are stored in insertion order, so requirements always have their task already
+        for phase in self.phases.values():
+            tasks[phase.name] = asyncio.ensure_future(self._run_phase(phase, tasks))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        return {name: task.result() for name, task in tasks.items()}
+
+    def run(self):
+        """
+        Runs every phase of the graph from synchronous code.
+
+        :return: A dictionary with the result of every phase, keyed by name.
+        """
+        return asyncio.run(self.run_async())
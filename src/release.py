@@ -0,0 +1,234 @@
+import re, json, logging
+from dataclasses import dataclass
+
+logging = logging.getLogger('quix-manager')
+
+# Statuses listed by a plain 'helm list', the ones an upgrade can start from
+ACTIVE_STATUSES = ('deployed', 'failed')
+
+# '<chart name>-<version>', where the version starts with a digit and may carry a pre-release suffix
+CHART_FIELD_PATTERN = re.compile(r'^(?P<name>.+?)-(?P<version>v?\d+(?:\.\d+)*(?:[-+].*)?)$')
+
+
+def split_chart_field(chart_field: str):
+    """
+    Splits the chart field of helm list and helm history into chart name and version.
+    Chart names and pre-release versions may both contain dashes (e.g. 'quixplatform-manager-1.5.4-rc.1').
+
+    :param chart_field: The '<chart name>-<version>' field.
+    :return: Tuple of chart name and version.
+    """
+    match = CHART_FIELD_PATTERN.match(chart_field or "")
+    if not match:
+        raise ValueError(f"Invalid chart field: {chart_field}")
+    return match.group('name'), match.group('version')
+
+
+def _decode(payload):
+    """
+    Decodes the JSON output of a helm command.
+
+    :param payload: The raw stdout of helm, as bytes or str.
+    :return: The decoded document.
+    """
+    try:
+        return json.loads(payload)
+    except ValueError as e:
+        logging.error(f"Invalid JSON output from helm: {e}")
+        raise
+
+
+@dataclass
+class ReleaseInfo:
+    """
+    A row of 'helm list -o json'.
+    """
+    __slots__ = ('name', 'namespace', 'revision', 'updated', 'status', 'chart', 'chart_version', 'app_version')
+    name: str
+    namespace: str
+    revision: int
+    updated: str
+    status: str
+    chart: str
+    chart_version: str
+    app_version: str
+
+    @classmethod
+    def from_json(cls, item: dict):
+        chart, chart_version = split_chart_field(item.get('chart'))
+        return cls(
+            name=item.get('name'),
+            namespace=item.get('namespace'),
+            revision=int(item.get('revision')),
+            updated=item.get('updated'),
+            status=item.get('status'),
+            chart=chart,
+            chart_version=chart_version,
+            app_version=item.get('app_version'),
+        )
+
+
+@dataclass
+class ReleaseStatus:
+    """
+    The release summary of 'helm status -o json'.
+    """
+    __slots__ = ('name', 'namespace', 'revision', 'status', 'chart', 'chart_version', 'app_version', 'description')
+    name: str
+    namespace: str
+    revision: int
+    status: str
+    chart: str
+    chart_version: str
+    app_version: str
+    description: str
+
+    @classmethod
+    def from_json(cls, item: dict):
+        info = item.get('info') or {}
+        metadata = (item.get('chart') or {}).get('metadata') or {}
+        return cls(
+            name=item.get('name'),
+            namespace=item.get('namespace'),
+            revision=int(item.get('version')),
+            status=info.get('status'),
+            chart=metadata.get('name'),
+            chart_version=metadata.get('version'),
+            app_version=metadata.get('appVersion'),
+            description=info.get('description'),
+        )
+
+
+@dataclass
+class Revision:
+    """
+    An entry of 'helm history -o json'.
+    """
+    __slots__ = ('revision', 'updated', 'status', 'chart', 'chart_version', 'app_version', 'description')
+    revision: int
+    updated: str
+    status: str
+    chart: str
+    chart_version: str
+    app_version: str
+    description: str
+
+    @classmethod
+    def from_json(cls, item: dict):
+        chart, chart_version = split_chart_field(item.get('chart'))
+        return cls(
+            revision=int(item.get('revision')),
+            updated=item.get('updated'),
+            status=item.get('status'),
+            chart=chart,
+            chart_version=chart_version,
+            app_version=item.get('app_version'),
+            description=item.get('description'),
+        )
+
+
+def parse_release_list(payload):
+    """
+    Parses the output of 'helm list -o json'.
+
+    :param payload: The raw stdout of helm.
+    :return: A list of ReleaseInfo.
+    """
+    return [ReleaseInfo.from_json(item) for item in _decode(payload) or []]
+
+
+def parse_release_status(payload):
+    """
+    Parses the output of 'helm status -o json'.
+
+    :param payload: The raw stdout of helm.
+    :return: A ReleaseStatus.
+    """
+    return ReleaseStatus.from_json(_decode(payload))
+
+
+def parse_history(payload):
+    """
+    Parses the output of 'helm history -o json', oldest revision first.
+
+    :param payload: The raw stdout of helm.
+    :return: A list of Revision.
+    """
+    return sorted((Revision.from_json(item) for item in _decode(payload) or []), key=lambda revision: revision.revision)
+
+
+def last_deployed_revision(history: list):
+    """
+    Finds the revision a release interrupted during an upgrade can be rolled back to: the last
+    deployed one, or the last one that was deployed and later superseded.
+
+    :param history: A list of Revision, oldest first.
+    :return: The Revision, None if no revision was ever deployed.
+    """
+    for status in ('deployed', 'superseded'):
+        for revision in reversed(history):
+            if revision.status == status:
+                return revision
+    return None
+
+
+def parse_values(payload):
+    """
+    Parses the output of 'helm get values -o json'. Helm prints null for a release without user-supplied values.
+
+    :param payload: The raw stdout of helm.
+    :return: A dictionary with the values.
+    """
+    return _decode(payload) or {}
+
+
+class ReleaseSnapshot:
+    def __init__(self, release_name: str, chart_version: str = None, revision: int = None, status: str = None):
+        """
+        Holds the state of a Helm release as read by a single query, so every phase of a run
+        reads the same view instead of querying helm again.
+
+        :param release_name: Name of the Helm release.
+        :param chart_version: Version of the deployed chart, None if the release is not found.
+        :param revision: Current revision of the release.
+        :param status: Current status of the release (e.g. 'deployed', 'pending-upgrade').
+        """
+        self.release_name = release_name
+        self.chart_version = chart_version
+        self.revision = revision
+        self.status = status
+
+    @property
+    def found(self):
+        """
+        :return: True if helm knows the release, whatever its status.
+        """
+        return self.status is not None
+
+    @property
+    def exists(self):
+        """
+        :return: True if the release is in a status an upgrade can start from.
+        """
+        return self.status in ACTIVE_STATUSES
+
+    @classmethod
+    def from_releases(cls, release_name: str, releases: list):
+        """
+        Builds a snapshot from the releases returned by 'helm list --all'.
+
+        :param release_name: Name of the Helm release.
+        :param releases: A list of ReleaseInfo.
+        :return: A ReleaseSnapshot, empty if the release is not listed.
+        """
+        for release in releases:
+            if release.name != release_name:
+                continue
+            snapshot = cls(release_name, chart_version=release.chart_version, revision=release.revision, status=release.status)
+            logging.debug(f"Release {release_name} is at revision {snapshot.revision} with status {snapshot.status} and chart version {snapshot.chart_version}")
+            return snapshot
+        logging.debug(f"Release {release_name} not found in helm list output")
+        return cls(release_name)
+
+    def __repr__(self):
+        return f"ReleaseSnapshot({self.release_name!r}, chart_version={self.chart_version!r}, revision={self.revision!r}, status={self.status!r})"
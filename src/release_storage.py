@@ -0,0 +1,239 @@
+import os, gzip, json, time, base64, binascii, logging
+from src.helm_backend import HelmBackend
+from src.helm_runner import HelmRunner, HelmResult
+from src.retry import MUTATING_OPERATIONS, Deadline
+
+logging = logging.getLogger('quix-manager')
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Values of $HELM_DRIVER storing the releases in secrets
+STORAGE_DRIVERS = ('secret', 'secrets')
+
+
+def decode_release(payload):
+    """
+    Decodes a release as helm stores it in the 'release' field of its storage secrets: base64
+    encoded gzip of the release JSON. The field of a secret read through the API is base64
+    encoded once more, which is removed first.
+
+    :param payload: The 'data.release' field of the secret, as str or bytes.
+    :return: The release as a dictionary.
+    :raises ValueError: If the payload is not a helm release.
+    """
+    try:
+        data = base64.b64decode(base64.b64decode(payload, validate=True), validate=True)
+        if data[:2] == GZIP_MAGIC:
+            data = gzip.decompress(data)
+        return json.loads(data)
+    except (binascii.Error, OSError, EOFError, ValueError) as e:
+        raise ValueError(f"Not a helm release record: {e}") from e
+
+
+def _chart_metadata(release: dict):
+    return (release.get('chart') or {}).get('metadata') or {}
+
+
+def _info(release: dict):
+    return release.get('info') or {}
+
+
+def list_entry(release: dict):
+    """
+    :return: The release as an entry of 'helm list -o json'.
+    """
+    metadata = _chart_metadata(release)
+    return {
+        'name': release.get('name'),
+        'namespace': release.get('namespace'),
+        'revision': str(release.get('version')),
+        'updated': _info(release).get('last_deployed'),
+        'status': _info(release).get('status'),
+        'chart': f"{metadata.get('name')}-{metadata.get('version')}",
+        'app_version': metadata.get('appVersion'),
+    }
+
+
+def history_entry(release: dict):
+    """
+    :return: The release as an entry of 'helm history -o json'.
+    """
+    metadata = _chart_metadata(release)
+    return {
+        'revision': release.get('version'),
+        'updated': _info(release).get('last_deployed'),
+        'status': _info(release).get('status'),
+        'chart': f"{metadata.get('name')}-{metadata.get('version')}",
+        'app_version': metadata.get('appVersion'),
+        'description': _info(release).get('description'),
+    }
+
+
+def status_document(release: dict):
+    """
+    :return: The release as printed by 'helm status -o json', without the chart files and the manifest.
+    """
+    return {
+        'name': release.get('name'),
+        'namespace': release.get('namespace'),
+        'version': release.get('version'),
+        'info': _info(release),
+        'chart': {'metadata': _chart_metadata(release)},
+        'config': release.get('config'),
+    }
+
+
+class StoredRelease:
+    def __init__(self, release_name: str, secrets: list):
+        """
+        The revisions of a release read from its storage secrets. Only the revisions a query needs
+        are decoded, the labels of the secrets already tell the revision numbers.
+
+        :param release_name: Name of the Helm release.
+        :param secrets: The items of 'kubectl get secrets -o json' for the release.
+        """
+        self.release_name = release_name
+        self._secrets = {}
+        for secret in secrets:
+            labels = (secret.get('metadata') or {}).get('labels') or {}
+            if labels.get('owner') == 'helm' and labels.get('name') == release_name and secret.get('type', 'helm.sh/release.v1') == 'helm.sh/release.v1':
+                self._secrets[int(labels.get('version', 0))] = secret
+        self._decoded = {}
+
+    @property
+    def revisions(self):
+        return sorted(self._secrets)
+
+    def revision(self, number: int):
+        """
+        :return: The decoded release of a revision.
+        """
+        if number not in self._decoded:
+            self._decoded[number] = decode_release((self._secrets[number].get('data') or {}).get('release', ''))
+        return self._decoded[number]
+
+    def latest(self):
+        """
+        :return: The decoded release of the last revision, None if the release has none.
+        """
+        return self.revision(self.revisions[-1]) if self._secrets else None
+
+
+class StorageBackend(HelmBackend):
+    def __init__(self, backend: HelmBackend, kubectl: str = None, context: str = None, deadline: Deadline = None):
+        """
+        Answers the read-only queries (list, status, history, get values) from the storage secrets
+        of helm, fetched once per release with a single kubectl call, instead of one helm process
+        per query. Every other operation goes to the wrapped backend, and so does any query when
+        kubectl fails, e.g. when it is missing or not allowed to read secrets, or finds no storage
+        secrets of the release. With a $HELM_DRIVER other than secret every query goes to helm.
+
+        :param backend: The backend of the other operations and of the fallback.
+        :param kubectl: The kubectl binary. Default is $KUBECTL or 'kubectl'.
+        :param context: The kube context, default is $HELM_KUBECONTEXT, the context helm uses.
+        :param deadline: The time budget of the run, bounding the kubectl calls.
+        """
+        self.backend = backend
+        self.runner = HelmRunner(kubectl or os.environ.get('KUBECTL') or 'kubectl')
+        self.context = context or os.environ.get('HELM_KUBECONTEXT')
+        self.deadline = deadline
+        # Only the secret driver, helm's default, keeps the releases in secrets
+        driver = os.environ.get('HELM_DRIVER') or 'secret'
+        self.available = driver in STORAGE_DRIVERS
+        if not self.available:
+            logging.debug(f"Helm storage driver {driver} does not use secrets, reading the release state with helm.")
+        self._releases = {}
+
+    def run(self, helm_args: list, **kwargs):
+        return self.backend.run(helm_args, **kwargs)
+
+    def version(self):
+        return self.backend.version()
+
+    def _call(self, operation: str, helm_args: list, artifacts: list = None, **kwargs):
+        if operation in MUTATING_OPERATIONS:
+            # The release gets a new revision
+            self._releases.clear()
+        return self.backend._call(operation, helm_args, artifacts=artifacts, **kwargs)
+
+    def _stored_release(self, release_name: str, namespace: str = None):
+        """
+        Reads the storage secrets of a release, once until the release is changed.
+
+        :return: A StoredRelease with revisions, None if they cannot be read or none are found.
+        """
+        key = (release_name, namespace)
+        if key in self._releases:
+            return self._releases[key]
+        if not self.available:
+            return None
+        kubectl_args = ['get', 'secrets', '--selector', f"owner=helm,name={release_name}", '--output', 'json']
+        if namespace:
+            kubectl_args.extend(['--namespace', namespace])
+        if self.context:
+            kubectl_args.extend(['--context', self.context])
+        # The secrets hold the values of the release, never log them
+        kwargs = {'on_stdout_line': lambda line: None}
+        if self.deadline is not None:
+            self.deadline.check('get secrets')
+            kwargs['timeout'] = self.deadline.remaining()
+        result = self.runner.run_sync(kubectl_args, **kwargs)
+        if not result.ok:
+            # Not worth trying again for the other queries of the run
+            self.available = False
+            logging.info(f"Could not read the release storage with kubectl, using helm: {result.stderr.decode('utf-8', errors='replace').strip()}")
+            return None
+        try:
+            stored = StoredRelease(release_name, json.loads(result.stdout).get('items') or [])
+        except (ValueError, AttributeError) as e:
+            self.available = False
+            logging.info(f"Unexpected output of kubectl, using helm: {e}")
+            return None
+        if not stored.revisions:
+            # Not proof the release does not exist, e.g. the secrets may be in another namespace: helm tells
+            logging.debug(f"No release storage found for {release_name}, using helm.")
+            stored = None
+        else:
+            logging.debug(f"Read {len(stored.revisions)} revisions of {release_name} from the release storage in {result.duration:.2f}s")
+        self._releases[key] = stored
+        return stored
+
+    def _answer(self, operation: str, release_name: str, namespace: str, render, fallback):
+        """
+        Answers a query from the release storage, or from the wrapped backend when the storage
+        cannot be read or decoded.
+
+        :param render: Builds the JSON document of the answer from a StoredRelease.
+        :param fallback: Runs the query on the wrapped backend.
+        """
+        start = time.monotonic()
+        stored = self._stored_release(release_name, namespace)
+        if stored is None:
+            return fallback()
+        try:
+            document = render(stored)
+        except ValueError as e:
+            logging.warning(f"Could not decode the release storage of {release_name}, using helm: {e}")
+            return fallback()
+        return HelmResult(['kubectl', operation, release_name], 0, stdout=json.dumps(document).encode('utf-8'),
+                          duration=time.monotonic() - start)
+
+    def list(self, release_name: str = None, namespace: str = None, all_namespaces: bool = False):
+        if all_namespaces or not release_name:
+            return self.backend.list(release_name, namespace, all_namespaces)
+        return self._answer('list', release_name, namespace, lambda stored: [list_entry(stored.latest())],
+                            lambda: self.backend.list(release_name, namespace))
+
+    def status(self, release_name: str, namespace: str = None):
+        return self._answer('status', release_name, namespace, lambda stored: status_document(stored.latest()),
+                            lambda: self.backend.status(release_name, namespace))
+
+    def history(self, release_name: str, namespace: str = None):
+        return self._answer('history', release_name, namespace,
+                            lambda stored: [history_entry(stored.revision(number)) for number in stored.revisions],
+                            lambda: self.backend.history(release_name, namespace))
+
+    def get_values(self, release_name: str, namespace: str = None):
+        # User-supplied values of the last revision, null when there are none, like helm prints them
+        return self._answer('get_values', release_name, namespace, lambda stored: stored.latest().get('config') or None,
+                            lambda: self.backend.get_values(release_name, namespace))
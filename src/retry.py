@@ -0,0 +1,106 @@
+import re, time, random, logging
+
+logging = logging.getLogger('quix-manager')
+
+# Errors of the registry, the API server or the network that go away on their own
+RETRYABLE_ERRORS = re.compile(
+    r'\b(?:429|502|503|504)\b|too many requests|bad gateway|service unavailable|gateway time-?out'
+    r'|i/o timeout|tls handshake timeout|connection reset by peer|connection refused|broken pipe|unexpected eof'
+    r'|http2: client connection lost|server is currently unable to handle the request'
+    r'|etcdserver: request timed out|client rate limiter|rate limit',
+    re.IGNORECASE)
+
+# Operations that change the release. Killed halfway they may have started the change, so they are not retried after a timeout
+MUTATING_OPERATIONS = ('upgrade', 'rollback')
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+
+
+def parse_duration(value):
+    """
+    Parses a duration in the format of helm, e.g. '90s', '6m' or '1h30m'. A plain number is in seconds.
+
+    :param value: The duration as a string or a number.
+    :return: The duration in seconds.
+    :raises ValueError: If the duration cannot be parsed.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(text)
+    if not parts or "".join(number + unit for number, unit in parts) != text:
+        raise ValueError(f"Invalid duration: {value!r}")
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def is_retryable(operation: str, result):
+    """
+    Tells whether a failed helm operation may succeed if run again.
+
+    :param operation: The name of the operation, e.g. 'pull'.
+    :param result: The HelmResult of the failed operation.
+    :return: True for transient errors, False for the fatal ones.
+    """
+    if result.ok or result.returncode == 127:
+        return False
+    if result.timed_out:
+        return operation not in MUTATING_OPERATIONS
+    return bool(RETRYABLE_ERRORS.search(result.stderr.decode('utf-8', errors='replace')))
+
+
+class DeadlineExceeded(RuntimeError):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        """
+        A time budget shared by every helm call of a run.
+
+        :param seconds: The budget, counted from now.
+        """
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        """
+        :return: The seconds left, 0 once the deadline passed.
+        """
+        return max(0.0, self.expires - time.monotonic())
+
+    def check(self, operation: str):
+        """
+        :raises DeadlineExceeded: If no time is left for the operation.
+        """
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(f"Deadline of {self.seconds:g}s exceeded before helm {operation}")
+
+
+class RetryPolicy:
+    def __init__(self, retries: int = 2, base_delay: float = 1.0, max_delay: float = 20.0, rng: random.Random = None):
+        """
+        Retries transient failures with exponential backoff and full jitter: the n-th retry waits a
+        random time between 0 and min(max_delay, base_delay * 2^n), so runs failing together do not
+        retry together.
+
+        :param retries: The number of retries after the first attempt, 0 to never retry.
+        :param base_delay: The backoff of the first retry, in seconds.
+        :param max_delay: The maximum backoff, in seconds.
+        :param rng: The random generator of the jitter.
+        """
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rng = rng or random.Random()
+
+    def delay(self, retry: int):
+        """
+        :param retry: The number of the retry, 0 for the first one.
+        :return: The seconds to wait before the retry.
+        """
+        return self.rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
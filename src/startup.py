@@ -0,0 +1,99 @@
+import sys, time, builtins, threading, logging
+
+logging = logging.getLogger('quix-manager')
+
+
+def _module_name(name: str, globals: dict, level: int):
+    """
+    Resolves the absolute name of the module of an import statement.
+    """
+    if not level:
+        return name
+    package = (globals or {}).get('__package__') or ''
+    if level > 1:
+        package = package.rsplit('.', level - 1)[0]
+    return f"{package}.{name}" if name else package
+
+
+class ImportProfiler:
+    _active = None
+
+    def __init__(self):
+        """
+        Times the imports of the process, like 'python -X importtime', but reported through the
+        logger of the run: the time of every module imported for the first time, with and without
+        the imports it made itself. Installed before the other imports of the script.
+        """
+        self.imports = {}
+        self.total = 0.0
+        self.ready_at = None
+        self.ready_total = 0.0
+        self.ready_count = 0
+        self._original = builtins.__import__
+        self._local = threading.local()
+
+    @classmethod
+    def install(cls):
+        """
+        Replaces the import function of the interpreter with the timed one, once per process.
+
+        :return: The active ImportProfiler.
+        """
+        if cls._active is None:
+            cls._active = cls()
+            builtins.__import__ = cls._active._import
+        return cls._active
+
+    @classmethod
+    def uninstall(cls):
+        """
+        Restores the import function of the interpreter.
+        """
+        if cls._active is not None:
+            builtins.__import__ = cls._active._original
+            cls._active = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        module_name = _module_name(name, globals, level)
+        if module_name in sys.modules:
+            return self._original(name, globals, locals, fromlist, level)
+        # Time of the imports nested in this one, per thread as phases import concurrently
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            else:
+                self.total += elapsed
+            if module_name in sys.modules and module_name not in self.imports:
+                self.imports[module_name] = (elapsed, elapsed - nested)
+
+    def ready(self):
+        """
+        Marks the end of the startup, when the run itself begins. Later imports are reported apart.
+        """
+        self.ready_at = time.perf_counter()
+        self.ready_total = self.total
+        self.ready_count = len(self.imports)
+
+    def report(self, started: float, limit: int = 10):
+        """
+        Logs the startup time, the time spent importing modules and the slowest imports.
+
+        :param started: The time.perf_counter() of the start of the script.
+        :param limit: The number of the slowest imports listed.
+        """
+        ready_at = self.ready_at or time.perf_counter()
+        ready_total = self.ready_total if self.ready_at else self.total
+        ready_count = self.ready_count if self.ready_at else len(self.imports)
+        logging.info(f"Startup profile: ready to run after {(ready_at - started) * 1000:.1f} ms, "
+                     f"{ready_total * 1000:.1f} ms of it importing {ready_count} modules; "
+                     f"{(self.total - ready_total) * 1000:.1f} ms more importing {len(self.imports) - ready_count} modules during the run")
+        slowest = sorted(self.imports.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+        for name, (cumulative, own) in slowest:
+            logging.info(f"Startup profile: import {name} took {cumulative * 1000:.1f} ms, {own * 1000:.1f} ms without its own imports")
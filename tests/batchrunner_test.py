@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+from argparse import Namespace
+from unittest.mock import MagicMock, patch
+from src.batch import BatchRunner, BatchResult
+
+
+HELM_LIST_ALL = (b'[{"name": "quixplatform-manager", "namespace": "quix-a", "revision": "3", "updated": "u", '
+                 b'"status": "deployed", "chart": "quixplatform-manager-1.5.4", "app_version": "1.5.4"}]')
+
+
+class TestBatchRunner(unittest.TestCase):
+    def setUp(self):
+        self.args = Namespace(release_name=None, namespace=None, repo=None, override=None, timeout="10m",
+                              action="batch", cache_dir=None, cache_max_size=None, parallel=2)
+
+    def _write_manifest(self, content):
+        tmp = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+        tmp.write(content)
+        tmp.close()
+        self.addCleanup(os.unlink, tmp.name)
+        return tmp.name
+
+    def test_from_manifest(self):
+        manifest = self._write_manifest(
+            "defaults:\n"
+            "  repo: myrepo:2.0.0\n"
+            "releases:\n"
+            "  - namespace: quix-a\n"
+            "  - namespace: quix-b\n"
+            "    repo: myrepo:2.1.0\n"
+            "    action: template\n"
+            "    output_dir: manifests/quix-b\n"
+        )
+        runner = BatchRunner.from_manifest(manifest, self.args)
+        self.assertEqual(runner.parallel, 2)
+        self.assertEqual([release.namespace for release in runner.releases], ["quix-a", "quix-b"])
+        self.assertEqual([release.repo for release in runner.releases], ["myrepo:2.0.0", "myrepo:2.1.0"])
+        self.assertEqual([release.action for release in runner.releases], ["update", "template"])
+        # CLI arguments are the fallback for settings the manifest does not set
+        self.assertEqual(runner.releases[0].timeout, "10m")
+
+    def test_from_manifest_discovery_backend(self):
+        manifest = self._write_manifest("releases:\n  - namespace: quix-a\n")
+        self.args.retries = 5
+        self.args.deadline = "10m"
+        runner = BatchRunner.from_manifest(manifest, self.args)
+        # The discovery retries and stops at the deadline of the CLI arguments
+        self.assertEqual(runner.backend.policy.retries, 5)
+        self.assertIsNotNone(runner.backend.deadline)
+
+    def test_from_manifest_template_needs_own_output_dir(self):
+        manifest = self._write_manifest("defaults:\n  output_dir: manifests\nreleases:\n  - namespace: quix-a\n    action: template\n")
+        self.assertEqual(BatchRunner.from_manifest(manifest, self.args).releases[0].output_dir, "manifests")
+        for releases in ("  - namespace: quix-a\n    action: template\n",
+                         "  - namespace: quix-a\n    action: template\n    output_dir: manifests\n"
+                         "  - namespace: quix-b\n    action: template\n    output_dir: ./manifests\n"):
+            manifest = self._write_manifest("releases:\n" + releases)
+            with self.assertRaises(ValueError):
+                BatchRunner.from_manifest(manifest, self.args)
+
+    def test_from_manifest_without_releases(self):
+        manifest = self._write_manifest("defaults: {}\n")
+        with self.assertRaises(ValueError):
+            BatchRunner.from_manifest(manifest, self.args)
+
+    @patch('src.batch.HelmManager')
+    def test_run_discovers_once_and_reports(self, mock_helm_manager):
+        mock_helm_manager._check_result.side_effect = lambda result: result
+        backend = MagicMock()
+        backend.list.return_value = MagicMock(stdout=HELM_LIST_ALL)
+        failing = MagicMock()
+        failing.run.side_effect = SystemExit(1)
+        mock_helm_manager.side_effect = lambda release, snapshot, deployment: failing if release.namespace == "quix-b" else MagicMock()
+        releases = [Namespace(release_name=None, namespace=namespace, repo="myrepo:2.0.0", override=None, timeout=None,
+                              action="update", cache_dir=None, cache_max_size=None) for namespace in ("quix-a", "quix-b")]
+        runner = BatchRunner(releases, parallel=2, backend=backend)
+
+        exit_code = runner.run()
+
+        self.assertEqual(exit_code, 1)
+        backend.list.assert_called_once_with(all_namespaces=True)
+        mock_helm_manager._check_result.assert_called_once_with(backend.list.return_value)
+        snapshots = {call.args[0].namespace: call.kwargs["snapshot"] for call in mock_helm_manager.call_args_list}
+        self.assertTrue(snapshots["quix-a"].exists)
+        self.assertEqual(snapshots["quix-a"].chart_version, "1.5.4")
+        self.assertFalse(snapshots["quix-b"].found)
+        # Every release works in its own directory
+        directories = {call.kwargs["deployment"].get_dir() for call in mock_helm_manager.call_args_list}
+        self.assertEqual(len(directories), 2)
+
+    def test_format_results(self):
+        succeeded = BatchResult("quix-a", "quixplatform-manager", "update")
+        succeeded.succeeded = True
+        failed = BatchResult("quix-b", "quixplatform-manager", "update")
+        failed.error = "boom"
+        lines = BatchRunner.format_results([succeeded, failed])
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith("NAMESPACE"))
+        self.assertIn("succeeded", lines[1])
+        self.assertTrue(lines[2].endswith("boom"))
+
+
+if __name__ == '__main__':
+    unittest.main()
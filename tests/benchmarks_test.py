@@ -0,0 +1,56 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from benchmarks.fake_helm import write_fixtures
+from benchmarks.run import compare, main
+from benchmarks.values_generator import derive_release_values, generate_values
+from src.helm_manager import FileManager
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_generate_values(self):
+        values = generate_values(size_kb=20, depth=3, list_length=2, seed=7)
+        self.assertEqual(values, generate_values(size_kb=20, depth=3, list_length=2, seed=7))
+        self.assertAlmostEqual(len(FileManager.dump_values(values)) / 1024, 20, delta=5)
+        self.assertEqual(values['image']['tag'], '1.0.0')
+        release = derive_release_values(values)
+        self.assertEqual(release['image']['tag'], '0.9.0')
+        self.assertEqual(values['image']['tag'], '1.0.0')
+
+    def test_fake_helm(self):
+        with tempfile.TemporaryDirectory() as directory:
+            helm_bin = write_fixtures(os.path.join(directory, "fixtures"), "image:\n  tag: 1.0.0\n", {"image": {"tag": "0.9.0"}}, "kind: ConfigMap\n")
+            listed = subprocess.run([helm_bin, 'list', '--output', 'json'], capture_output=True, check=True)
+            self.assertEqual(json.loads(listed.stdout)[0]['status'], 'deployed')
+            subprocess.run([helm_bin, 'pull', 'oci://registry/helm/quixplatform-manager', '--version', '1.0.0', '--destination', directory], check=True)
+            self.assertTrue(os.path.isfile(os.path.join(directory, "quixplatform-manager-1.0.0.tgz")))
+            rendered = subprocess.run([helm_bin, 'template', 'release', 'chart', '--values', '-'], input=b"key: value\n", capture_output=True, check=True)
+            self.assertEqual(rendered.stdout, b"kind: ConfigMap\n")
+
+    def test_compare(self):
+        baseline = {'results': {'fast': {'median': 1.0}, 'slow': {'median': 1.0}}}
+        results = {'results': {'fast': {'median': 1.1}, 'slow': {'median': 1.5}, 'new': {'median': 1.0}}}
+        lines, regressions = compare(results, baseline, threshold=0.2)
+        self.assertEqual(regressions, ['slow'])
+        self.assertEqual(len(lines), 4)
+
+    def test_main_offline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.json")
+            arguments = ['--size-kb', '10', '--repeat', '1', '--latency', '0', '--output', output]
+            self.assertEqual(main(arguments), 0)
+            with open(output) as f:
+                results = json.load(f)
+            self.assertIn('e2e.update', results['results'])
+            self.assertIn('micro.yaml_merger_merge', results['results'])
+            self.assertEqual(main(arguments[:-2] + ['--filter', 'micro', '--compare', output, '--threshold', '1000']), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
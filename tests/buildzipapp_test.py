@@ -0,0 +1,42 @@
+import os
+import sys
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from tools.build_zipapp import build
+
+
+class TestBuildZipapp(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.output = os.path.join(self.tmp.name, "quix-manager.pyz")
+
+    def test_build(self):
+        names = build(self.output)
+        self.assertIn("__main__.py", names)
+        self.assertIn("__main__.pyc", names)
+        self.assertIn("src/helm_manager.pyc", names)
+        self.assertNotIn("src/requirements.txt", names)
+
+        # The bytecode is imported from the archive, without writing any cache
+        env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+        check = "import sys; sys.path.insert(0, sys.argv[1]); import src.helm_manager as m; print(type(m.__loader__).__name__)"
+        result = subprocess.run([sys.executable, "-c", check, self.output], capture_output=True, env=env, cwd=self.tmp.name)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertTrue(result.stdout.startswith(b"zipimporter"))
+
+        result = subprocess.run([sys.executable, self.output, "--help"], capture_output=True, cwd=self.tmp.name)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn(b"--startup-profile", result.stdout)
+
+    def test_build_sources_only(self):
+        names = build(self.output, compile_bytecode=False)
+        self.assertFalse([name for name in names if name.endswith(".pyc")])
+        self.assertEqual(os.listdir(self.tmp.name), ["quix-manager.pyz"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+from src.chart_cache import ChartCache, ManifestCache, file_digest
+
+
+class TestChartCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache = ChartCache(os.path.join(self.tmp.name, "cache"))
+
+    def _make_chart(self, name, content=b"archive"):
+        archive = os.path.join(self.tmp.name, f"{name}.tgz")
+        with open(archive, "wb") as f:
+            f.write(content)
+        return archive, b"image:\n  tag: 1.0.0\n"
+
+    def test_lookup_miss(self):
+        self.assertIsNone(self.cache.lookup("myrepo", "1.0.0"))
+
+    def test_store_and_lookup(self):
+        archive, values = self._make_chart("chart")
+        self.cache.store("myrepo", "1.0.0", archive=archive, values=values)
+        entry = self.cache.lookup("myrepo", "1.0.0")
+        self.assertIsNotNone(entry)
+        self.assertEqual(self.cache.read_values(entry), b"image:\n  tag: 1.0.0\n")
+        self.assertEqual(file_digest(self.cache.archive_path(entry)), file_digest(archive))
+        # Another version of the same repo is a different entry
+        self.assertIsNone(self.cache.lookup("myrepo", "1.0.1"))
+
+    def test_lookup_discards_corrupted_entry(self):
+        archive, values = self._make_chart("chart")
+        entry = self.cache.store("myrepo", "1.0.0", archive=archive, values=values)
+        with open(self.cache.archive_path(entry), "wb") as f:
+            f.write(b"tampered")
+        self.assertIsNone(self.cache.lookup("myrepo", "1.0.0"))
+        self.assertFalse(os.path.exists(entry))
+
+    def test_evict_least_recently_used(self):
+        self.cache.max_bytes = 150
+        first = self.cache.store("myrepo", "1.0.0", *self._make_chart("first", b"x" * 40))
+        second = self.cache.store("myrepo", "2.0.0", *self._make_chart("second", b"y" * 40))
+        # Make the first entry the oldest one
+        os.utime(os.path.join(first, ChartCache.META_NAME), (0, 0))
+        os.utime(os.path.join(second, ChartCache.META_NAME), (10, 10))
+        self.cache.store("myrepo", "3.0.0", *self._make_chart("third", b"z" * 40))
+        self.assertIsNone(self.cache.lookup("myrepo", "1.0.0"))
+        self.assertIsNotNone(self.cache.lookup("myrepo", "3.0.0"))
+
+
+class TestManifestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache = ManifestCache(self.tmp.name)
+
+    def _store(self, key, manifests):
+        with self.cache.writer(key) as write:
+            write(manifests)
+
+    def _read(self, key):
+        f = self.cache.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def test_store_and_open(self):
+        key = ManifestCache.key("sha256:chart", "sha256:values", "release", "namespace", "v3.16.0")
+        self.assertIsNone(self._read(key))
+        self._store(key, b"kind: ConfigMap\n")
+        self.assertEqual(self._read(key), b"kind: ConfigMap\n")
+        # Any other input is another render
+        self.assertIsNone(self._read(ManifestCache.key("sha256:chart", "sha256:values", "release", "namespace", "v3.17.0")))
+
+    def test_evict_least_recently_used(self):
+        self.cache.max_bytes = 100
+        self._store("first", b"x" * 40)
+        self._store("second", b"y" * 40)
+        os.utime(self.cache._path("first"), (0, 0))
+        os.utime(self.cache._path("second"), (10, 10))
+        self._store("third", b"z" * 40)
+        self.assertIsNone(self._read("first"))
+        self.assertIsNotNone(self._read("second"))
+        self.assertIsNotNone(self._read("third"))
+
+    def test_writer(self):
+        with self.cache.writer("streamed") as write:
+            write(b"kind: ConfigMap\n")
+            write(b"kind: Secret\n")
+        with self.cache.open("streamed") as f:
+            self.assertEqual(list(f), [b"kind: ConfigMap\n", b"kind: Secret\n"])
+        # An interrupted render is not stored
+        with self.assertRaises(RuntimeError):
+            with self.cache.writer("interrupted") as write:
+                write(b"kind: ConfigMap\n")
+                raise RuntimeError("helm failed")
+        self.assertIsNone(self.cache.open("interrupted"))
+        self.assertEqual(sorted(os.listdir(self.cache.manifests_dir)), ["streamed.yaml"])
+
+
+if __name__ == '__main__':
+    unittest.main()
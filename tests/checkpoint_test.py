@@ -0,0 +1,123 @@
+import os
+import sys
+import tempfile
+import unittest
+from argparse import Namespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from benchmarks.fake_helm import write_fixtures
+from src.checkpoint import Checkpoint, prune_checkpoints
+from src.helm_backend import SubprocessBackend
+from src.helm_manager import DeploymentManager, HelmManager
+from src.helm_runner import HelmResult, HelmRunner
+
+
+class FlakyBackend(SubprocessBackend):
+    """Runs the stub helm binary, counting the operations and failing the upgrades while asked to."""
+    def __init__(self, runner):
+        super().__init__(runner)
+        self.operations = []
+        self.fail_upgrade = False
+
+    def _call(self, operation, helm_args, artifacts=None, **kwargs):
+        self.operations.append(operation)
+        if operation == 'upgrade' and self.fail_upgrade:
+            return HelmResult(['helm'] + helm_args, 1, stderr=b"Error: UPGRADE FAILED: context deadline exceeded")
+        return super()._call(operation, helm_args, artifacts=artifacts, **kwargs)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.directory = os.path.join(self.tmp.name, "checkpoint")
+        self.inputs = {'release': 'quixplatform-manager', 'version': '1.0.0'}
+
+    def test_save_and_load(self):
+        checkpoint = Checkpoint(self.directory, self.inputs)
+        self.assertEqual(checkpoint.load(), [])
+        checkpoint.save("values", data={'revision': 3}, blobs={'values.json': b"{}"})
+        source = os.path.join(self.tmp.name, "chart.tgz")
+        with open(source, "wb") as f:
+            f.write(b"archive")
+        checkpoint.save("chart", files={'chart.tgz': source})
+
+        resumed = Checkpoint(self.directory, self.inputs)
+        self.assertEqual(resumed.load(), ["chart", "values"])
+        self.assertEqual(resumed.get("values")['revision'], 3)
+        self.assertEqual(resumed.read('chart.tgz'), b"archive")
+        self.assertIsNone(resumed.get("merged"))
+
+    def test_damaged_blob(self):
+        Checkpoint(self.directory, self.inputs).save("values", blobs={'values.json': b"{}"})
+        with open(os.path.join(self.directory, "values.json"), "wb") as f:
+            f.write(b"{\"truncated")
+        checkpoint = Checkpoint(self.directory, self.inputs)
+        self.assertEqual(checkpoint.load(), ["values"])
+        self.assertIsNone(checkpoint.get("values"))
+
+    def test_other_inputs_or_expired(self):
+        Checkpoint(self.directory, self.inputs).save("values", blobs={'values.json': b"{}"})
+        self.assertEqual(Checkpoint(self.directory, dict(self.inputs, version='2.0.0')).load(), [])
+        self.assertFalse(os.path.exists(self.directory))
+
+        Checkpoint(self.directory, self.inputs).save("values", blobs={'values.json': b"{}"})
+        self.assertEqual(Checkpoint(self.directory, self.inputs, ttl=-1).load(), [])
+        self.assertFalse(os.path.exists(self.directory))
+
+    def test_prune_expired(self):
+        root = os.path.join(self.tmp.name, DeploymentManager.CHECKPOINTS_DIR)
+        Checkpoint(os.path.join(root, "old"), self.inputs).save("values", blobs={'values.json': b"{}"})
+        Checkpoint(os.path.join(root, "recent"), self.inputs).save("values", blobs={'values.json': b"{}"})
+        past = os.path.getmtime(os.path.join(root, "old", Checkpoint.STATE_NAME)) - 7200
+        os.utime(os.path.join(root, "old", Checkpoint.STATE_NAME), (past, past))
+        self.assertEqual(oct(os.stat(os.path.join(root, "recent")).st_mode & 0o777), oct(0o700))
+
+        self.assertEqual(prune_checkpoints(root), 1)
+        self.assertEqual(os.listdir(root), ["recent"])
+        self.assertEqual(prune_checkpoints(os.path.join(self.tmp.name, "missing")), 0)
+
+        # Every run prunes the checkpoints of its temporary directory
+        os.utime(os.path.join(root, "recent", Checkpoint.STATE_NAME), (past, past))
+        deployment = DeploymentManager(tempdir=self.tmp.name)
+        deployment.setup()
+        self.addCleanup(deployment.cleanup)
+        self.assertEqual(os.listdir(root), [])
+
+    def test_update_resumes_after_failed_upgrade(self):
+        helm_bin = write_fixtures(os.path.join(self.tmp.name, "fixtures"), "global:\n  byocZipVersion: 1.0.0\nimage:\n  tag: 1.0.0\n",
+                                  {"global": {"byocZipVersion": "0.9.0"}, "image": {"tag": "0.9.0"}}, "kind: ConfigMap\n")
+        backend = FlakyBackend(HelmRunner(helm_bin))
+        args = Namespace(action="update", release_name="quixplatform-manager", namespace="quix", timeout=None, override=None,
+                         repo="registry/helm/quixplatform-manager:1.0.0", force=True, resume=True)
+        tempdir = os.path.join(self.tmp.name, "runs")
+        checkpoint_dir = DeploymentManager(tempdir=tempdir).checkpoint_dir("quix-quixplatform-manager")
+
+        backend.fail_upgrade = True
+        with self.assertRaises(SystemExit):
+            HelmManager(args, deployment=DeploymentManager(tempdir=tempdir), backend=backend).run()
+        self.assertTrue(os.path.isfile(os.path.join(checkpoint_dir, Checkpoint.STATE_NAME)))
+
+        # The retry only checks the release and upgrades it
+        backend.fail_upgrade = False
+        backend.operations = []
+        manager = HelmManager(args, deployment=DeploymentManager(tempdir=tempdir), backend=backend)
+        manager.run()
+        self.assertEqual(backend.operations, ['list', 'upgrade'])
+        self.assertEqual(manager.current_values["image"]["tag"], "0.9.0")
+        self.assertFalse(os.path.exists(checkpoint_dir))
+
+        # Without resume nothing is written to disk and every phase runs again
+        args.resume = False
+        backend.fail_upgrade = True
+        with self.assertRaises(SystemExit):
+            HelmManager(args, deployment=DeploymentManager(tempdir=tempdir), backend=backend).run()
+        self.assertFalse(os.path.exists(checkpoint_dir))
+        backend.fail_upgrade = False
+        backend.operations = []
+        HelmManager(args, deployment=DeploymentManager(tempdir=tempdir), backend=backend).run()
+        self.assertEqual(sorted(backend.operations), ['get_values', 'list', 'pull', 'upgrade'])
+
+
+if __name__ == '__main__':
+    unittest.main()
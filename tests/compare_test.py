@@ -0,0 +1,62 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from tools.compare import compact, diff_values, iter_values, main, MAX_INLINE
+
+
+class TestCompare(unittest.TestCase):
+
+    def test_iter_values(self):
+        values = list(iter_values("a:\n  b: 1\n  c: [x, {}]\nd: {}\ne: '2'\nf: 'plain'\n"))
+        self.assertEqual(values, [
+            ('a.b', '1'), ('a.c[0]', 'x'), ('a.c[1]', '{}'), ('d', '{}'), ('e', '"2"'), ('f', 'plain'),
+        ])
+
+    def test_iter_values_names_documents(self):
+        stream = (
+            "apiVersion: v1\nmetadata:\n  name: web\nkind: Service\n"
+            "---\n"
+            "---\n"
+            "apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: web\n"
+            "---\n"
+            "plain: document\n"
+        )
+        values = list(iter_values(stream))
+        self.assertIn(('Service/web:apiVersion', 'v1'), values)
+        self.assertIn(('ConfigMap/web:metadata.name', 'web'), values)
+        self.assertIn(('document[3]:plain', 'document'), values)
+        self.assertEqual(len(values), 7)
+
+    def test_diff_values(self):
+        old = [('a', '1'), ('b', '2'), ('c', '3')]
+        new = [('c', '4'), ('b', '2'), ('d', '5')]
+        self.assertEqual(diff_values(iter(old), iter(new)), {
+            'added': [{'path': 'd', 'value': '5'}],
+            'removed': [{'path': 'a', 'value': '1'}],
+            'changed': [{'path': 'c', 'old': '3', 'new': '4'}],
+        })
+
+    def test_compact(self):
+        self.assertEqual(compact("short"), "short")
+        self.assertTrue(compact("x" * (MAX_INLINE + 1)).startswith("sha256:"))
+        self.assertNotEqual(compact("x" * (MAX_INLINE + 1)), compact("y" * (MAX_INLINE + 1)))
+
+    def test_main_exit_code(self):
+        with tempfile.TemporaryDirectory() as directory:
+            old_path, new_path, report = (os.path.join(directory, name) for name in ("old.yaml", "new.yaml", "report.json"))
+            with open(old_path, 'w') as f:
+                f.write("a: 1\n")
+            with open(new_path, 'w') as f:
+                f.write("a: 1\n")
+            self.assertEqual(main([old_path, new_path, '--output', report]), 0)
+            with open(new_path, 'w') as f:
+                f.write("a: 2\n")
+            self.assertEqual(main([old_path, new_path, '--output', report]), 1)
+            self.assertEqual(main([old_path, os.path.join(directory, "missing.yaml")]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
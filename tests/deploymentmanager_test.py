@@ -1,28 +1,96 @@
+import os
+import tempfile
+import threading
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from src.helm_manager import DeploymentManager
+from src.retry import Deadline, DeadlineExceeded
 
 class TestDeploymentManager(unittest.TestCase):
     def setUp(self):
-        self.tempdir = "./tmp_test"
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tempdir = os.path.join(tmp.name, "tmp_test")
         self.deployment_manager = DeploymentManager(tempdir=self.tempdir)
-    
+
     def test_get_dir(self):
         # Act
         directory = self.deployment_manager.get_dir()
         # Assert
         self.assertEqual(directory, self.tempdir, "get_dir should return the initialized temporary directory")
-    
+
     def test_setup_calls_create_folder_and_returns_true(self):
-        # Arrange: Replace file_manager with a mock
-        self.deployment_manager.file_manager = MagicMock()
-        
+        # Arrange: Spy on file_manager
+        self.deployment_manager.file_manager = MagicMock(wraps=self.deployment_manager.file_manager)
+
         # Act
         result = self.deployment_manager.setup()
-        
+
         # Assert: Verify that create_folder was called with the correct directory
         self.deployment_manager.file_manager.create_folder.assert_called_once_with(self.tempdir)
         self.assertTrue(result, "setup should return True after creating the folder")
 
+    def test_setup_creates_a_workspace_per_run(self):
+        other = DeploymentManager(tempdir=self.tempdir)
+        self.deployment_manager.setup()
+        other.setup()
+        workspace = self.deployment_manager.get_dir()
+        self.assertTrue(os.path.isdir(workspace))
+        self.assertEqual(os.path.dirname(workspace), self.tempdir)
+        self.assertNotEqual(workspace, other.get_dir())
+
+        self.deployment_manager.cleanup()
+        self.assertFalse(os.path.exists(workspace))
+        self.assertTrue(os.path.isdir(other.get_dir()))
+        other.cleanup()
+
+    def test_tmpfs_falls_back_to_tempdir(self):
+        with patch('src.helm_manager.TMPFS_DIR', os.path.join(self.tempdir, "missing")):
+            deployment_manager = DeploymentManager(tempdir=self.tempdir, tmpfs=True)
+        self.assertEqual(deployment_manager.get_dir(), self.tempdir)
+
+    def test_lock_serializes_the_same_name_only(self):
+        other = DeploymentManager(tempdir=self.tempdir)
+        events = []
+
+        def run_on_same_release():
+            with other.lock("quix-release"):
+                events.append("same")
+
+        with self.deployment_manager.lock("quix-release"):
+            # Another name is not blocked
+            with other.lock("quix-other"):
+                events.append("other")
+            thread = threading.Thread(target=run_on_same_release)
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            events.append("released")
+        thread.join(5)
+        self.assertEqual(events, ["other", "released", "same"])
+
+    def test_lock_wait_bounded_by_deadline(self):
+        other = DeploymentManager(tempdir=self.tempdir)
+        with self.deployment_manager.lock("quix-release"):
+            with self.assertRaises(DeadlineExceeded):
+                with other.lock("quix-release", Deadline(0.3)):
+                    self.fail("the lock is held by another run")
+        # Released within the deadline, the lock is taken
+        held, events = threading.Event(), []
+
+        def hold():
+            with self.deployment_manager.lock("quix-release"):
+                held.set()
+                threading.Event().wait(0.3)
+                events.append("released")
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        held.wait(5)
+        with other.lock("quix-release", Deadline(5)):
+            events.append("acquired")
+        self.assertEqual(events, ["released", "acquired"])
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,4 @@
-import unittest
-from src.helm_manager import FileManager
+from src.helm_manager import FileManager, load_yaml
 import os
 import tarfile
 import tempfile
@@ -54,6 +53,24 @@ class TestFileManager(unittest.TestCase):
                 content = f.read()
             self.assertEqual(content, file_content)
 
+    def test_read_from_tgz(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            # Build a chart-like archive with values.yaml next to other files.
+            chart_dir = os.path.join(tmpdirname, "chart")
+            os.makedirs(os.path.join(chart_dir, "templates"))
+            with open(os.path.join(chart_dir, "values.yaml"), "w") as f:
+                f.write("image:\n  tag: 1.0.0\n")
+            with open(os.path.join(chart_dir, "templates", "deployment.yaml"), "w") as f:
+                f.write("kind: Deployment\n")
+            archive_path = os.path.join(tmpdirname, "chart.tgz")
+            with tarfile.open(archive_path, "w:gz") as tar:
+                tar.add(chart_dir, arcname="chart")
+
+            content = FileManager.read_from_tgz(archive_path, "chart/values.yaml")
+            self.assertEqual(content, b"image:\n  tag: 1.0.0\n")
+            with self.assertRaises(FileNotFoundError):
+                FileManager.read_from_tgz(archive_path, "chart/missing.yaml")
+
     def test_copy_and_rename(self):
         with tempfile.TemporaryDirectory() as tmpdirname:
             # Create a source file.
@@ -95,5 +112,22 @@ class TestFileManager(unittest.TestCase):
             with open(file_path, "r") as f:
                 loaded = yaml.safe_load(f)
             self.assertEqual(loaded, data)
+    def test_dump_values_matches_pure_python_dumper(self):
+        # The libyaml dumper, when available, must emit exactly what the pure Python dumper emits
+        data = {
+            'global': {'byocZipVersion': '2.0', 'flags': [True, None, 1.5]},
+            'script': 'line1\nline2\n',
+            'trailing': 'text \nmore\n',
+            'unicode': 'héllo ✓\nsecond',
+            'long': 'word ' * 40,
+            'quoted': "it's: yes",
+        }
+        # The custom string presenter is added to every dumper on the first dump
+        dumped = FileManager.dump_values(data)
+        expected = yaml.dump(data, Dumper=yaml.Dumper, default_flow_style=False, sort_keys=False)
+        self.assertEqual(dumped, expected)
+        self.assertIn("script: |\n  line1\n  line2\n", expected)
+        self.assertEqual(load_yaml(expected), data)
+
 if __name__ == '__main__':
     unittest.main()
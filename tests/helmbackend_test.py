@@ -0,0 +1,106 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from argparse import Namespace
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from benchmarks.fake_helm import write_fixtures
+from src.helm_backend import HelmBackend, RecordingBackend, ReplayBackend, SubprocessBackend
+from src.helm_manager import DeploymentManager, HelmManager
+from src.helm_runner import HelmResult, HelmRunner
+
+
+class ArgsBackend(HelmBackend):
+    def __init__(self):
+        self.calls = []
+
+    def run(self, helm_args, **kwargs):
+        self.calls.append((helm_args, kwargs))
+        return HelmResult(['helm'] + helm_args, 0)
+
+
+class TestHelmBackend(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.helm_bin = write_fixtures(os.path.join(self.directory.name, "fixtures"), "global:\n  byocZipVersion: 1.0.0\nimage:\n  tag: 1.0.0\n",
+                                       {"global": {"byocZipVersion": "0.9.0"}, "image": {"tag": "0.9.0"}}, "kind: ConfigMap\n")
+        self.recording = os.path.join(self.directory.name, "helm.jsonl")
+
+    def _run(self, backend, action="template"):
+        args = Namespace(action=action, release_name="quixplatform-manager", namespace="quix", timeout=None, override=None,
+                         repo="registry/helm/quixplatform-manager:1.0.0", force=True,
+                         output_dir=os.path.join(self.directory.name, "manifests"))
+        deployment = DeploymentManager(tempdir=os.path.join(self.directory.name, "runs"))
+        manager = HelmManager(args, deployment=deployment, backend=backend)
+        manager.run()
+        return manager
+
+    def test_operations_arguments(self):
+        backend = ArgsBackend()
+        backend.list("release", namespace="quix")
+        backend.list(all_namespaces=True)
+        backend.get_values("release")
+        backend.pull("registry/helm/chart", "1.0.0", "/tmp/run")
+        backend.upgrade("release", ["/tmp/run/chart-1.0.0.tgz"], b"a: 1\n", namespace="quix", timeout="5m")
+        backend.rollback("release", "3", namespace="quix")
+        self.assertEqual([call[0] for call in backend.calls], [
+            ['list', '--all', '--filter', '^release$', '--output', 'json', '--namespace', 'quix'],
+            ['list', '--all-namespaces', '--all', '--max', '0', '--output', 'json'],
+            ['get', 'values', 'release', '--output', 'json'],
+            ['pull', 'oci://registry/helm/chart', '--version', '1.0.0', '--destination', '/tmp/run'],
+            ['upgrade', '--install', 'release', '/tmp/run/chart-1.0.0.tgz', '--values', '-', '--namespace', 'quix', '--timeout', '5m'],
+            ['rollback', 'release', '3', '--namespace', 'quix'],
+        ])
+        self.assertEqual(backend.calls[4][1], {'stdin': b"a: 1\n"})
+
+    def test_record_and_replay(self):
+        recorded = self._run(RecordingBackend(SubprocessBackend(HelmRunner(self.helm_bin)), self.recording))
+        with open(self.recording) as f:
+            records = [json.loads(line) for line in f]
+        # get values and pull run concurrently
+        self.assertEqual(sorted(record['operation'] for record in records), ['get_values', 'list', 'pull', 'template'])
+        pull = next(record for record in records if record['operation'] == 'pull')
+        self.assertEqual(pull['args'][-1], '<destination>')
+        self.assertIn('quixplatform-manager-1.0.0.tgz', pull['artifacts'])
+        self.assertTrue(all(record['duration'] > 0 for record in records))
+        self.assertEqual(os.stat(self.recording).st_mode & 0o777, 0o600)
+
+        # The replay runs no helm at all, from another workspace
+        with patch('src.helm_manager.HELM_RUNNER.run_sync', side_effect=AssertionError("helm was run")):
+            replayed = self._run(ReplayBackend(self.recording))
+        self.assertEqual(replayed.merged_values, recorded.merged_values)
+        self.assertEqual(replayed.chart_digest, recorded.chart_digest)
+
+    def test_replay_order_and_misses(self):
+        backend = RecordingBackend(ArgsBackend(), self.recording)
+        backend.status("release")
+        backend.backend.run = lambda helm_args, **kwargs: HelmResult(['helm'] + helm_args, 1, stderr=b"Error: not found")
+        backend.status("release")
+
+        replay = ReplayBackend(self.recording)
+        self.assertTrue(replay.status("release").ok)
+        self.assertEqual(replay.status("release").stderr, b"Error: not found")
+        # The last response is served again once the recorded ones are used up
+        self.assertFalse(replay.status("release").ok)
+        missing = replay.status("other")
+        self.assertEqual(missing.returncode, 1)
+        self.assertIn(b"no recorded response", missing.stderr)
+
+    def test_replay_streams_stdout(self):
+        backend = RecordingBackend(SubprocessBackend(HelmRunner(self.helm_bin)), self.recording)
+        backend.template("release", ["chart.tgz"], b"a: 1\n")
+        lines = []
+        result = ReplayBackend(self.recording).template("release", ["chart.tgz"], b"a: 1\n")
+        self.assertEqual(result.stdout, b"kind: ConfigMap\n")
+        self.assertFalse(ReplayBackend(self.recording).template("release", ["chart.tgz"], b"a: 2\n").ok)
+        result = ReplayBackend(self.recording)._call('template', ['template', 'release', 'chart.tgz', '--values', '-'], stdin=b"a: 1\n",
+                                                      capture_stdout=False, on_stdout_line=lines.append)
+        self.assertEqual((result.stdout, lines), (b"", [b"kind: ConfigMap\n"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,30 @@
 import os
+import json
+import contextlib
 import sys
 import tarfile
 import tempfile
 import unittest
 from argparse import Namespace
 from unittest.mock import MagicMock, patch
-from src.helm_manager import HelmManager
+from src.chart_cache import file_digest
+from src.helm_manager import DeploymentManager, HelmManager
+from src.helm_runner import HelmCommandError, HelmResult
+from src.release import ReleaseInfo, ReleaseSnapshot, Revision
+
+
+def helm_result(stdout=b"", returncode=0, stderr=b""):
+    return HelmResult(['helm'], returncode, stdout, stderr)
+
+
+def streamed_result(stdout=b"", returncode=0):
+    """Mimics HelmRunner.run streaming its standard output to on_stdout_line."""
+    def run(helm_args, capture_stdout=True, on_stdout_line=None, **kwargs):
+        if on_stdout_line:
+            for line in stdout.splitlines(keepends=True):
+                on_stdout_line(line)
+        return HelmResult(['helm'] + helm_args, returncode, stdout if capture_stdout else b"")
+    return run
 
 
 class TestHelmManager(unittest.TestCase):
@@ -19,14 +38,18 @@ class TestHelmManager(unittest.TestCase):
             repo=None,
             action="update"
         )
-        # Patch subprocess.run (used in _run_helm_with_args) so that external helm/kubectl commands are not executed.
-        self.run_patch = patch('src.helm_manager.subprocess.run')
+        # Patch the helm runner (behind the default backend) so that external helm/kubectl commands are not executed.
+        self.run_patch = patch('src.helm_manager.HELM_RUNNER.run_sync')
         self.mock_run = self.run_patch.start()
         # Simulate a successful helm command with a dummy output.
-        mock_result = MagicMock(stdout=b"HEADER\n")
-        mock_result.returncode = 0
-        self.mock_run.return_value = mock_result
+        self.mock_run.return_value = helm_result(b"[]")
         self.addCleanup(self.run_patch.stop)
+        # The runs keep their workspace, locks and checkpoints out of the repository
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        tempdir_patch = patch.object(DeploymentManager, 'DEFAULT_TEMPDIR', tmp.name)
+        tempdir_patch.start()
+        self.addCleanup(tempdir_patch.stop)
 
     def test_init_override_invalid(self):
         """Test that providing an invalid override file causes sys.exit."""
@@ -40,8 +63,8 @@ class TestHelmManager(unittest.TestCase):
             tmp.write(b"dummy")
             tmp.flush()
             self.args.override = tmp.name
-            # Patch _get_remote_version so that __init__ does not try to run helm commands.
-            with patch.object(HelmManager, "_get_remote_version", return_value="1.0.0"):
+            # Patch _get_snapshot so that __init__ does not try to run helm commands.
+            with patch.object(HelmManager, "_get_snapshot", return_value=ReleaseSnapshot("test", "1.0.0", 1, "deployed")):
                 hm = HelmManager(self.args)
                 self.assertEqual(hm.override_path, tmp.name)
         os.unlink(tmp.name)
@@ -62,15 +85,23 @@ class TestHelmManager(unittest.TestCase):
 
     def test_init_no_repo(self):
         """
-        Test that if repo is not provided, _get_remote_version is used and the default repo is set.
+        Test that if repo is not provided, the version comes from the release snapshot and the default repo is set.
         In this case, since our dummy helm output doesn't contain the release name,
-        _check_if_exists returns False and version becomes None.
+        the release does not exist and version becomes None.
         """
         self.args.repo = None
-        with patch.object(HelmManager, "_get_remote_version", return_value="9.9.9"):
-            hm = HelmManager(self.args)
-            self.assertEqual(hm.repo, "quixcontainerregistry.azurecr.io/helm/quixplatform-manager")
-            self.assertEqual(hm.version, None)
+        hm = HelmManager(self.args)
+        self.assertEqual(hm.repo, "quixcontainerregistry.azurecr.io/helm/quixplatform-manager")
+        self.assertEqual(hm.version, None)
+
+    def test_no_repo_existing_release(self):
+        """Test that without a repo the version of the deployed chart is used, read by the check state."""
+        self.args.repo = None
+        hm = HelmManager(self.args)
+        self.assertIsNone(hm.version)
+        with patch.object(HelmManager, "_get_snapshot", return_value=ReleaseSnapshot("test", "9.9.9", 2, "deployed")):
+            hm._check_release()
+        self.assertEqual(hm.version, "9.9.9")
 
     def test_extract_version_and_format_valid(self):
         """Test _extract_version_and_format with a valid repository string."""
@@ -81,98 +112,106 @@ class TestHelmManager(unittest.TestCase):
         self.assertEqual(version, "1.2.3")
 
     def test_get_values(self):
-        """Test _get_values returns the expected helm values output."""
-        with patch.object(HelmManager, "_get_remote_version", return_value="1.0.0"):
+        """Test _get_values decodes the JSON values of the release."""
+        with patch.object(HelmManager, "_get_snapshot", return_value=ReleaseSnapshot("test", "1.0.0", 1, "deployed")):
             hm = HelmManager(self.args)
-            dummy_output = b"key: value\nanother: test"
-            self.mock_run.return_value = MagicMock(stdout=dummy_output, returncode=0)
+            dummy_output = b'{"key": "value", "another": {"nested": "test"}}'
+            self.mock_run.return_value = helm_result(dummy_output)
             values = hm._get_values("test")
-            self.assertEqual(values, "key: value\nanother: test")
-
-    def test_extract_version_from_stdout(self):
-        """Test that _extract_version_from_stdout extracts the version correctly."""
-        self.args.repo = "dummy:0.0.1"
-        with patch.object(HelmManager, "_get_remote_version", return_value="0.0.1"):
-            hm = HelmManager(self.args)
-            # Provide an output with at least 9 whitespace-separated fields.
-            helm_output = "a b c d e f g h chart-1.2.3"
-            version = hm._extract_version_from_stdout(helm_output)
-            self.assertEqual(version, "1.2.3")
+            self.assertEqual(values, {"key": "value", "another": {"nested": "test"}})
+            self.mock_run.assert_called_with(
+                ['get', 'values', 'test', '--output', 'json', '--namespace', 'default'])
+            # Releases without user-supplied values print null
+            self.mock_run.return_value = helm_result(b"null")
+            self.assertEqual(hm._get_values("test"), {})
 
     def test_check_remote_chart(self):
-        """Test that _check_remote_chart returns helm output without the header."""
-        with patch.object(HelmManager, "_get_remote_version", return_value="1.0.0"):
+        """Test that _check_remote_chart decodes the helm list JSON output."""
+        with patch.object(HelmManager, "_get_snapshot", return_value=ReleaseSnapshot("test", "1.0.0", 1, "deployed")):
             hm = HelmManager(self.args)
-            dummy_output = b"HEADER\nline1\nline2"
-            self.mock_run.return_value = MagicMock(stdout=dummy_output, returncode=0)
+            dummy_output = (b'[{"name": "test", "namespace": "default", "revision": "3", '
+                            b'"updated": "2024-01-01 10:00:00.0 +0000 UTC", "status": "deployed", '
+                            b'"chart": "quixplatform-manager-1.5.4-rc.1", "app_version": "1.5.4"}]')
+            self.mock_run.return_value = helm_result(dummy_output)
             result = hm._check_remote_chart("test")
-            self.assertEqual(result, "line1\nline2")
+            self.assertEqual(len(result), 1)
+            self.assertEqual(result[0].chart, "quixplatform-manager")
+            self.assertEqual(result[0].chart_version, "1.5.4-rc.1")
+            self.assertEqual(result[0].revision, 3)
 
-    def test_get_remote_version(self):
-        """Test that _get_remote_version extracts version from helm output."""
-        self.args.repo = None
-        with patch.object(HelmManager, "_get_remote_version", return_value="2.0.0"):
-            hm = HelmManager(self.args)
-        # Override internal methods to simulate helm output.
-        hm._check_remote_chart = MagicMock(return_value="a b c d e f g h chart-2.0.0")
-        hm._extract_version_from_stdout = MagicMock(return_value="2.0.0")
-        version = hm._get_remote_version("test")
-        self.assertEqual(version, "2.0.0")
-
-    def test_check_if_exists(self):
-        """Test _check_if_exists returns True if the release name is found in the output."""
+    def test_check_remote_chart_args(self):
+        """Test that the release is listed with every status and an anchored filter."""
         self.args.repo = "dummy:0.0.1"
         hm = HelmManager(self.args)
-        hm._check_remote_chart = MagicMock(return_value="some release test content")
-        exists = hm._check_if_exists("test")
-        self.assertTrue(exists)
-        hm._check_remote_chart = MagicMock(return_value="no release info")
-        exists = hm._check_if_exists("test")
-        self.assertFalse(exists)
-
-    def test_parse_output(self):
-        """Test that parse_output converts helm output into a dictionary."""
-        output_str = "STATUS: deployed\nREVISION: 2\nOTHER: value"
-        result = HelmManager.parse_output(output_str)
-        self.assertEqual(result, {"STATUS": "deployed", "REVISION": "2", "OTHER": "value"})
-
-    def test_get_release_status(self):
-        """Test that _get_release_status parses helm status output correctly."""
+        hm._check_remote_chart("test")
+        self.mock_run.assert_called_with(
+            ['list', '--all', '--filter', '^test$', '--output', 'json', '--namespace', 'default'])
+
+    def test_get_snapshot_queries_once(self):
+        """Test that the snapshot is read from helm once and reused until refreshed."""
+        self.args.repo = "dummy:0.0.1"
+        hm = HelmManager(self.args)
+        release = ReleaseInfo("test", "default", 3, "2024-01-01 10:00:00.0 +0000 UTC", "deployed",
+                              "quixplatform-manager", "1.2.3", "1.2.3")
+        hm._check_remote_chart = MagicMock(return_value=[release])
+        snapshot = hm._get_snapshot()
+        self.assertTrue(snapshot.exists)
+        self.assertEqual(snapshot.chart_version, "1.2.3")
+        self.assertEqual(snapshot.revision, 3)
+        self.assertIs(hm._get_snapshot(), snapshot)
+        hm._check_remote_chart.assert_called_once_with("test")
+        hm._check_remote_chart = MagicMock(return_value=[])
+        self.assertFalse(hm._get_snapshot(refresh=True).exists)
+
+    def test_get_history(self):
+        """Test that _get_history returns the revisions oldest first."""
         self.args.repo = "dummy:0.0.1"
         hm = HelmManager(self.args)
-        dummy_output = b"STATUS: deployed\nREVISION: 3"
-        self.mock_run.return_value = MagicMock(stdout=dummy_output, returncode=0)
-        status = hm._get_release_status()
-        self.assertEqual(status.get("STATUS"), "deployed")
-        self.assertEqual(status.get("REVISION"), "3")
+        dummy_output = (b'[{"revision": 2, "updated": "u2", "status": "deployed", "chart": "quixplatform-manager-1.5.4", '
+                        b'"app_version": "1.5.4", "description": "Upgrade complete"}, '
+                        b'{"revision": 1, "updated": "u1", "status": "superseded", "chart": "quixplatform-manager-1.5.3", '
+                        b'"app_version": "1.5.3", "description": "Install complete"}]')
+        self.mock_run.return_value = helm_result(dummy_output)
+        history = hm._get_history()
+        self.assertEqual([revision.revision for revision in history], [1, 2])
+        self.assertEqual(history[0].chart_version, "1.5.3")
+
+    def test_check_result_failure(self):
+        """Test that a failed helm command raises instead of exiting."""
+        with self.assertRaises(HelmCommandError) as error:
+            HelmManager._check_result(helm_result(returncode=1, stderr=b"Error: release not found"))
+        self.assertEqual(error.exception.result.returncode, 1)
+        self.assertIn("release not found", str(error.exception))
 
     def test_pull_repo(self):
-        """Test that pull_repo builds the correct helm command."""
+        """Test that pull_repo builds the correct helm command and records the pulled archive."""
         self.args.repo = "myrepo:2.0.0"
         hm = HelmManager(self.args)
-        hm.deployment.get_dir = MagicMock(return_value="/tmp/deployment")
-        self.mock_run.return_value = MagicMock(stdout=b"", returncode=0)
-        hm._pull_repo()
-        expected_args = ['helm', 'pull', 'oci://myrepo', '--version', '2.0.0', '--destination', "/tmp/deployment"]
-        self.mock_run.assert_called_with(
-            expected_args, check=True, stdout=unittest.mock.ANY, stderr=unittest.mock.ANY
-        )
+        with tempfile.TemporaryDirectory() as deployment_dir:
+            hm.deployment.get_dir = MagicMock(return_value=deployment_dir)
+            archive = os.path.join(deployment_dir, "myrepo-2.0.0.tgz")
+            with open(archive, "wb") as f:
+                f.write(b"archive")
+            self.mock_run.return_value = helm_result(b"")
+            with hm.metrics.span("pull") as span:
+                hm._pull_repo()
+            # The bytes of the pull are those of the archive helm wrote
+            self.assertEqual(span.bytes_out, len(b"archive"))
+            expected_args = ['pull', 'oci://myrepo', '--version', '2.0.0', '--destination', deployment_dir]
+            self.mock_run.assert_called_with(expected_args)
+            self.assertEqual(hm.chart_archive, archive)
+            self.assertEqual(hm.chart_digest, file_digest(archive))
 
     def test_extract_chart(self):
-        """Test that extract_chart calls FileManager methods with expected file paths."""
+        """Test that extract_chart reads only values.yaml from the expected archive."""
         self.args.repo = "myrepo:2.0.0"
         hm = HelmManager(self.args)
         hm.deployment.get_dir = MagicMock(return_value="/tmp/deployment")
-        hm.default_file_path = "/tmp/deployment/testdefault.yaml"
-        with patch('src.helm_manager.FileManager.extract_tgz') as mock_extract, \
-                patch('src.helm_manager.FileManager.copy_and_rename') as mock_copy:
+        with patch('src.helm_manager.FileManager.read_from_tgz', return_value=b"key: value") as mock_read:
             hm._extract_chart()
-            chart_name = "myrepo"
-            expected_archive = os.path.join("/tmp/deployment", f"{chart_name}-2.0.0.tgz")
-            expected_values_path = os.path.join("/tmp/deployment", chart_name, "values.yaml")
-            mock_extract.assert_called_with(archive=expected_archive, path="/tmp/deployment")
-            mock_copy.assert_called_with(from_path=expected_values_path,
-                                         new_filename="/tmp/deployment/testdefault.yaml")
+            expected_archive = os.path.join("/tmp/deployment", "myrepo-2.0.0.tgz")
+            mock_read.assert_called_with(archive=expected_archive, member="myrepo/values.yaml")
+            self.assertEqual(hm.default_values, b"key: value")
 
     def test_run_nonexistent_release(self):
         """
@@ -181,19 +220,74 @@ class TestHelmManager(unittest.TestCase):
         """
         self.args.repo = "myrepo:2.0.0"
         hm = HelmManager(self.args)
-        hm._check_if_exists = MagicMock(return_value=False)
-        hm._get_release_status = MagicMock(return_value={"STATUS": "unknown"})
+        hm._get_snapshot = MagicMock(return_value=ReleaseSnapshot("test", "2.0.0", 1, "uninstalling"))
         with self.assertRaises(SystemExit):
             hm.run()
 
+    def _list_calls_of_update(self, snapshot=None, waited=False):
+        self.mock_run.return_value = helm_result(
+            b'[{"name": "test", "namespace": "default", "revision": "2", "updated": "", "status": "deployed", '
+            b'"chart": "quixplatform-manager-1.1.0", "app_version": "1.1.0"}]')
+        with tempfile.TemporaryDirectory() as tempdir:
+            deployment = DeploymentManager(tempdir=tempdir)
+            hm = HelmManager(self.args, snapshot=snapshot, deployment=deployment)
+            hm._run_phases = MagicMock(return_value=None)
+            with patch.object(deployment, "lock", return_value=contextlib.nullcontext(waited)):
+                hm.run()
+        hm._run_phases.assert_called_once()
+        return hm, [call.args[0] for call in self.mock_run.call_args_list if call.args[0][0] == "list"]
+
+    def test_update_reads_the_release_once_under_lock(self):
+        """Test that an update lists the release once, after it holds the lock, and resolves the version from it."""
+        hm, lists = self._list_calls_of_update()
+        self.assertEqual(len(lists), 1)
+        self.assertEqual(hm.version, "1.1.0")
+        self.assertEqual(hm.values_revision, 2)
+
+        # The snapshot of a batch discovery is used as is, unless the update waited for another run
+        self.mock_run.reset_mock()
+        hm, lists = self._list_calls_of_update(snapshot=ReleaseSnapshot("test", "1.0.0", 1, "deployed"))
+        self.assertEqual(lists, [])
+        self.assertEqual((hm.version, hm.values_revision), ("1.0.0", 1))
+        hm, lists = self._list_calls_of_update(snapshot=ReleaseSnapshot("test", "1.0.0", 1, "deployed"), waited=True)
+        self.assertEqual(len(lists), 1)
+        self.assertEqual((hm.version, hm.values_revision), ("1.1.0", 2))
+
+    def test_run_pending_upgrade(self):
+        """Test that a pending upgrade is rolled back and the update runs on the refreshed snapshot."""
+        self.args.repo = None
+        hm = HelmManager(self.args)
+        hm._get_snapshot = MagicMock(side_effect=[
+            ReleaseSnapshot("test", "2.0.0", 5, "pending-upgrade"),
+            ReleaseSnapshot("test", "1.0.0", 6, "deployed"),
+        ])
+        # The previous revision failed, the rollback goes to the last deployed one
+        hm._get_history = MagicMock(return_value=[
+            Revision(3, "", "deployed", "chart", "1.0.0", "1.0.0", ""),
+            Revision(4, "", "failed", "chart", "2.0.0", "2.0.0", ""),
+            Revision(5, "", "pending-upgrade", "chart", "2.0.0", "2.0.0", ""),
+        ])
+        hm._rollback = MagicMock()
+        hm._get_values = MagicMock(return_value={"key": "value"})
+        hm._pull_repo = MagicMock()
+        hm._extract_chart = MagicMock()
+        hm._update_with_merged_values = MagicMock()
+        with patch('src.helm_manager.FileManager.write_values'), patch('src.helm_manager.YamlMerger') as mock_yaml_merger:
+            mock_yaml_merger.return_value.merged_values.return_value = {"key": "value"}
+            hm.run()
+        hm._rollback.assert_called_once_with("3")
+        hm._get_snapshot.assert_called_with(refresh=True)
+        self.assertEqual(hm.version, "1.0.0")
+        hm._update_with_merged_values.assert_called_once()
+
     def test_run_update(self):
         """Test the run method when release exists and action is update."""
         self.args.repo = "myrepo:2.0.0"
         self.args.action = "update"
         hm = HelmManager(self.args)
         # Simulate that the release exists.
-        hm._check_if_exists = MagicMock(return_value=True)
-        hm._get_values = MagicMock(return_value="dummy values")
+        hm._get_snapshot = MagicMock(return_value=ReleaseSnapshot("test", "2.0.0", 1, "deployed"))
+        hm._get_values = MagicMock(return_value={"key": "value"})
         hm._pull_repo = MagicMock()
         # Patch _extract_chart (note the underscore) to avoid file system calls.
         hm._extract_chart = MagicMock()
@@ -202,13 +296,253 @@ class TestHelmManager(unittest.TestCase):
         with patch('src.helm_manager.FileManager.write_values') as mock_write, \
                 patch('src.helm_manager.YamlMerger') as mock_yaml_merger:
             dummy_yaml_merger = MagicMock()
-            dummy_yaml_merger.save_merged_yaml = MagicMock()
+            dummy_yaml_merger.merged_values = MagicMock(return_value={"key": "value"})
             mock_yaml_merger.return_value = dummy_yaml_merger
             hm.run()
             hm._pull_repo.assert_called_once()
             hm._extract_chart.assert_called_once()
-            mock_write.assert_called_once()
-            dummy_yaml_merger.save_merged_yaml.assert_called_once_with(file_path=hm.merged_file_path)
+            # The merge happens in memory, nothing is written to disk
+            mock_write.assert_not_called()
+            self.assertEqual(mock_yaml_merger.call_args.kwargs["source_file"], {"key": "value"})
+            dummy_yaml_merger.merged_values.assert_called_once_with(provenance=None)
+            self.assertEqual(hm.merged_values, b"key: value\n")
+            hm._update_with_merged_values.assert_called_once()
+
+    def test_merge_values_keep_artifacts(self):
+        """Test that the values files are only written with keep_artifacts."""
+        self.args.repo = "myrepo:2.0.0"
+        self.args.keep_artifacts = True
+        hm = HelmManager(self.args)
+        hm.current_values = {"key": "value"}
+        hm.default_values = b"key: default\n"
+        with patch('src.helm_manager.FileManager.write_values') as mock_write, \
+                patch('src.helm_manager.YamlMerger') as mock_yaml_merger:
+            mock_yaml_merger.return_value.merged_values.return_value = {"key": "value"}
+            hm._merge_values()
+            hm._serialize_values()
+        mock_write.assert_any_call(file_path=hm.current_file_path, values={"key": "value"})
+        mock_write.assert_any_call(file_path=hm.default_file_path, values="key: default\n")
+        mock_write.assert_any_call(file_path=hm.merged_file_path, values="key: value\n")
+
+    def test_merge_values_explain(self):
+        """Test that --explain writes the origin of every merged value."""
+        self.args.repo = "myrepo:2.0.0"
+        with tempfile.TemporaryDirectory() as report_dir:
+            self.args.explain = os.path.join(report_dir, "explain.json")
+            hm = HelmManager(self.args)
+            hm.current_values = {"global": {"byocZipVersion": "1.0"}, "image": {"tag": "old"}, "key": "value"}
+            hm.default_values = b"global:\n  byocZipVersion: '2.0'\nimage:\n  tag: new\nkey: default\nnew_key: default\n"
+            hm._merge_values()
+            with open(self.args.explain) as f:
+                report = json.load(f)
+        self.assertEqual(report["release"], "test")
+        self.assertEqual(report["values"], {
+            "global.byocZipVersion": "special",
+            "image.tag": "special",
+            "key": "release",
+            "new_key": "defaults",
+        })
+        self.assertEqual(report["origins"], {"special": 2, "release": 1, "defaults": 1})
+
+    def test_merge_values_explain_to_stderr(self):
+        """Test that --explain without a path leaves stdout to the manifests."""
+        self.args.repo = "myrepo:2.0.0"
+        self.args.explain = "-"
+        hm = HelmManager(self.args)
+        hm.current_values = {"global": {"byocZipVersion": "1.0"}, "image": {"tag": "old"}, "key": "value"}
+        hm.default_values = b"global:\n  byocZipVersion: '2.0'\nimage:\n  tag: new\nkey: default\n"
+        with patch('sys.stdout') as stdout, patch('sys.stderr') as stderr:
+            hm._merge_values()
+        stdout.write.assert_not_called()
+        self.assertEqual(json.loads(stderr.write.call_args.args[0])["values"]["key"], "release")
+
+    def test_update_pipes_values_to_helm(self):
+        """Test that the merged values reach helm on stdin."""
+        self.args.repo = "myrepo:2.0.0"
+        hm = HelmManager(self.args)
+        hm.merged_values = b"key: value\n"
+        hm._update_with_merged_values()
+        self.mock_run.assert_called_with(
+            ['upgrade', '--install', 'test', 'oci://myrepo', '--version', '2.0.0', '--values', '-',
+             '--namespace', 'default', '--timeout', '6m'], stdin=b"key: value\n")
+
+    def test_update_deploys_pulled_archive(self):
+        """Test that the pulled archive is deployed instead of fetching the chart again, once its digest is checked."""
+        self.args.repo = "myrepo:2.0.0"
+        hm = HelmManager(self.args)
+        with tempfile.TemporaryDirectory() as deployment_dir:
+            archive = os.path.join(deployment_dir, "myrepo-2.0.0.tgz")
+            with open(archive, "wb") as f:
+                f.write(b"archive")
+            hm.chart_archive, hm.chart_digest = archive, file_digest(archive)
+            hm.merged_values = b"key: value\n"
+            hm._update_with_merged_values()
+            self.mock_run.assert_called_with(
+                ['upgrade', '--install', 'test', archive, '--values', '-',
+                 '--namespace', 'default', '--timeout', '6m'], stdin=b"key: value\n")
+            with open(archive, "wb") as f:
+                f.write(b"tampered")
+            with self.assertRaises(RuntimeError):
+                hm._update_with_merged_values()
+
+    def test_update_skipped_when_unchanged(self):
+        """Test that the upgrade is skipped when the release already runs the same chart and values."""
+        self.args.repo = "myrepo:2.0.0"
+        snapshot = ReleaseSnapshot("test", chart_version="2.0.0", revision=3, status="deployed")
+        hm = HelmManager(self.args, snapshot=snapshot)
+        hm.current_values = {"b": {"y": 1, "x": 2}, "a": "1"}
+        hm.merged_document = {"a": "1", "b": {"x": 2, "y": 1}}
+        hm.merged_values = b"a: '1'\nb:\n  x: 2\n  y: 1\n"
+        self.mock_run.reset_mock()
+        hm._update_with_merged_values()
+        self.mock_run.assert_not_called()
+
+        # Other values, another chart version or --force run the upgrade
+        hm.merged_document, hm.merged_hash = {"a": "2", "b": {"x": 2, "y": 1}}, None
+        hm._update_with_merged_values()
+        self.assertEqual(self.mock_run.call_count, 1)
+        hm.merged_document, hm.merged_hash = {"a": "1", "b": {"x": 2, "y": 1}}, None
+        hm.version = "2.1.0"
+        hm._update_with_merged_values()
+        self.assertEqual(self.mock_run.call_count, 2)
+        hm.version = "2.0.0"
+        hm.force = True
+        hm._update_with_merged_values()
+        self.assertEqual(self.mock_run.call_count, 3)
+
+    def test_run_removes_workspace_on_exit(self):
+        """Test that the workspace of the run is removed on the sys.exit paths too."""
+        self.args.repo = "myrepo:2.0.0"
+        with tempfile.TemporaryDirectory() as tempdir:
+            hm = HelmManager(self.args, snapshot=ReleaseSnapshot("test"), deployment=DeploymentManager(tempdir=tempdir))
+            workspace = hm.deployment.get_dir()
+            self.assertTrue(os.path.isdir(workspace))
+            with self.assertRaises(SystemExit):
+                hm.run()
+            self.assertFalse(os.path.exists(workspace))
+
+    def test_run_writes_metrics(self):
+        """Test that every phase of the run is measured and written to the metrics file."""
+        self.args.repo = "myrepo:2.0.0"
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.args.metrics_file = os.path.join(tempdir, "metrics.prom")
+            hm = HelmManager(self.args)
+            # The update reads the release once it holds the lock
+            self.mock_run.return_value = helm_result(
+                b'[{"name": "test", "namespace": "default", "revision": "1", "updated": "", "status": "deployed", '
+                b'"chart": "quixplatform-manager-2.0.0", "app_version": "2.0.0"}]')
+            hm._get_values = MagicMock(return_value={"key": "value"})
+            hm._pull_repo = MagicMock()
+            hm._extract_chart = MagicMock()
+            hm._update_with_merged_values = MagicMock()
+            with patch('src.helm_manager.YamlMerger') as mock_yaml_merger:
+                mock_yaml_merger.return_value.merged_values.return_value = {"key": "value"}
+                hm.run()
+            with open(self.args.metrics_file) as f:
+                exposition = f.read()
+        phases = [span["name"] for span in hm.metrics.to_dict()["spans"]]
+        self.assertEqual(set(phases), {"check", "get_values", "pull", "extract", "load_override", "merge", "serialize", "update"})
+        self.assertEqual(phases[-2:], ["serialize", "update"])
+        self.assertIn('phase="serialize",direction="out"} 11', exposition)
+        self.assertIn('quix_manager_run_success{release="test",namespace="default",action="update"} 1', exposition)
+
+    def test_build_phases(self):
+        """Test that the cluster query, the pull and the override load do not wait on each other."""
+        self.args.repo = "myrepo:2.0.0"
+        hm = HelmManager(self.args)
+        phases = hm._build_phases().phases
+        self.assertEqual(phases["get_values"].requires, ())
+        self.assertEqual(phases["pull"].requires, ())
+        self.assertEqual(phases["load_override"].requires, ())
+        self.assertEqual(phases["extract"].requires, ("pull",))
+        self.assertEqual(set(phases["merge"].requires), {"get_values", "extract", "load_override"})
+        self.assertEqual(phases["serialize"].requires, ("merge",))
+        self.assertEqual(phases["update"].requires, ("serialize",))
+
+    def test_template_served_from_manifest_cache(self):
+        """Test that a render done with the same inputs is not run again."""
+        self.args.repo = "myrepo:2.0.0"
+        self.args.action = "template"
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.args.cache_dir = cache_dir
+            hm = HelmManager(self.args)
+            archive = hm.chart_archive = os.path.join(cache_dir, "chart.tgz")
+            with open(archive, "wb") as f:
+                f.write(b"archive")
+            hm.chart_digest = file_digest(archive)
+            hm.merged_document = {"key": "value"}
+            hm.merged_values = b"key: value\n"
+            with patch('src.helm_manager.HELM_RUNNER.version', return_value="v3.16.2"):
+                self.mock_run.side_effect = streamed_result(b"kind: ConfigMap\n")
+                self.assertEqual(hm._template_with_merged_values().stdout, b"kind: ConfigMap\n")
+                self.mock_run.reset_mock()
+                self.assertEqual(hm._template_with_merged_values().stdout, b"kind: ConfigMap\n")
+                self.mock_run.assert_not_called()
+                # Other values are another render
+                hm.merged_document, hm.merged_hash = {"key": "other"}, None
+                hm._template_with_merged_values()
+                self.mock_run.assert_called_once()
+                # A failed render is not cached
+                hm.merged_document, hm.merged_hash = {"key": "failed"}, None
+                self.mock_run.side_effect = streamed_result(b"partial\n", returncode=1)
+                with self.assertRaises(HelmCommandError):
+                    hm._template_with_merged_values()
+                self.mock_run.side_effect = streamed_result(b"kind: Secret\n")
+                self.assertEqual(hm._template_with_merged_values().stdout, b"kind: Secret\n")
+
+    def test_template_streams_to_output_dir(self):
+        """Test that the template action writes one file per resource, or streams the manifests to stdout."""
+        self.args.repo = "myrepo:2.0.0"
+        self.args.action = "template"
+        manifests = (b"---\n# Source: chart/templates/cm.yaml\napiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: config\n"
+                     b"---\napiVersion: apps/v1\nkind: Deployment\nmetadata:\n  labels:\n    name: label\n  name: \"web\"\n")
+        self.mock_run.side_effect = streamed_result(manifests)
+        with tempfile.TemporaryDirectory() as output_dir:
+            self.args.output_dir = output_dir
+            hm = HelmManager(self.args)
+            hm.merged_values = b"key: value\n"
+            with hm.metrics.span("apply") as span:
+                hm._apply_action()
+            self.assertEqual(span.bytes_out, len(manifests))
+            with open(os.path.join(output_dir, "Deployment", "web.yaml"), "rb") as f:
+                self.assertTrue(f.read().endswith(b"  name: \"web\"\n"))
+            self.assertEqual(sorted(os.listdir(output_dir)), ["ConfigMap", "Deployment"])
+
+        self.args.output_dir = None
+        hm = HelmManager(self.args)
+        hm.merged_values = b"key: value\n"
+        stdout = MagicMock()
+        with patch('sys.stdout', stdout), hm.metrics.span("apply") as span:
+            hm._apply_action()
+        self.assertEqual(span.bytes_out, len(manifests))
+        self.assertEqual(b"".join(call.args[0] for call in stdout.buffer.write.call_args_list), manifests)
+
+    def test_run_update_with_cached_chart(self):
+        """Test that a chart found in the cache is not pulled again."""
+        self.args.repo = "myrepo:2.0.0"
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.args.cache_dir = cache_dir
+            hm = HelmManager(self.args)
+            archive = os.path.join(cache_dir, "chart.tgz")
+            with open(archive, "wb") as f:
+                f.write(b"archive")
+            entry = hm.chart_cache.store(hm.repo, hm.version, archive=archive, values=b"key: value")
+            hm.chart_cache.lookup = MagicMock(return_value=entry)
+            hm.chart_cache.read_values = MagicMock(return_value=b"key: value")
+            hm._get_snapshot = MagicMock(return_value=ReleaseSnapshot("test", "2.0.0", 1, "deployed"))
+            hm._get_values = MagicMock(return_value={"key": "value"})
+            hm._pull_repo = MagicMock()
+            hm._extract_chart = MagicMock()
+            hm._update_with_merged_values = MagicMock()
+            with patch('src.helm_manager.FileManager.write_values'), \
+                    patch('src.helm_manager.YamlMerger') as mock_yaml_merger:
+                mock_yaml_merger.return_value.merged_values.return_value = {"key": "value"}
+                hm.run()
+            hm.chart_cache.lookup.assert_called_once_with("myrepo", "2.0.0")
+            hm.chart_cache.read_values.assert_called_once_with(entry)
+            self.assertEqual(mock_yaml_merger.call_args.kwargs["new_fields_file"], b"key: value")
+            hm._pull_repo.assert_not_called()
+            hm._extract_chart.assert_not_called()
             hm._update_with_merged_values.assert_called_once()
 
 
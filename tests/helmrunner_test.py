@@ -0,0 +1,86 @@
+import asyncio
+import os
+import stat
+import tempfile
+import unittest
+from src.helm_runner import HelmCommandError, HelmRunner
+
+
+FAKE_HELM = """#!/bin/sh
+case "$1" in
+  lines) printf 'first\\nsecond\\nthird' ;;
+  echo) cat ;;
+  values) echo '{"global": {"password": "s3cr3t"}}' ;;
+  fail) echo "Error: boom" >&2; exit 3 ;;
+  sleep) exec sleep 10 ;;
+  version) echo "v3.16.2+g13654a5" ;;
+esac
+"""
+
+
+class TestHelmRunner(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        helm_bin = os.path.join(tmp.name, "helm")
+        with open(helm_bin, "w") as f:
+            f.write(FAKE_HELM)
+        os.chmod(helm_bin, os.stat(helm_bin).st_mode | stat.S_IEXEC)
+        self.runner = HelmRunner(helm_bin=helm_bin)
+
+    def test_run_captures_and_streams_lines(self):
+        lines = []
+        result = self.runner.run_sync(['lines'], on_stdout_line=lines.append)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.stdout, b"first\nsecond\nthird")
+        self.assertEqual(lines, [b"first\n", b"second\n", b"third"])
+
+    def test_run_without_capture(self):
+        lines = []
+        result = self.runner.run_sync(['lines'], capture_stdout=False, on_stdout_line=lines.append)
+        self.assertEqual(result.stdout, b"")
+        self.assertEqual(len(lines), 3)
+
+    def test_run_never_logs_stdout(self):
+        with self.assertLogs('quix-manager', level='DEBUG') as logs:
+            result = self.runner.run_sync(['values'])
+        self.assertIn(b"s3cr3t", result.stdout)
+        self.assertFalse([line for line in logs.output if "s3cr3t" in line])
+        self.assertTrue([line for line in logs.output if f"printed {len(result.stdout)} bytes" in line])
+
+    def test_run_with_stdin(self):
+        result = self.runner.run_sync(['echo'], stdin=b"image:\n  tag: 1.0.0\n")
+        self.assertEqual(result.stdout, b"image:\n  tag: 1.0.0\n")
+
+    def test_run_failure_returns_result(self):
+        result = self.runner.run_sync(['fail'])
+        self.assertFalse(result.ok)
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(result.stderr, b"Error: boom\n")
+        with self.assertRaises(HelmCommandError):
+            result.check()
+
+    def test_run_timeout_kills_helm(self):
+        result = self.runner.run_sync(['sleep'], timeout=0.2)
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result.ok)
+        self.assertLess(result.duration, 5)
+
+    def test_version_is_memoized(self):
+        self.assertEqual(self.runner.version(), "v3.16.2+g13654a5")
+        self.runner.helm_bin = "/nonexistent/helm"
+        self.assertEqual(self.runner.version(), "v3.16.2+g13654a5")
+
+    def test_run_missing_binary(self):
+        result = HelmRunner(helm_bin="/non/existent/helm").run_sync(['list'])
+        self.assertEqual(result.returncode, 127)
+
+    def test_concurrent_runs_on_one_loop(self):
+        async def run_all():
+            return await asyncio.gather(*(self.runner.run(['echo'], stdin=str(i).encode()) for i in range(5)))
+        results = asyncio.run(run_all())
+        self.assertEqual([result.stdout for result in results], [b"0", b"1", b"2", b"3", b"4"])
+
+
+if __name__ == '__main__':
+    unittest.main()
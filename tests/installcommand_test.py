@@ -0,0 +1,65 @@
+import os
+import sys
+import stat
+import tempfile
+import unittest
+import subprocess
+
+import yaml
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+from benchmarks.fake_helm import CHART_NAME, CHART_VERSION, write_fixtures
+from benchmarks.values_generator import generate_manifests
+
+
+class TestInstallCommand(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def _helm_stub(self, script: str):
+        path = os.path.join(self.tmp.name, "helm")
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\n" + script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        return path
+
+    def _run(self, helm_bin: str, *args):
+        env = dict(os.environ, HELM_BIN=helm_bin)
+        env.pop('HELM_NAMESPACE', None)
+        return subprocess.run([sys.executable, os.path.join(ROOT, "quix_install_command.py")] + list(args),
+                              capture_output=True, env=env, cwd=self.tmp.name, timeout=60)
+
+    def test_failing_helm_list_still_prints_the_configmap(self):
+        helm_bin = self._helm_stub('echo "Error: Kubernetes cluster unreachable" >&2\nexit 1\n')
+        result = self._run(helm_bin, "update", "--namespace", "quix", "--logs-as-config")
+        self.assertEqual(result.returncode, 1, result.stderr)
+        self.assertNotIn(b"Traceback", result.stderr)
+        configmap = yaml.safe_load(result.stdout)
+        self.assertEqual(configmap['kind'], "ConfigMap")
+        self.assertIn("Kubernetes cluster unreachable", configmap['data']['helm-logs'])
+
+    def test_template_keeps_every_manifest_before_the_configmap(self):
+        helm_bin = write_fixtures(os.path.join(self.tmp.name, "fixtures"), "global:\n  byocZipVersion: 1.0.0\nimage:\n  tag: 1.0.0\n",
+                                  {'replicas': 1}, generate_manifests(documents=3, size_kb=1))
+        result = self._run(helm_bin, "template", "--namespace", "quix", "--logs-as-config",
+                           "--repo", f"quixcontainerregistry.azurecr.io/helm/{CHART_NAME}:{CHART_VERSION}")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        documents = [document for document in yaml.safe_load_all(result.stdout) if document]
+        self.assertEqual([document['metadata']['name'] for document in documents],
+                         ["config0", "config1", "config2", "quix-manager-log-configmap"])
+
+    def test_invalid_batch_manifest_still_prints_the_configmap(self):
+        manifest = os.path.join(self.tmp.name, "batch.yaml")
+        with open(manifest, "w") as f:
+            f.write("releases: []\n")
+        result = self._run(self._helm_stub("exit 1\n"), "batch", "--manifest", manifest, "--logs-as-config")
+        self.assertEqual(result.returncode, 1, result.stderr)
+        self.assertNotIn(b"Traceback", result.stderr)
+        configmap = yaml.safe_load(result.stdout)
+        self.assertIn("does not list any release", configmap['data']['helm-logs'])
+
+
+if __name__ == '__main__':
+    unittest.main()
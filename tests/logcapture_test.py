@@ -0,0 +1,63 @@
+import base64
+import gzip
+import logging
+import unittest
+from quix_install_command import generate_configmap
+from src.log_capture import CaptureHandler
+
+
+class TestCaptureHandler(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('quix-manager-capture-test')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def _capture(self, **kwargs):
+        handler = CaptureHandler(**kwargs)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        return handler
+
+    def test_captures_in_order(self):
+        handler = self._capture()
+        self.logger.info("first")
+        self.logger.error("second")
+        self.assertEqual(handler.getvalue(), "INFO first\nERROR second\n")
+
+    def test_drops_lowest_levels_first(self):
+        handler = self._capture(max_bytes=200)
+        self.logger.error("error 0")
+        for i in range(50):
+            self.logger.debug(f"debug {i}")
+        self.logger.warning("warning 0")
+        self.logger.info("info 0")
+
+        captured = handler.getvalue()
+        self.assertLessEqual(handler._size, 200)
+        self.assertIn("ERROR error 0\n", captured)
+        self.assertIn("WARNING warning 0\n", captured)
+        self.assertIn("INFO info 0\n", captured)
+        self.assertNotIn("debug 0\n", captured)
+        self.assertTrue(captured.startswith(f"# [log capture limited to 200 bytes: {handler.dropped} lines"))
+        self.assertIn("lines dropped ...]\n", captured)
+
+    def test_truncates_long_records(self):
+        handler = self._capture(max_bytes=1000, max_record_bytes=100)
+        self.logger.info("x" * 10000)
+        captured = handler.getvalue()
+        self.assertLessEqual(len(captured.encode('utf-8')), 100)
+        self.assertTrue(captured.endswith("bytes]\n"))
+        self.assertIn("[truncated", captured)
+
+    def test_compressed_configmap(self):
+        configmap = generate_configmap("line\n" * 1000, metrics={'spans': []}, compress=True)
+        self.assertNotIn('helm-logs', configmap['data'])
+        self.assertIn('helm-metrics', configmap['data'])
+        logs = gzip.decompress(base64.b64decode(configmap['binaryData']['helm-logs.gz'])).decode('utf-8')
+        self.assertEqual(logs, "line\n" * 1000)
+        self.assertEqual(generate_configmap("line\n")['data'], {'helm-logs': "line\n"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+from src.manifests import ManifestSplitter
+
+
+class TestManifestSplitter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.splitter = ManifestSplitter(os.path.join(self.tmp.name, "out"))
+
+    def _split(self, stream: bytes):
+        for line in stream.splitlines(keepends=True):
+            self.splitter.write_line(line)
+        self.splitter.close()
+        return [os.path.relpath(path, self.splitter.output_dir) for path in self.splitter.paths]
+
+    def _read(self, path):
+        with open(os.path.join(self.splitter.output_dir, path), "rb") as f:
+            return f.read()
+
+    def test_split_by_kind_and_name(self):
+        paths = self._split(b"---\n# Source: chart/templates/role.yaml\nkind: Role\nmetadata:\n  namespace: a\n  name: reader\n"
+                            b"---\nkind: Role\nmetadata:\n  name: 'reader'\n  namespace: b\n"
+                            b"---\n# Source: chart/templates/empty.yaml\n"
+                            b"---\nmetadata:\n  annotations:\n    name: not-this\n  name: svc\nkind: Service\nspec:\n  name: nor-this\n")
+        self.assertEqual(paths, [os.path.join("Role", "reader.yaml"), os.path.join("Role", "reader-2.yaml"), os.path.join("Service", "svc.yaml")])
+        self.assertEqual(self._read(paths[0]), b"# Source: chart/templates/role.yaml\nkind: Role\nmetadata:\n  namespace: a\n  name: reader\n")
+        self.assertEqual(sorted(os.listdir(self.splitter.output_dir)), ["Role", "Service"])
+
+    def test_document_without_name(self):
+        paths = self._split(b"key: value\n--- \nkind: List\nitems: []\n")
+        self.assertEqual(paths, ["document-0.yaml", "document-1.yaml"])
+        self.assertEqual(self._read("document-1.yaml"), b"kind: List\nitems: []\n")
+
+    def test_discard(self):
+        self.splitter.write_line(b"kind: ConfigMap\n")
+        self.splitter.discard()
+        self.splitter.close()
+        self.assertEqual(self.splitter.paths, [])
+        self.assertEqual(os.listdir(self.splitter.output_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
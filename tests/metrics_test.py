@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+from src.helm_runner import HelmResult
+from src.metrics import Metrics, record_bytes, record_helm_result
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics(labels={"release": "quixplatform-manager", "namespace": "quix"})
+
+    def test_span_records_helm_results(self):
+        with self.metrics.span("upgrade") as span:
+            record_helm_result(HelmResult(['helm'], 0, stdout=b"12345"), stdin=b"abc")
+            record_helm_result(HelmResult(['helm'], 1, stdout=b"6"))
+            record_helm_result(HelmResult(['helm'], 0))
+            record_bytes(bytes_out=4)
+        self.assertEqual(span.exit_code, 1)
+        self.assertEqual(span.bytes_in, 3)
+        self.assertEqual(span.bytes_out, 10)
+        self.assertTrue(span.succeeded)
+        # Outside of a span nothing is recorded
+        record_helm_result(HelmResult(['helm'], 2))
+        self.assertEqual([span.name for span in self.metrics.spans], ["upgrade"])
+
+    def test_failed_span(self):
+        with self.assertRaises(RuntimeError):
+            with self.metrics.span("pull"):
+                raise RuntimeError("boom")
+        self.assertFalse(self.metrics.spans[0].succeeded)
+        self.assertIn("pull", self.metrics.summary())
+        self.assertIn("failed", self.metrics.summary())
+
+    def test_timed(self):
+        self.assertEqual(self.metrics.timed("merge", lambda: 42)(), 42)
+        self.assertEqual(self.metrics.to_dict()["spans"][0]["name"], "merge")
+
+    def test_openmetrics(self):
+        with self.metrics.span("get_values"):
+            record_helm_result(HelmResult(['helm'], 0, stdout=b"{}"))
+        self.metrics.finish(True)
+        exposition = self.metrics.to_openmetrics()
+        self.assertIn('# TYPE quix_manager_phase_duration_seconds gauge', exposition)
+        self.assertIn('quix_manager_phase_exit_code{release="quixplatform-manager",namespace="quix",phase="get_values"} 0', exposition)
+        self.assertIn('quix_manager_phase_bytes{release="quixplatform-manager",namespace="quix",phase="get_values",direction="out"} 2', exposition)
+        self.assertIn('quix_manager_run_success{release="quixplatform-manager",namespace="quix"} 1', exposition)
+        self.assertTrue(exposition.endswith("# EOF\n"))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "quix-manager.prom")
+            self.metrics.write_openmetrics(path)
+            with open(path) as f:
+                self.assertEqual(f.read(), exposition)
+            self.assertEqual(os.listdir(directory), ["quix-manager.prom"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import unittest
+from src.phases import PhaseGraph
+
+
+class TestPhaseGraph(unittest.TestCase):
+    def test_add_unknown_requirement(self):
+        graph = PhaseGraph()
+        with self.assertRaises(ValueError):
+            graph.add("merge", lambda: None, requires=("pull",))
+
+    def test_add_duplicate(self):
+        graph = PhaseGraph().add("pull", lambda: None)
+        with self.assertRaises(ValueError):
+            graph.add("pull", lambda: None)
+
+    def test_run_respects_requirements(self):
+        order = []
+        lock = threading.Lock()
+
+        def phase(name):
+            def func():
+                with lock:
+                    order.append(name)
+                return name
+            return func
+
+        graph = PhaseGraph()
+        graph.add("pull", phase("pull"))
+        graph.add("extract", phase("extract"), requires=("pull",))
+        graph.add("get_values", phase("get_values"))
+        graph.add("merge", phase("merge"), requires=("extract", "get_values"))
+        results = graph.run()
+
+        self.assertEqual(results["merge"], "merge")
+        self.assertLess(order.index("pull"), order.index("extract"))
+        self.assertEqual(order[-1], "merge")
+
+    def test_independent_phases_overlap(self):
+        # Each phase waits for the other to start, which only succeeds if they run concurrently
+        first_started, second_started = threading.Event(), threading.Event()
+
+        def first():
+            first_started.set()
+            return second_started.wait(timeout=5)
+
+        def second():
+            second_started.set()
+            return first_started.wait(timeout=5)
+
+        results = PhaseGraph().add("first", first).add("second", second).run()
+        self.assertEqual(results, {"first": True, "second": True})
+
+    def test_coroutine_phases(self):
+        async def pull():
+            await asyncio.sleep(0)
+            return "chart"
+
+        results = PhaseGraph().add("pull", pull).run()
+        self.assertEqual(results["pull"], "chart")
+
+    def test_failure_skips_dependents(self):
+        ran = []
+
+        def pull():
+            raise RuntimeError("registry unavailable")
+
+        graph = PhaseGraph()
+        graph.add("pull", pull)
+        graph.add("extract", lambda: ran.append("extract"), requires=("pull",))
+        with self.assertRaises(RuntimeError):
+            graph.run()
+        self.assertEqual(ran, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+from src.release import (ReleaseInfo, ReleaseSnapshot, Revision, last_deployed_revision, parse_history, parse_release_list,
+                         parse_release_status, parse_values, split_chart_field)
+
+
+HELM_LIST_OUTPUT = b"""[
+  {"name": "test-other", "namespace": "default", "revision": "1", "updated": "2024-01-01 10:00:00.0 +0000 UTC",
+   "status": "deployed", "chart": "quixplatform-manager-9.9.9", "app_version": "9.9.9"},
+  {"name": "test", "namespace": "default", "revision": "7", "updated": "2024-01-02 11:30:00.0 +0000 UTC",
+   "status": "pending-upgrade", "chart": "quixplatform-manager-1.5.4", "app_version": "1.5.4"}
+]"""
+
+
+class TestRelease(unittest.TestCase):
+    def test_split_chart_field(self):
+        self.assertEqual(split_chart_field("quixplatform-manager-1.5.4"), ("quixplatform-manager", "1.5.4"))
+        self.assertEqual(split_chart_field("quixplatform-manager-1.5.4-rc.1"), ("quixplatform-manager", "1.5.4-rc.1"))
+        self.assertEqual(split_chart_field("chart-v2.0.0+build.5"), ("chart", "v2.0.0+build.5"))
+        with self.assertRaises(ValueError):
+            split_chart_field("chart")
+
+    def test_parse_release_list(self):
+        releases = parse_release_list(HELM_LIST_OUTPUT)
+        self.assertEqual([release.name for release in releases], ["test-other", "test"])
+        self.assertEqual(releases[1].revision, 7)
+        self.assertEqual(releases[1].chart_version, "1.5.4")
+        self.assertEqual(parse_release_list(b"[]"), [])
+
+    def test_models_are_slotted(self):
+        release = parse_release_list(HELM_LIST_OUTPUT)[0]
+        self.assertIsInstance(release, ReleaseInfo)
+        self.assertFalse(hasattr(release, "__dict__"))
+        with self.assertRaises(AttributeError):
+            release.unknown = "value"
+
+    def test_parse_release_status(self):
+        status = parse_release_status(b'{"name": "test", "namespace": "default", "version": 4, '
+                                      b'"info": {"status": "pending-upgrade", "description": "Preparing upgrade"}, '
+                                      b'"chart": {"metadata": {"name": "quixplatform-manager", "version": "1.5.4"}}}')
+        self.assertEqual(status.status, "pending-upgrade")
+        self.assertEqual(status.revision, 4)
+        self.assertEqual(status.chart, "quixplatform-manager")
+        self.assertIsNone(status.app_version)
+
+    def test_parse_history(self):
+        history = parse_history(b'[{"revision": 3, "updated": "u3", "status": "pending-upgrade", "chart": "c-1.1.0", '
+                                b'"app_version": "1.1.0", "description": "Preparing upgrade"}, '
+                                b'{"revision": 2, "updated": "u2", "status": "deployed", "chart": "c-1.0.0", '
+                                b'"app_version": "1.0.0", "description": "Upgrade complete"}]')
+        self.assertEqual(history, [
+            Revision(2, "u2", "deployed", "c", "1.0.0", "1.0.0", "Upgrade complete"),
+            Revision(3, "u3", "pending-upgrade", "c", "1.1.0", "1.1.0", "Preparing upgrade"),
+        ])
+
+    def test_last_deployed_revision(self):
+        def revision(number, status):
+            return Revision(number, "", status, "c", "1.0.0", "1.0.0", "")
+        self.assertEqual(last_deployed_revision([revision(1, "superseded"), revision(2, "deployed"), revision(3, "failed"),
+                                                 revision(4, "pending-upgrade")]).revision, 2)
+        # After a failed rollback no revision is deployed any more
+        self.assertEqual(last_deployed_revision([revision(1, "superseded"), revision(2, "superseded"), revision(3, "failed")]).revision, 2)
+        self.assertIsNone(last_deployed_revision([revision(1, "pending-install")]))
+
+    def test_parse_values(self):
+        self.assertEqual(parse_values(b'{"image": {"tag": "1.0.0"}}'), {"image": {"tag": "1.0.0"}})
+        self.assertEqual(parse_values(b"null"), {})
+        with self.assertRaises(ValueError):
+            parse_values(b"USER-SUPPLIED VALUES:\nimage: {}")
+
+
+class TestReleaseSnapshot(unittest.TestCase):
+    def test_from_releases(self):
+        snapshot = ReleaseSnapshot.from_releases("test", parse_release_list(HELM_LIST_OUTPUT))
+        self.assertEqual(snapshot.chart_version, "1.5.4")
+        self.assertEqual(snapshot.revision, 7)
+        self.assertEqual(snapshot.status, "pending-upgrade")
+        self.assertTrue(snapshot.found)
+        self.assertFalse(snapshot.exists)
+
+    def test_from_releases_deployed(self):
+        snapshot = ReleaseSnapshot.from_releases("test-other", parse_release_list(HELM_LIST_OUTPUT))
+        self.assertTrue(snapshot.exists)
+        self.assertEqual(snapshot.chart_version, "9.9.9")
+
+    def test_from_releases_not_found(self):
+        snapshot = ReleaseSnapshot.from_releases("missing", parse_release_list(HELM_LIST_OUTPUT))
+        self.assertFalse(snapshot.found)
+        self.assertFalse(snapshot.exists)
+        self.assertIsNone(snapshot.chart_version)
+        self.assertIsNone(snapshot.revision)
+
+
+if __name__ == '__main__':
+    unittest.main()
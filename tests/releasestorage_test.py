@@ -0,0 +1,138 @@
+import os
+import sys
+import gzip
+import json
+import base64
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.helm_backend import HelmBackend
+from src.helm_runner import HelmResult
+from src.release import parse_history, parse_release_list, parse_release_status, parse_values
+from src.release_storage import StorageBackend, StoredRelease, decode_release
+
+
+def release_record(version, status, config=None, chart_version="1.5.4"):
+    return {
+        'name': 'quixplatform-manager',
+        'namespace': 'quix',
+        'version': version,
+        'info': {'status': status, 'last_deployed': f"2024-01-0{version}T00:00:00Z", 'description': f"Revision {version}"},
+        'chart': {'metadata': {'name': 'quixplatform-manager', 'version': chart_version, 'appVersion': chart_version}},
+        'config': config,
+    }
+
+
+def storage_secret(record):
+    # What the API returns: the base64 of the gzip helm stores, base64 encoded once more
+    stored = base64.b64encode(gzip.compress(json.dumps(record).encode('utf-8')))
+    return {
+        'type': 'helm.sh/release.v1',
+        'metadata': {'name': f"sh.helm.release.v1.{record['name']}.v{record['version']}",
+                     'labels': {'owner': 'helm', 'name': record['name'], 'version': str(record['version']), 'status': record['info']['status']}},
+        'data': {'release': base64.b64encode(stored).decode('ascii')},
+    }
+
+
+def kubectl_output(*records):
+    return HelmResult(['kubectl'], 0, stdout=json.dumps({'items': [storage_secret(record) for record in records]}).encode('utf-8'))
+
+
+class FakeBackend(HelmBackend):
+    """Answers every helm operation with an empty JSON list, counting them."""
+    def __init__(self):
+        self.operations = []
+
+    def run(self, helm_args, **kwargs):
+        return HelmResult(['helm'] + helm_args, 0, stdout=b"[]")
+
+    def _call(self, operation, helm_args, artifacts=None, **kwargs):
+        self.operations.append(operation)
+        return super()._call(operation, helm_args, artifacts=artifacts, **kwargs)
+
+
+class TestReleaseStorage(unittest.TestCase):
+    def setUp(self):
+        self.helm = FakeBackend()
+        self.backend = StorageBackend(self.helm, kubectl="kubectl", context="")
+        self.records = [release_record(1, 'superseded', {'replicas': 1}), release_record(2, 'deployed', {'replicas': 2}),
+                        release_record(3, 'pending-upgrade', None, chart_version="1.6.0")]
+
+    def test_decode_release(self):
+        secret = storage_secret(self.records[0])
+        self.assertEqual(decode_release(secret['data']['release']), self.records[0])
+        with self.assertRaises(ValueError):
+            decode_release("not base64!")
+
+    def test_stored_release(self):
+        other = dict(release_record(4, 'deployed'), name='other')
+        stored = StoredRelease('quixplatform-manager', [storage_secret(record) for record in self.records + [other]])
+        self.assertEqual(stored.revisions, [1, 2, 3])
+        self.assertEqual(stored.latest()['info']['status'], 'pending-upgrade')
+        self.assertIsNone(StoredRelease('quixplatform-manager', []).latest())
+
+    def test_queries_read_the_storage_once(self):
+        with patch.object(self.backend.runner, 'run_sync', return_value=kubectl_output(*self.records)) as run_sync:
+            releases = parse_release_list(self.backend.list('quixplatform-manager', 'quix').stdout)
+            status = parse_release_status(self.backend.status('quixplatform-manager', 'quix').stdout)
+            history = parse_history(self.backend.history('quixplatform-manager', 'quix').stdout)
+            values = parse_values(self.backend.get_values('quixplatform-manager', 'quix').stdout)
+
+        run_sync.assert_called_once()
+        self.assertEqual(run_sync.call_args[0][0], ['get', 'secrets', '--selector', 'owner=helm,name=quixplatform-manager',
+                                                    '--output', 'json', '--namespace', 'quix'])
+        self.assertEqual(self.helm.operations, [])
+        self.assertEqual((releases[0].revision, releases[0].status, releases[0].chart_version), (3, 'pending-upgrade', '1.6.0'))
+        self.assertEqual((status.revision, status.chart_version), (3, '1.6.0'))
+        self.assertEqual([(revision.revision, revision.status) for revision in history],
+                         [(1, 'superseded'), (2, 'deployed'), (3, 'pending-upgrade')])
+        self.assertEqual(values, {})
+
+    def test_missing_release_asks_helm(self):
+        # No secret is not proof the release does not exist, helm answers
+        with patch.object(self.backend.runner, 'run_sync', return_value=kubectl_output()) as run_sync:
+            self.backend.list('quixplatform-manager', 'quix')
+            self.backend.status('quixplatform-manager', 'quix')
+        run_sync.assert_called_once()
+        self.assertEqual(self.helm.operations, ['list', 'status'])
+
+    def test_other_storage_driver(self):
+        for driver, available in (("configmap", False), ("sql", False), ("secrets", True), ("", True)):
+            with patch.dict(os.environ, {'HELM_DRIVER': driver}):
+                backend = StorageBackend(FakeBackend(), kubectl="kubectl", context="")
+            self.assertEqual(backend.available, available, driver)
+        with patch('src.release_storage.HelmRunner.run_sync') as run_sync, patch.dict(os.environ, {'HELM_DRIVER': 'configmap'}):
+            backend = StorageBackend(FakeBackend(), kubectl="kubectl", context="")
+            backend.list('quixplatform-manager', 'quix')
+        run_sync.assert_not_called()
+        self.assertEqual(backend.backend.operations, ['list'])
+
+    def test_upgrade_reads_the_storage_again(self):
+        with patch.object(self.backend.runner, 'run_sync', return_value=kubectl_output(*self.records[:2])) as run_sync:
+            self.backend.get_values('quixplatform-manager', 'quix')
+            self.backend.rollback('quixplatform-manager', 2, 'quix')
+            self.assertEqual(json.loads(self.backend.get_values('quixplatform-manager', 'quix').stdout), {'replicas': 2})
+        self.assertEqual(run_sync.call_count, 2)
+        self.assertEqual(self.helm.operations, ['rollback'])
+
+    def test_falls_back_to_helm(self):
+        failure = HelmResult(['kubectl'], 1, stderr=b"Error from server (Forbidden): secrets is forbidden")
+        with patch.object(self.backend.runner, 'run_sync', return_value=failure) as run_sync:
+            self.backend.status('quixplatform-manager', 'quix')
+            self.backend.history('quixplatform-manager', 'quix')
+        run_sync.assert_called_once()
+        self.assertFalse(self.backend.available)
+        self.assertEqual(self.helm.operations, ['status', 'history'])
+
+        # A record that does not decode is also read from helm
+        backend = StorageBackend(FakeBackend(), kubectl="kubectl", context="")
+        damaged = json.loads(kubectl_output(*self.records).stdout)
+        damaged['items'][-1]['data']['release'] = "bm90IGd6aXA="
+        with patch.object(backend.runner, 'run_sync', return_value=HelmResult(['kubectl'], 0, stdout=json.dumps(damaged).encode('utf-8'))):
+            backend.status('quixplatform-manager', 'quix')
+        self.assertEqual(backend.backend.operations, ['status'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import random
+import tempfile
+import unittest
+from argparse import Namespace
+from unittest.mock import MagicMock, patch
+from src.helm_backend import HelmBackend, RetryingBackend
+from src.helm_manager import DeploymentManager, HelmManager
+from src.helm_runner import HelmResult
+from src.retry import Deadline, DeadlineExceeded, RetryPolicy, is_retryable, parse_duration
+
+
+class ScriptedBackend(HelmBackend):
+    """Answers the calls with the given results, in order."""
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+
+    def run(self, helm_args, **kwargs):
+        self.calls.append(kwargs)
+        result = self.results.pop(0)
+        if kwargs.get('on_stdout_line') and result.stdout:
+            kwargs['on_stdout_line'](result.stdout)
+        return result
+
+
+def failure(stderr=b"", timed_out=False):
+    return HelmResult(['helm'], 1, stderr=stderr, timed_out=timed_out)
+
+
+class TestRetry(unittest.TestCase):
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration("6m"), 360)
+        self.assertEqual(parse_duration("1h30m10s"), 5410)
+        self.assertEqual(parse_duration("1500ms"), 1.5)
+        self.assertEqual(parse_duration("45"), 45)
+        with self.assertRaises(ValueError):
+            parse_duration("6 minutes")
+
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable('pull', failure(b"Error: failed to fetch: 502 Bad Gateway")))
+        self.assertTrue(is_retryable('list', failure(b"Error: Kubernetes cluster unreachable: dial tcp: i/o timeout")))
+        self.assertTrue(is_retryable('upgrade', failure(b"Error: UPGRADE FAILED: the server is currently unable to handle the request")))
+        self.assertFalse(is_retryable('get_values', failure(b"Error: release: not found")))
+        self.assertFalse(is_retryable('upgrade', failure(b"Error: UPGRADE FAILED: context deadline exceeded")))
+        # A killed read can run again, a killed upgrade may have started
+        self.assertTrue(is_retryable('status', failure(timed_out=True)))
+        self.assertFalse(is_retryable('upgrade', failure(timed_out=True)))
+        self.assertFalse(is_retryable('list', HelmResult(['helm'], 127, stderr=b"No such file or directory: 'helm'")))
+
+    def test_backoff_is_jittered_and_bounded(self):
+        policy = RetryPolicy(base_delay=1.0, max_delay=5.0, rng=random.Random(1))
+        delays = [policy.delay(retry) for retry in range(6)]
+        self.assertTrue(all(0 <= delay <= min(5.0, 2 ** retry) for retry, delay in enumerate(delays)))
+        self.assertEqual(len(set(delays)), len(delays))
+
+    def test_retries_transient_errors(self):
+        sleep = MagicMock()
+        inner = ScriptedBackend(failure(b"503 Service Unavailable"), failure(b"429 Too Many Requests"), HelmResult(['helm'], 0, stdout=b"[]"))
+        result = RetryingBackend(inner, RetryPolicy(retries=2), sleep=sleep).list("release")
+        self.assertTrue(result.ok)
+        self.assertEqual(len(inner.calls), 3)
+        self.assertEqual(sleep.call_count, 2)
+        # Retries are limited
+        inner = ScriptedBackend(failure(b"503"), failure(b"503"))
+        self.assertFalse(RetryingBackend(inner, RetryPolicy(retries=1), sleep=sleep).list("release").ok)
+        self.assertEqual(len(inner.calls), 2)
+
+    def test_fatal_and_streamed_errors_are_not_retried(self):
+        inner = ScriptedBackend(failure(b"Error: release: not found"))
+        self.assertFalse(RetryingBackend(inner, sleep=MagicMock()).status("release").ok)
+        self.assertEqual(len(inner.calls), 1)
+        inner = ScriptedBackend(HelmResult(['helm'], 1, stdout=b"kind: ConfigMap\n", stderr=b"502 Bad Gateway"))
+        lines = []
+        RetryingBackend(inner, sleep=MagicMock()).template("release", ["chart.tgz"], b"", capture_stdout=False, on_stdout_line=lines.append)
+        self.assertEqual((len(inner.calls), lines), (1, [b"kind: ConfigMap\n"]))
+
+    def test_deadline(self):
+        deadline = Deadline(30)
+        inner = ScriptedBackend(failure(b"502 Bad Gateway"), HelmResult(['helm'], 0))
+        backend = RetryingBackend(inner, RetryPolicy(base_delay=0.01), deadline, sleep=MagicMock())
+        self.assertTrue(backend.status("release").ok)
+        self.assertTrue(all(0 < call['timeout'] <= 30 for call in inner.calls))
+        # No retry when the backoff would run past the deadline
+        inner = ScriptedBackend(failure(b"502 Bad Gateway"))
+        self.assertFalse(RetryingBackend(inner, RetryPolicy(base_delay=100, max_delay=100, rng=MagicMock(uniform=lambda a, b: b)),
+                                         deadline, sleep=MagicMock()).status("release").ok)
+        self.assertEqual(len(inner.calls), 1)
+        with self.assertRaises(DeadlineExceeded):
+            RetryingBackend(ScriptedBackend(), deadline=Deadline(0)).status("release")
+
+    def test_helm_timeout_fits_in_deadline(self):
+        args = Namespace(release_name="test", namespace="default", timeout="6m", override=None, repo="myrepo:2.0.0", action="update")
+        with patch('src.helm_manager.HELM_RUNNER.run_sync'), tempfile.TemporaryDirectory() as tempdir:
+            deployment = DeploymentManager(tempdir=tempdir)
+            self.assertEqual(HelmManager(args, deployment=deployment)._helm_timeout(), "6m")
+            args.deadline = "2m"
+            self.assertIn(HelmManager(args, deployment=deployment)._helm_timeout(), ("107s", "108s"))
+            args.deadline = "1h"
+            self.assertEqual(HelmManager(args, deployment=deployment)._helm_timeout(), "360s")
+
+
+if __name__ == '__main__':
+    unittest.main()
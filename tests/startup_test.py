@@ -0,0 +1,45 @@
+import os
+import sys
+import builtins
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.startup import ImportProfiler, _module_name
+
+
+class TestImportProfiler(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(ImportProfiler.uninstall)
+
+    def test_module_name(self):
+        self.assertEqual(_module_name("src.retry", {}, 0), "src.retry")
+        self.assertEqual(_module_name("error", {'__package__': 'yaml'}, 1), "yaml.error")
+        self.assertEqual(_module_name("", {'__package__': 'a.b'}, 1), "a.b")
+        self.assertEqual(_module_name("c", {'__package__': 'a.b'}, 2), "a.c")
+
+    def test_times_new_imports(self):
+        sys.modules.pop("json.tool", None)
+        profiler = ImportProfiler.install()
+        self.assertIs(ImportProfiler.install(), profiler)
+        # Through the import function of the interpreter, like an import statement
+        __import__("json.tool")
+        __import__("os.path")
+        profiler.ready()
+        self.assertIn("json.tool", profiler.imports)
+        self.assertNotIn("os.path", profiler.imports)
+        cumulative, own = profiler.imports["json.tool"]
+        self.assertGreaterEqual(cumulative, own)
+        self.assertGreater(profiler.total, 0)
+        self.assertEqual(profiler.ready_count, len(profiler.imports))
+
+        with self.assertLogs('quix-manager', level='INFO') as logs:
+            profiler.report(profiler.ready_at - 0.05)
+        self.assertIn("ready to run after 50.0 ms", logs.output[0])
+        self.assertTrue(any("import json.tool took" in line for line in logs.output[1:]))
+
+        ImportProfiler.uninstall()
+        self.assertIs(builtins.__import__, profiler._original)
+
+
+if __name__ == '__main__':
+    unittest.main()
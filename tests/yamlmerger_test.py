@@ -1,16 +1,16 @@
 import unittest
 from unittest.mock import patch, mock_open
-import yaml,sys, os
+import io, yaml,sys, os, copy
 
 # Add the parent directory of the current file to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from src.helm_manager import YamlMerger
+from src.helm_manager import YamlMerger, merge_values, FILL, OVERRIDE
 
 
 class TestYamlMerger(unittest.TestCase):
 
     @patch('builtins.open', new_callable=mock_open, read_data='{}')
-    @patch('yaml.safe_load', return_value={'global': {'version': '1.0'}})
+    @patch('src.helm_manager.load_yaml', return_value={'global': {'version': '1.0'}})
     def test_load_yaml(self, mock_yaml_load, mock_open_file):
         merger = YamlMerger("source.yaml", "new_fields.yaml")
         mock_open_file.assert_any_call("source.yaml", 'r')
@@ -18,7 +18,7 @@ class TestYamlMerger(unittest.TestCase):
         self.assertEqual(merger.source_data, {'global': {'version': '1.0'}})
 
     @patch('builtins.open', new_callable=mock_open, read_data='{}')
-    @patch('yaml.safe_load')
+    @patch('src.helm_manager.load_yaml')
     def test_merge_without_override(self, mock_yaml_load, mock_open_file):
         mock_yaml_load.side_effect = [
             {'global': {'version': '1.0'}, 'data': {'field1': 'value1'}},
@@ -34,7 +34,7 @@ class TestYamlMerger(unittest.TestCase):
         self.assertEqual(merged_data, expected_data)
 
     @patch('builtins.open', new_callable=mock_open, read_data='{}')
-    @patch('yaml.safe_load')
+    @patch('src.helm_manager.load_yaml')
     def test_merge_with_override(self, mock_yaml_load, mock_open_file):
         mock_yaml_load.side_effect = [
             {'global': {'version': '1.0','byocZipVersion': '1.0'}, 'data': {'field1': 'value1'}},
@@ -67,5 +67,79 @@ class TestYamlMerger(unittest.TestCase):
         overridden_data = merger._apply_overrides(data, overrides)
         self.assertEqual(overridden_data, {'key1': 'override_value'})
 
+    def test_load_from_memory(self):
+        source = {'global': {'byocZipVersion': '1.0'}, 'image': {'tag': 'old'}, 'data': {'field1': 'value1'}}
+        new_fields = b"global:\n  byocZipVersion: '2.0'\nimage:\n  tag: new\ndata:\n  field2: value2\n"
+        override = io.StringIO("data:\n  field1: new_value\n")
+        merger = YamlMerger(source, new_fields, override)
+        self.assertEqual(merger.new_fields_data['image'], {'tag': 'new'})
+        self.assertEqual(merger.override_data, {'data': {'field1': 'new_value'}})
+        self.assertEqual(yaml.safe_load(merger.merged_yaml()), {
+            'global': {'byocZipVersion': '2.0'},
+            'image': {'tag': 'new'},
+            'data': {'field1': 'new_value', 'field2': 'value2'},
+        })
+
+    def test_merged_yaml_keeps_multiline_strings_literal(self):
+        source = {'global': {}, 'image': {}, 'script': 'line1\nline2\n'}
+        new_fields = {'global': {'byocZipVersion': '2.0'}, 'image': {'tag': 'new'}}
+        merged = YamlMerger(source, new_fields).merged_yaml()
+        self.assertIn(b"script: |\n  line1\n  line2\n", merged)
+
+    def test_merge_does_not_mutate_inputs(self):
+        source = {'global': {'byocZipVersion': '1.0'}, 'image': {'tag': 'old'}, 'data': {'field1': 'value1'}, 'untouched': {'a': 1}}
+        new_fields = {'global': {'byocZipVersion': '2.0'}, 'image': {'tag': 'new'}, 'data': {'field2': 'value2'}}
+        override = {'data': {'field1': 'new_value'}}
+        originals = copy.deepcopy((source, new_fields, override))
+        merger = YamlMerger(source, new_fields, override)
+        first = merger.merged_values()
+        second = merger.merged_values()
+        self.assertEqual((source, new_fields, override), originals)
+        self.assertEqual(first, second)
+        # Subtrees no layer changes are shared, not copied
+        self.assertIs(first['untouched'], source['untouched'])
+
+    def test_merge_values_keeps_key_order(self):
+        merged = merge_values({'b': 1, 'a': {'y': 1}}, [({'c': 2, 'a': {'x': 2}}, FILL), ({'d': 3, 'a': {'y': 3}}, OVERRIDE)])
+        self.assertEqual(list(merged), ['b', 'a', 'c', 'd'])
+        self.assertEqual(list(merged['a']), ['y', 'x'])
+        self.assertEqual(merged['a'], {'y': 3, 'x': 2})
+
+    def test_merge_values_deep_documents(self):
+        depth = sys.getrecursionlimit() * 2
+        source, new_fields = {}, {}
+        node, new_node = source, new_fields
+        for _ in range(depth):
+            node['child'] = {}
+            new_node['child'] = {}
+            node, new_node = node['child'], new_node['child']
+        node['old'] = 1
+        new_node['new'] = 2
+        merged = merge_values(source, [(new_fields, FILL)])
+        for _ in range(depth):
+            merged = merged['child']
+        self.assertEqual(merged, {'old': 1, 'new': 2})
+        self.assertNotIn('new', node)
+
+    def test_merged_values_provenance(self):
+        source = {'USER-SUPPLIED VALUES': None, 'global': {'byocZipVersion': '1.0', 'domain': 'example.com'},
+                  'image': {'tag': 'old'}, 'annotations': {'kubernetes.io/name': 'x'}, 'list': [1, 2]}
+        new_fields = {'global': {'byocZipVersion': '2.0', 'region': 'eu'}, 'image': {'tag': 'new', 'pullPolicy': 'Always'}}
+        override = {'global': {'domain': 'override.com'}, 'extra': {}}
+        provenance = {}
+        merged = YamlMerger(source, new_fields, override).merged_values(provenance=provenance)
+        self.assertEqual(provenance, {
+            'global.byocZipVersion': 'special',
+            'global.domain': 'override',
+            'global.region': 'defaults',
+            'image.tag': 'special',
+            'image.pullPolicy': 'defaults',
+            'annotations."kubernetes.io/name"': 'release',
+            'list': 'release',
+            'extra': 'override',
+        })
+        self.assertNotIn('USER-SUPPLIED VALUES', merged)
+        self.assertIs(merged['annotations'], source['annotations'])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,78 @@
+"""
+Builds the plugin as a single zipapp with precompiled bytecode, run instead of quix_install_command.py.
+
+Usage: python tools/build_zipapp.py [--output quix-manager.pyz] [--no-compile]
+
+The archive holds quix_install_command.py as __main__ and the src package, next to their bytecode
+compiled by the building interpreter as unchecked hash-based .pyc files: the imports then neither
+look up the files of the plugin one by one nor check or write __pycache__. Run it with the
+interpreter that built it (the plugin venv), another Python version falls back to the sources.
+PyYAML is not bundled, it is imported from the environment of the interpreter.
+"""
+import argparse, os, shutil, sys, zipapp, tempfile, py_compile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MAIN_SCRIPT = "quix_install_command.py"
+PACKAGES = ("src",)
+DEFAULT_OUTPUT = os.path.join(ROOT, "quix-manager.pyz")
+
+
+def _sources():
+    """
+    Lists the Python files of the plugin.
+
+    :return: Tuples of the path of the file and its path in the archive.
+    """
+    yield os.path.join(ROOT, MAIN_SCRIPT), "__main__.py"
+    for package in PACKAGES:
+        directory = os.path.join(ROOT, package)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".py"):
+                yield os.path.join(directory, name), f"{package}/{name}"
+
+
+def build(output: str = DEFAULT_OUTPUT, compile_bytecode: bool = True):
+    """
+    Builds the zipapp, replacing the archive atomically so a running plugin never reads a partial one.
+
+    :param output: The path of the archive.
+    :param compile_bytecode: Add the bytecode of every module next to its source.
+    :return: The names of the files in the archive.
+    """
+    output = os.path.abspath(output)
+    names = []
+    with tempfile.TemporaryDirectory() as staging:
+        for source, name in _sources():
+            target = os.path.join(staging, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+            names.append(name)
+            if compile_bytecode:
+                # zipimport looks for module.pyc next to module.py, not in __pycache__. Unchecked
+                # hashes are never compared to the source, which cannot change inside the archive
+                py_compile.compile(target, cfile=target + "c", dfile=os.path.join(output, name), doraise=True,
+                                   invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+                names.append(name + "c")
+        partial = f"{output}.{os.getpid()}.tmp"
+        try:
+            # Stored, not deflated: the archive is small and read on every start
+            zipapp.create_archive(staging, partial, compressed=False)
+            os.replace(partial, output)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+    return sorted(names)
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='Path of the archive (default quix-manager.pyz in the plugin directory)')
+    parser.add_argument('--no-compile', action='store_true', help='Only bundle the sources, without bytecode')
+    args = parser.parse_args(argv)
+    names = build(args.output, compile_bytecode=not args.no_compile)
+    print(f"Built {args.output} with {len(names)} files for Python {sys.version_info[0]}.{sys.version_info[1]}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
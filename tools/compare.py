@@ -1,66 +1,257 @@
-import yaml
+"""
+Compares the keys and values of two YAML files and reports the differences as JSON.
 
-def load_yaml(file_path):
-    """Loads a YAML file and returns its content as a dictionary."""
-    with open(file_path, 'r') as file:
-        try:
-            return yaml.safe_load(file)
-        except yaml.YAMLError as e:
-            print(f"Error reading YAML file {file_path}: {e}")
-            return None
+Usage: python tools/compare.py OLD NEW [--output PATH] [--indent 2]
+
+The files are read as a stream of parser events, so memory stays bounded on large inputs such as the
+full output of 'helm template'. Multi-document files are supported: values of a document with a kind
+and a metadata.name are reported under 'Kind/name:<path>'. Values longer than a few hundred bytes are
+reported, and compared, by digest.
+
+Exit code: 0 if the files are identical, 1 if they differ, 2 if one of them cannot be read.
+"""
+import argparse, hashlib, json, os, sys, yaml
+from itertools import zip_longest
+from yaml.events import (AliasEvent, DocumentEndEvent, DocumentStartEvent, MappingEndEvent, MappingStartEvent,
+                         ScalarEvent, SequenceEndEvent, SequenceStartEvent)
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.helm_manager import YamlLoader, child_path
+
+# Values longer than this are kept and reported as a digest
+MAX_INLINE = 256
+ROOT_PATH = '.'
+_NO_KEY = object()
+_RESOLVER = yaml.resolver.Resolver()
+
+
+class _Container:
+    __slots__ = ('is_map', 'path', 'key', 'index', 'empty')
+
+    def __init__(self, is_map: bool, path: str):
+        self.is_map = is_map
+        self.path = path
+        self.key = _NO_KEY
+        self.index = 0
+        self.empty = True
+
+    def child(self):
+        """
+        :return: The path of the value the parser is about to produce in this container.
+        """
+        if self.is_map:
+            return child_path(None if self.path == ROOT_PATH else self.path, self.key)
+        return sys.intern(f"{'' if self.path == ROOT_PATH else self.path}[{self.index}]")
+
+    def advance(self):
+        self.empty = False
+        if self.is_map:
+            self.key = _NO_KEY
+        else:
+            self.index += 1
 
-def get_all_keys(data, parent_key=''):
+
+def compact(value: str):
     """
-    Recursively retrieves all keys from the YAML structure.
-    Supports nested fields by concatenating parent and child keys.
+    Shortens a value to a digest when it is too long to be kept in memory while waiting for its match.
+
+    :param value: The value as text.
+    :return: The value itself, or its 'sha256:<hex>' digest.
     """
-    keys = []
-    for key, value in data.items():
-        full_key = f"{parent_key}.{key}" if parent_key else key
-        if isinstance(value, dict):
-            keys.extend(get_all_keys(value, full_key))
-        else:
-            keys.append(full_key)
-    return keys
-
-def compare_yaml_fields(file1_path, file2_path):
-    """Compares the fields (keys) of two YAML files, including nested fields."""
-    # Load both YAML files
-    yaml1 = load_yaml(file1_path)
-    yaml2 = load_yaml(file2_path)
-
-    if yaml1 is None or yaml2 is None:
-        print("Error in loading YAML files. Exiting comparison.")
-        return False
-
-    # Get all keys (including nested) from both YAML files
-    keys1 = set(get_all_keys(yaml1))
-    keys2 = set(get_all_keys(yaml2))
-
-    if keys1 == keys2:
-        print("Both YAML files have the same fields.")
-        return True
+    if len(value) <= MAX_INLINE:
+        return value
+    return f"sha256:{hashlib.sha256(value.encode('utf-8')).hexdigest()}"
+
+
+def scalar_text(event: ScalarEvent):
+    """
+    Renders a scalar so that equal values compare equal whatever their style: plain and quoted strings
+    are the same value, a quoted '1' is not the number 1.
+
+    :param event: The scalar event of the parser.
+    :return: The value as text.
+    """
+    if event.tag and event.tag != '!':
+        return f"{event.tag} {event.value}"
+    if event.implicit[0]:
+        return event.value
+    # A quoted scalar is a string, quote it only when plain it would be read as something else
+    if _RESOLVER.resolve(yaml.ScalarNode, event.value, (True, False)) == yaml.resolver.BaseResolver.DEFAULT_SCALAR_TAG:
+        return event.value
+    return json.dumps(event.value)
+
+
+def iter_values(stream):
+    """
+    Walks the parser events of a YAML stream and yields every leaf value with its path.
+    Empty mappings and sequences are leaves too, mapping keys that are not scalars are reported as '<complex>'.
+
+    :param stream: A readable stream or the YAML content.
+    :return: A generator of (path, value) tuples, the value compacted.
+    """
+    document = 0
+    prefixes = {}
+    stack = []
+    skip = 0
+    buffer = prefix = kind = name = None
+    for event in yaml.parse(stream, Loader=YamlLoader):
+        if isinstance(event, DocumentStartEvent):
+            buffer, prefix, kind, name = [], None, None, None
+            continue
+        if isinstance(event, DocumentEndEvent):
+            if prefix is None:
+                # No kind and metadata.name to name the document, fall back on its position
+                prefix = "" if document == 0 else f"document[{document}]"
+                for path, value in buffer:
+                    yield (f"{prefix}:{path}" if prefix else path), value
+            document += 1
+            buffer = None
+            continue
+        if buffer is None:
+            # Stream start and end
+            continue
+
+        if skip:
+            # Inside a mapping key that is itself a collection
+            if isinstance(event, (MappingStartEvent, SequenceStartEvent)):
+                skip += 1
+            elif isinstance(event, (MappingEndEvent, SequenceEndEvent)):
+                skip -= 1
+                if not skip:
+                    stack[-1].key = '<complex>'
+            continue
+        if stack and stack[-1].is_map and stack[-1].key is _NO_KEY:
+            if isinstance(event, ScalarEvent):
+                stack[-1].key = event.value
+                continue
+            if isinstance(event, (MappingStartEvent, SequenceStartEvent)):
+                skip = 1
+                continue
+            if isinstance(event, AliasEvent):
+                stack[-1].key = f"*{event.anchor}"
+                continue
+
+        leaf = None
+        if isinstance(event, (MappingStartEvent, SequenceStartEvent)):
+            stack.append(_Container(isinstance(event, MappingStartEvent), stack[-1].child() if stack else ROOT_PATH))
+            continue
+        if isinstance(event, (MappingEndEvent, SequenceEndEvent)):
+            container = stack.pop()
+            if container.empty:
+                leaf = (container.path, '{}' if container.is_map else '[]')
+        elif isinstance(event, ScalarEvent):
+            if not stack and event.implicit[0] and event.value == '':
+                # Empty document, e.g. a template rendering nothing
+                continue
+            leaf = (stack[-1].child() if stack else ROOT_PATH, compact(scalar_text(event)))
+        elif isinstance(event, AliasEvent):
+            leaf = (stack[-1].child() if stack else ROOT_PATH, f"*{event.anchor}")
+        if stack:
+            stack[-1].advance()
+        if leaf is None:
+            continue
+
+        if prefix is not None:
+            yield f"{prefix}:{leaf[0]}", leaf[1]
+            continue
+        buffer.append(leaf)
+        if leaf[0] == 'kind':
+            kind = leaf[1]
+        elif leaf[0] == 'metadata.name':
+            name = leaf[1]
+        if kind is not None and name is not None:
+            # The document is named, release the values read so far
+            prefix = f"{kind}/{name}"
+            prefixes[prefix] = prefixes.get(prefix, 0) + 1
+            if prefixes[prefix] > 1:
+                prefix = f"{prefix}#{prefixes[prefix]}"
+            for path, value in buffer:
+                yield f"{prefix}:{path}", value
+            buffer = []
+
+
+def diff_values(old_values, new_values):
+    """
+    Compares two streams of (path, value) tuples read in lockstep. Only the values not matched yet
+    are kept in memory, which stays small when both files list their keys in a similar order.
+
+    :param old_values: The values of the old file, as yielded by iter_values.
+    :param new_values: The values of the new file, as yielded by iter_values.
+    :return: A dictionary with the 'added', 'removed' and 'changed' values.
+    """
+    pending_old, pending_new = {}, {}
+    changed = []
+    for old, new in zip_longest(old_values, new_values):
+        if old is not None and new is not None and old[0] == new[0]:
+            if old[1] != new[1]:
+                changed.append({'path': old[0], 'old': old[1], 'new': new[1]})
+            continue
+        if old is not None:
+            path, value = old
+            other = pending_new.pop(path, _NO_KEY)
+            if other is _NO_KEY:
+                pending_old[path] = value
+            elif other != value:
+                changed.append({'path': path, 'old': value, 'new': other})
+        if new is not None:
+            path, value = new
+            other = pending_old.pop(path, _NO_KEY)
+            if other is _NO_KEY:
+                pending_new[path] = value
+            elif other != value:
+                changed.append({'path': path, 'old': other, 'new': value})
+    return {
+        'added': [{'path': path, 'value': value} for path, value in pending_new.items()],
+        'removed': [{'path': path, 'value': value} for path, value in pending_old.items()],
+        'changed': changed,
+    }
+
+
+def compare_yaml_files(old_path: str, new_path: str):
+    """
+    Compares the keys and values of two YAML files.
+
+    :param old_path: The path of the old file, '-' for stdin.
+    :param new_path: The path of the new file, '-' for stdin.
+    :return: A dictionary with the 'added', 'removed' and 'changed' values.
+    """
+    old_file = sys.stdin.buffer if old_path == '-' else open(old_path, 'rb')
+    try:
+        new_file = sys.stdin.buffer if new_path == '-' else open(new_path, 'rb')
+        try:
+            return diff_values(iter_values(old_file), iter_values(new_file))
+        finally:
+            if new_file is not sys.stdin.buffer:
+                new_file.close()
+    finally:
+        if old_file is not sys.stdin.buffer:
+            old_file.close()
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('old', help='The old YAML file, - for stdin')
+    parser.add_argument('new', help='The new YAML file, - for stdin')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    parser.add_argument('--indent', type=int, default=None, help='Indent the JSON report')
+    args = parser.parse_args(argv)
+    if args.old == '-' and args.new == '-':
+        parser.error("only one of the files can be read from stdin")
+
+    try:
+        differences = compare_yaml_files(args.old, args.new)
+    except (OSError, yaml.YAMLError) as e:
+        print(f"Error reading YAML files: {e}", file=sys.stderr)
+        return 2
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(differences, f, indent=args.indent)
     else:
-        print("YAML files have different fields.")
-        
-        # Fields that are in file1 but not in file2
-        diff1 = keys1 - keys2
-        if diff1:
-            print(f"Fields in {file1_path} but not in {file2_path}:")
-            for key in diff1:
-                print(f"  - {key}")
-
-        # Fields that are in file2 but not in file1
-        diff2 = keys2 - keys1
-        if diff2:
-            print(f"Fields in {file2_path} but not in {file1_path}:")
-            for key in diff2:
-                print(f"  - {key}")
-        
-        return False
-
-
-# Example usage:
-file1_path = "file.yaml"
-file2_path = "file2.yaml"
-compare_yaml_fields(file1_path, file2_path)
+        json.dump(differences, sys.stdout, indent=args.indent)
+        sys.stdout.write("\n")
+    return 1 if any(differences.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
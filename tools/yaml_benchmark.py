@@ -0,0 +1,65 @@
+"""
+Compares the pure Python and the libyaml backed YAML loader and dumper on a large values document.
+
+Usage: python tools/yaml_benchmark.py [--size-kb 300] [--repeat 5]
+"""
+import argparse, os, sys, time, yaml
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.helm_manager import YamlDumper, YamlLoader
+
+
+def build_values(size_kb: int):
+    """Builds a values document shaped like a platform values file, of roughly size_kb kilobytes."""
+    values = {'global': {'byocZipVersion': '1.0.0'}, 'image': {'tag': '1.0.0'}, 'services': {}}
+    index = 0
+    # Measuring the size is a full dump, so it is only done every batch of services
+    while index % 25 or len(yaml.dump(values, Dumper=YamlDumper)) < size_kb * 1024:
+        values['services'][f'service{index}'] = {
+            'replicaCount': index % 5,
+            'image': {'repository': f'quix/service{index}', 'tag': f'1.{index}.0'},
+            'resources': {'limits': {'cpu': '500m', 'memory': '512Mi'}},
+            'env': [{'name': f'VAR_{i}', 'value': str(i)} for i in range(5)],
+            'config': 'line one\nline two\nline three\n',
+        }
+        index += 1
+    return values
+
+
+def timed(func, repeat: int):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-kb', type=int, default=300, help='Approximate size of the values document')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs, the best one is reported')
+    args = parser.parse_args()
+
+    values = build_values(args.size_kb)
+    document = yaml.dump(values, Dumper=yaml.Dumper, default_flow_style=False, sort_keys=False)
+    print(f"Document size: {len(document) / 1024:.0f} KB, libyaml available: {YamlLoader is not yaml.SafeLoader}")
+
+    if yaml.dump(values, Dumper=YamlDumper, default_flow_style=False, sort_keys=False) != document:
+        print("The libyaml dumper output differs from the pure Python dumper output")
+        return 1
+
+    rows = [
+        ("load", lambda: yaml.load(document, Loader=yaml.SafeLoader), lambda: yaml.load(document, Loader=YamlLoader)),
+        ("dump", lambda: yaml.dump(values, Dumper=yaml.Dumper, default_flow_style=False, sort_keys=False),
+                 lambda: yaml.dump(values, Dumper=YamlDumper, default_flow_style=False, sort_keys=False)),
+    ]
+    for name, python_func, fast_func in rows:
+        python_time, fast_time = timed(python_func, args.repeat), timed(fast_func, args.repeat)
+        print(f"{name}: python {python_time * 1000:.1f} ms, libyaml {fast_time * 1000:.1f} ms, speedup {python_time / fast_time:.1f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())